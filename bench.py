@@ -0,0 +1,549 @@
+"""Offline benchmark harness for bot.py.
+
+Replays synthetic Telegram updates through bot.process_new_updates against a
+temporary seeded database, with a local stub standing in for the Bot API.
+
+    python bench.py --users 10000,100000 --updates 5000 --save benchmarks/baseline.json
+    python bench.py --users 10000 --compare benchmarks/baseline.json
+    python bench.py --users 10000 --polling --fail-rate 0.05
+    python bench.py --router
+    python bench.py --parse
+"""
+import os
+import sys
+import json
+import time
+import random
+import sqlite3
+import argparse
+import tempfile
+import threading
+import contextlib
+import seed as seeding
+from collections import defaultdict
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ADMIN_ID = seeding.ADMIN_IDS[0]
+BENCH_TOKEN = "123456:BENCHMARK"
+BENCH_ACTIONS_PER_USER = 5
+SCENARIOS = ["start_referral", "earn_spam", "task_taps", "redeem_burst", "withdrawals", "admin_views", "payments"]
+
+# ================= BOT API STUB =================
+class StubApiHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    calls = defaultdict(int)
+    updates = []      # served by getUpdates in --polling mode
+    star_transactions = []  # served by getStarTransactions, newest first
+    fail_rate = 0.0   # share of sendMessage/answerCallbackQuery calls answered with a 500
+    rng = random.Random(0)
+
+    def _reply(self):
+        parsed = urlparse(self.path)
+        method = parsed.path.rsplit("/", 1)[-1]
+        params = {k: v[0] for k, v in parse_qs(parsed.query).items()}
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        if self.headers.get("Content-Type", "").startswith("application/x-www-form-urlencoded"):
+            # The asyncio client posts its parameters as a form
+            params.update({k: v[0] for k, v in parse_qs(body.decode()).items()})
+        StubApiHandler.calls[method] += 1
+
+        chat_id = params.get("chat_id", "0")
+        chat_id = int(chat_id) if chat_id.lstrip("-").isdigit() else chat_id
+        if method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        elif method == "getChatMember":
+            user_id = int(params.get("user_id", 0))
+            result = {"status": "member", "user": {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"}}
+        elif method == "createInvoiceLink":
+            result = f"https://t.me/$bench_{params.get('payload', '')}"
+        elif method == "getStarTransactions":
+            offset = int(params.get("offset") or 0)
+            limit = int(params.get("limit") or 100)
+            result = {"transactions": StubApiHandler.star_transactions[offset:offset + limit]}
+        elif method == "getUpdates":
+            offset = int(params.get("offset") or 0)
+            limit = int(params.get("limit") or 100)
+            result = [raw for raw in StubApiHandler.updates if raw["update_id"] >= offset][:limit]
+        elif (method in ("sendMessage", "answerCallbackQuery")
+              and StubApiHandler.rng.random() < StubApiHandler.fail_rate):
+            return self._send(500, {"ok": False, "error_code": 500, "description": "Internal Server Error"})
+        elif method in ("sendMessage", "editMessageText", "sendInvoice", "sendDocument"):
+            result = {"message_id": 1, "date": int(time.time()), "chat": {"id": chat_id, "type": "private"},
+                      "text": params.get("text", "")}
+        else:
+            result = True
+        self._send(200, {"ok": True, "result": result})
+
+    def _send(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = _reply
+    do_POST = _reply
+
+    def log_message(self, *args):
+        pass
+
+def start_stub_api():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubApiHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+# ================= BOT LOADING =================
+def load_bot(workdir, api_url):
+    os.environ["BOT_TOKEN"] = BENCH_TOKEN
+    os.environ["DB_PATH"] = os.path.join(workdir, "bootstrap.db")
+    os.environ["REPLICA_DB_PATH"] = os.path.join(workdir, "replica.db")
+    os.environ["REPLICA_INTERVAL"] = "0"
+    os.environ["RETENTION_INTERVAL"] = "0"
+    for key in ("GITHUB_TOKEN", "GITHUB_REPO", "RENDER_EXTERNAL_URL"):
+        os.environ.pop(key, None)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+    import telebot
+    telebot.apihelper.API_URL = api_url + "/bot{0}/{1}"
+    import bot
+    # Run handlers inline so each process_new_updates call is one measurable unit
+    bot.bot.threaded = False
+    return bot
+
+def attach_database(bot, path):
+    """Point bot.py at a fresh database file carrying the same schema."""
+    schema = [row[0] for row in bot.conn.execute(
+        """SELECT sql FROM sqlite_master WHERE sql IS NOT NULL AND name NOT LIKE 'sqlite_%'
+           ORDER BY CASE type WHEN 'table' THEN 0 WHEN 'index' THEN 1 ELSE 2 END""")]
+    if os.path.exists(path):
+        os.remove(path)
+    new_conn = sqlite3.connect(path, check_same_thread=False)
+    for sql in schema:
+        new_conn.execute(sql)
+    new_conn.commit()
+    bot.conn = new_conn
+    bot.store = bot.SQLiteStorage(new_conn, bot.InstrumentedCursor)
+    bot.known_users.clear()
+    return new_conn
+
+# ================= UPDATE GENERATION =================
+class UpdateFactory:
+    def __init__(self, users, rng):
+        self.users = users
+        self.rng = rng
+        self.update_id = 0
+        self.new_user_id = users + 1000000
+
+    def _user(self, user_id):
+        return {"id": user_id, "is_bot": False, "first_name": f"User{user_id}", "username": f"user{user_id}"}
+
+    def message(self, user_id, text):
+        self.update_id += 1
+        msg = {"message_id": self.update_id, "date": int(time.time()), "from": self._user(user_id),
+               "chat": {"id": user_id, "type": "private"}, "text": text}
+        if text.startswith("/"):
+            msg["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return {"update_id": self.update_id, "message": msg}
+
+    def callback(self, user_id, data):
+        self.update_id += 1
+        return {"update_id": self.update_id, "callback_query": {
+            "id": str(self.update_id), "from": self._user(user_id), "chat_instance": "1", "data": data,
+            "message": {"message_id": 1, "date": int(time.time()), "chat": {"id": user_id, "type": "private"},
+                        "text": "⚡ Pulse Profit"}}}
+
+    def payment(self, user_id, payload, amount, charge_id):
+        self.update_id += 1
+        msg = {"message_id": self.update_id, "date": int(time.time()), "from": self._user(user_id),
+               "chat": {"id": user_id, "type": "private"},
+               "successful_payment": {"currency": "XTR", "total_amount": amount, "invoice_payload": payload,
+                                      "telegram_payment_charge_id": charge_id, "provider_payment_charge_id": ""}}
+        return {"update_id": self.update_id, "message": msg}
+
+    def random_user(self):
+        return self.rng.randint(1, self.users)
+
+    def scenario(self, name):
+        """Return the list of raw updates making up one occurrence of a scenario."""
+        if name == "start_referral":
+            self.new_user_id += 1
+            return [self.message(self.new_user_id, f"/start {self.random_user()}")]
+        if name == "earn_spam":
+            user_id = self.random_user()
+            return [self.callback(user_id, "earn") for _ in range(3)]
+        if name == "task_taps":
+            return [self.callback(self.random_user(), f"do_task_{self.rng.randint(1, seeding.TASKS)}")]
+        if name == "redeem_burst":
+            user_id = self.random_user()
+            return [self.callback(user_id, "redeem_menu"),
+                    self.message(user_id, f"SEED-{self.rng.randint(1, seeding.CODES):04d}")]
+        if name == "withdrawals":
+            user_id = self.random_user()
+            return [self.callback(user_id, "withdraw_menu"), self.callback(user_id, "withdraw_stars"),
+                    self.callback(user_id, "withdraw_auto_50")]
+        if name == "admin_views":
+            return [self.callback(ADMIN_ID, data) for data in ("admin_panel", "admin_stats", "leaderboard")]
+        if name == "payments":
+            # A purchase whose update Telegram delivers twice; the second must not credit again
+            user_id = self.random_user()
+            payment = self.payment(user_id, "buy_100", 85, f"bench_charge_{self.update_id}")
+            redelivered = json.loads(json.dumps(payment))
+            return [payment, redelivered]
+        raise ValueError(f"Unknown scenario: {name}")
+
+# ================= REPLAY =================
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))
+    return ordered[index]
+
+def prepare_scale(bot, workdir, users, updates, scenarios, seed):
+    """Seed a fresh database and build the update plan. Returns (conn, seed seconds, plan)."""
+    rng = random.Random(seed)
+    conn = attach_database(bot, os.path.join(workdir, f"bench_{users}.db"))
+    started = time.perf_counter()
+    seeding.populate(conn, seed=seed, users=users, actions_per_user=BENCH_ACTIONS_PER_USER)
+    seed_seconds = time.perf_counter() - started
+    # Route analytics reads the way production does once the replica is warm
+    bot.replica.refresh()
+
+    factory = UpdateFactory(users, rng)
+    plan = []
+    while len(plan) < updates:
+        name = rng.choice(scenarios)
+        plan.extend((name, raw) for raw in factory.scenario(name))
+    return conn, seed_seconds, plan[:updates]
+
+def run_scale(bot, workdir, users, updates, scenarios, seed):
+    import telebot
+    conn, seed_seconds, plan = prepare_scale(bot, workdir, users, updates, scenarios, seed)
+    statements = [0]
+    conn.set_trace_callback(lambda sql: statements.__setitem__(0, statements[0] + 1))
+
+    latencies = defaultdict(list)
+    sql_counts = defaultdict(list)
+    errors = defaultdict(int)
+    api_calls_before = sum(StubApiHandler.calls.values())
+
+    wall_start = time.perf_counter()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        for name, raw in plan:
+            update = telebot.types.Update.de_json(raw)
+            statements[0] = 0
+            t0 = time.perf_counter()
+            try:
+                bot.bot.process_new_updates([update])
+            except Exception:
+                errors[name] += 1
+            latencies[name].append((time.perf_counter() - t0) * 1000)
+            sql_counts[name].append(statements[0])
+    wall = time.perf_counter() - wall_start
+    conn.set_trace_callback(None)
+
+    all_latencies = [v for values in latencies.values() for v in values]
+    all_sql = [v for values in sql_counts.values() for v in values]
+    return {
+        "users": users,
+        "updates": len(plan),
+        "seed_seconds": round(seed_seconds, 3),
+        "wall_seconds": round(wall, 3),
+        "updates_per_s": round(len(plan) / wall, 1) if wall else 0.0,
+        "p50_ms": round(percentile(all_latencies, 50), 3),
+        "p99_ms": round(percentile(all_latencies, 99), 3),
+        "sql_per_update": round(sum(all_sql) / len(all_sql), 2) if all_sql else 0.0,
+        "api_calls_per_update": round((sum(StubApiHandler.calls.values()) - api_calls_before) / len(plan), 2),
+        "errors": sum(errors.values()),
+        "scenarios": {
+            name: {
+                "updates": len(latencies[name]),
+                "p50_ms": round(percentile(latencies[name], 50), 3),
+                "p99_ms": round(percentile(latencies[name], 99), 3),
+                "sql_per_update": round(sum(sql_counts[name]) / len(sql_counts[name]), 2),
+                "errors": errors[name],
+            }
+            for name in sorted(latencies)
+        },
+    }
+
+def run_polled(bot, workdir, users, updates, scenarios, seed):
+    """Serve the plan through the stub's getUpdates and drain it with the bot's long poller."""
+    conn, seed_seconds, plan = prepare_scale(bot, workdir, users, updates, scenarios, seed)
+    statements = [0]
+    conn.set_trace_callback(lambda sql: statements.__setitem__(0, statements[0] + 1))
+    StubApiHandler.updates = [raw for _, raw in plan]
+    last_update_id = plan[-1][1]["update_id"]
+
+    poller = bot.LongPoller(timeout=0)
+    bot.bot.threaded = False
+    failures = [0]
+    commit = poller.commit
+    def counting_commit(batch, handled, failed):
+        failures[0] += len(failed)
+        commit(batch, handled, failed)
+    poller.commit = counting_commit
+
+    batch_latencies = []
+    api_calls_before = sum(StubApiHandler.calls.values())
+    dropped_before = bot.metrics.snapshot()["counters"].get(("bot_poll_updates_dropped_total", ()), 0)
+    wall_start = time.perf_counter()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        while poller.offset is None or poller.offset <= last_update_id:
+            t0 = time.perf_counter()
+            poller.poll_once()
+            batch_latencies.append((time.perf_counter() - t0) * 1000)
+    wall = time.perf_counter() - wall_start
+    conn.set_trace_callback(None)
+    poller.executor.shutdown()
+    StubApiHandler.updates = []
+    dropped = bot.metrics.snapshot()["counters"].get(("bot_poll_updates_dropped_total", ()), 0) - dropped_before
+
+    return {
+        "users": users,
+        "updates": len(plan),
+        "seed_seconds": round(seed_seconds, 3),
+        "wall_seconds": round(wall, 3),
+        "updates_per_s": round(len(plan) / wall, 1) if wall else 0.0,
+        "batches": len(batch_latencies),
+        "p50_ms": round(percentile(batch_latencies, 50), 3),
+        "p99_ms": round(percentile(batch_latencies, 99), 3),
+        "sql_per_update": round(statements[0] / len(plan), 2),
+        "api_calls_per_update": round((sum(StubApiHandler.calls.values()) - api_calls_before) / len(plan), 2),
+        "retries": failures[0],
+        "errors": int(dropped),
+        "scenarios": {},
+    }
+
+# ================= ROUTER MICRO-BENCHMARK =================
+ROUTE_COUNTS = [10, 100, 1000, 10000]
+ROUTER_LOOKUPS = 200000
+
+def bench_router(bot):
+    """Time callback lookups through CallbackRouter against a linear scan of lambda filters."""
+    async def handler(call, **kwargs):
+        pass
+
+    print(f"\n🧭 Callback dispatch, {ROUTER_LOOKUPS} lookups per row (ns/lookup)")
+    print(f"   {'routes':>8} {'router':>10} {'linear scan':>12}")
+    for count in ROUTE_COUNTS:
+        router = bot.CallbackRouter()
+        filters = []
+        for i in range(count // 2):
+            router.route(f"menu_{i}")(handler)
+            router.route(f"item_{i}_{{item_id}}", int)(handler)
+            filters.append(lambda data, exact=f"menu_{i}": data == exact)
+            filters.append(lambda data, prefix=f"item_{i}_": data.startswith(prefix))
+        # Half exact, half parameterized, spread over the whole table
+        samples = [f"menu_{i}" if i % 2 else f"item_{i}_{i * 7}" for i in range(0, count // 2, max(1, count // 200))]
+        lookups = [samples[i % len(samples)] for i in range(ROUTER_LOOKUPS)]
+
+        started = time.perf_counter()
+        for data in lookups:
+            router.resolve(data)
+        routed = (time.perf_counter() - started) / ROUTER_LOOKUPS * 1e9
+
+        scanned_lookups = lookups[:max(1000, ROUTER_LOOKUPS // count)]
+        started = time.perf_counter()
+        for data in scanned_lookups:
+            for test in filters:
+                if test(data):
+                    break
+        scanned = (time.perf_counter() - started) / len(scanned_lookups) * 1e9
+        print(f"   {count:>8} {routed:>10.0f} {scanned:>12.0f}")
+
+# ================= WEBHOOK PARSE MICRO-BENCHMARK =================
+PARSE_ROUNDS = 20000
+
+def parse_samples(factory):
+    """One raw webhook body per update shape the bot receives."""
+    photo = factory.message(42, "")
+    del photo["message"]["text"]
+    photo["message"]["photo"] = [{"file_id": "x", "file_unique_id": "y", "width": 90, "height": 90}]
+    edited = factory.message(42, "hello")
+    edited["edited_message"] = edited.pop("message")
+    return {
+        "command": factory.message(42, "/start 17"),
+        "plain_text": factory.message(42, "hello there"),
+        "callback": factory.callback(42, "do_task_7"),
+        "unknown_callback": factory.callback(42, "stale_button"),
+        "photo": photo,
+        "edited_message": edited,
+    }
+
+def bench_parse(bot):
+    """Per update type: full json + telebot parse (the old webhook) against peek_update (+ build when kept)."""
+    import telebot
+    samples = parse_samples(UpdateFactory(1000, random.Random(1)))
+    print(f"\n🔎 Webhook parse cost, {PARSE_ROUNDS} rounds ({'orjson' if bot.orjson else 'json'} peek, us/update)")
+    print(f"   {'update':<17} {'full parse':>10} {'peek':>8} {'peek+build':>11}  verdict")
+    for name, raw in samples.items():
+        body = json.dumps(raw).encode()
+        started = time.perf_counter()
+        for _ in range(PARSE_ROUNDS):
+            telebot.types.Update.de_json(body.decode("utf-8"))
+        full = (time.perf_counter() - started) / PARSE_ROUNDS * 1e6
+
+        started = time.perf_counter()
+        for _ in range(PARSE_ROUNDS):
+            bot.peek_update(body)
+        peek = (time.perf_counter() - started) / PARSE_ROUNDS * 1e6
+
+        started = time.perf_counter()
+        for _ in range(PARSE_ROUNDS):
+            data, detail = bot.peek_update(body)
+            if data is not None:
+                telebot.types.Update.de_json(data)
+        built = (time.perf_counter() - started) / PARSE_ROUNDS * 1e6
+
+        data, detail = bot.peek_update(body)
+        verdict = f"drop ({detail})" if data is None else "state check" if detail else "handle"
+        print(f"   {name:<17} {full:>10.1f} {peek:>8.1f} {built:>11.1f}  {verdict}")
+
+# ================= RECONCILIATION BENCHMARK =================
+RECONCILE_PAYMENTS = 2000
+
+def bench_reconcile(bot, count, seed):
+    """Reconcile a synthetic Star transaction list with planted mismatches, offline, and check what is found."""
+    rng = random.Random(seed)
+    now = int(time.time())
+    transactions, expected = [], defaultdict(int)
+    for i in range(count):
+        charge_id = f"bench_recon_{i}"
+        user = {"id": rng.randint(1, 1000), "is_bot": False, "first_name": "Bench"}
+        tx = {"id": charge_id, "amount": 85, "date": now - i,
+              "source": {"type": "user", "user": user, "invoice_payload": "buy_100"}}
+        kind = rng.choices(["ok", "missing", "amount_mismatch", "refunded", "orphan"], [90, 3, 2, 3, 2])[0]
+        if kind != "missing":
+            bot.store.record_payment(charge_id, user["id"], "buy_100", 80 if kind == "amount_mismatch" else 85, 100)
+        if kind == "refunded":
+            transactions.append({"id": charge_id, "amount": 85, "date": now - i, "receiver": {"type": "user", "user": user}})
+        if kind != "orphan":
+            transactions.append(tx)
+        if kind != "ok":
+            expected[kind] += 1
+    # Recorded a minute ago, so every row falls inside the window the run checks
+    bot.store._run("UPDATE payments SET created_at = created_at - 60")
+
+    fetched = []
+    def fetch(offset, limit):
+        fetched.append(offset)
+        return transactions[offset:offset + limit]
+
+    print(f"\n💰 Payment reconciliation, {count} payments, {len(transactions)} Star transactions")
+    failed = False
+    for label, repair, want in (("report", False, expected),
+                                ("repair", True, expected),
+                                ("after repair", False, {k: v for k, v in expected.items() if k not in ("missing", "refunded")})):
+        fetched.clear()
+        started = time.perf_counter()
+        report = bot.reconcile_payments(repair=repair, fetch=fetch)
+        elapsed = (time.perf_counter() - started) * 1000
+        found = {kind: len(items) for kind, items in report["found"].items()}
+        ok = found == dict(want)
+        failed |= not ok
+        print(f"   {label:<13} {elapsed:>8.1f}ms  {len(fetched)} pages  found {found}  repaired {report['repaired']}  "
+              f"{'✅' if ok else '❌ expected ' + str(dict(want))}")
+    return not failed
+
+# ================= REPORTING =================
+def print_report(result):
+    print(f"\n👥 {result['users']} users - {result['updates']} updates (seeded in {result['seed_seconds']}s)")
+    if "batches" in result:
+        print(f"   polled in {result['batches']} batches | {result['retries']} failed attempts redelivered | "
+              f"{result['errors']} updates dropped | p50/p99 are per batch")
+    print(f"   {result['updates_per_s']} updates/s | p50 {result['p50_ms']}ms | p99 {result['p99_ms']}ms | "
+          f"{result['sql_per_update']} SQL/update | {result['api_calls_per_update']} API calls/update | "
+          f"{result['errors']} errors")
+    for name, stats in result["scenarios"].items():
+        print(f"   - {name:<15} n={stats['updates']:<6} p50 {stats['p50_ms']:>8}ms  p99 {stats['p99_ms']:>8}ms  "
+              f"{stats['sql_per_update']:>6} SQL/update  {stats['errors']} errors")
+
+def compare(results, baseline_path):
+    with open(baseline_path) as f:
+        baseline = {run["users"]: run for run in json.load(f)["runs"]}
+    print(f"\n📊 Compared to {baseline_path}")
+    for result in results:
+        base = baseline.get(result["users"])
+        if not base:
+            print(f"   {result['users']} users: no baseline")
+            continue
+        for key in ("updates_per_s", "p50_ms", "p99_ms", "sql_per_update"):
+            old, new = base[key], result[key]
+            change = ((new - old) / old * 100) if old else 0.0
+            print(f"   {result['users']} users {key:<15} {old:>10} -> {new:>10} ({change:+.1f}%)")
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay synthetic updates through bot.py")
+    parser.add_argument("--users", default="10000", help="Comma-separated seed sizes, e.g. 10000,100000,1000000")
+    parser.add_argument("--updates", type=int, default=2000, help="Updates replayed per seed size")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--save", help="Write results to this JSON baseline file")
+    parser.add_argument("--compare", help="Compare results against a saved JSON baseline")
+    parser.add_argument("--polling", action="store_true",
+                        help="Deliver updates through getUpdates and the bot's long poller instead of directly")
+    parser.add_argument("--fail-rate", type=float, default=0.0,
+                        help="Share of sendMessage/answerCallbackQuery calls the stub fails (exercises redelivery)")
+    parser.add_argument("--parse", action="store_true",
+                        help="Only run the webhook parse micro-benchmark")
+    parser.add_argument("--router", action="store_true",
+                        help="Only run the callback router micro-benchmark")
+    parser.add_argument("--reconcile", action="store_true",
+                        help="Only run payment reconciliation against a planted Star transaction list")
+    parser.add_argument("--check-plans", action="store_true",
+                        help="Exit non-zero if a hot query's plan is a full table scan on the seeded data")
+    args = parser.parse_args()
+
+    scales = [int(n) for n in args.users.split(",")]
+    scenarios = args.scenarios.split(",")
+    StubApiHandler.fail_rate = args.fail_rate
+    server = start_stub_api()
+    api_url = f"http://127.0.0.1:{server.server_address[1]}"
+
+    with tempfile.TemporaryDirectory(prefix="pulse_bench_") as workdir:
+        bot = load_bot(workdir, api_url)
+        if args.router or args.parse or args.reconcile:
+            if args.router:
+                bench_router(bot)
+            if args.parse:
+                bench_parse(bot)
+            if args.reconcile and not bench_reconcile(bot, RECONCILE_PAYMENTS, args.seed):
+                sys.exit(1)
+            server.shutdown()
+            return
+        results = []
+        regressions = {}
+        for users in scales:
+            run = run_polled if args.polling else run_scale
+            result = run(bot, workdir, users, args.updates, scenarios, args.seed)
+            print_report(result)
+            results.append(result)
+            if args.check_plans:
+                for name, scans in bot.check_query_plans(bot.conn).items():
+                    regressions[f"{users} users: {name}"] = scans
+
+    server.shutdown()
+
+    if args.save:
+        os.makedirs(os.path.dirname(os.path.abspath(args.save)), exist_ok=True)
+        with open(args.save, "w") as f:
+            json.dump({"created_at": time.strftime("%Y-%m-%d %H:%M:%S"), "seed": args.seed,
+                       "scenarios": scenarios, "runs": results}, f, indent=2)
+        print(f"\n💾 Baseline saved to {args.save}")
+    if args.compare:
+        compare(results, args.compare)
+    if args.check_plans:
+        if regressions:
+            print("\n❌ Query plan regressions:")
+            for name, scans in regressions.items():
+                print(f"   {name}: {'; '.join(scans)}")
+            sys.exit(1)
+        print(f"\n✅ All {len(bot.HOT_QUERIES)} hot queries are index-backed")
+
+if __name__ == "__main__":
+    main()
@@ -7,10 +7,37 @@ import time
 import base64
 import string
 import json
+import io
+import html
+import sys
+import re
+import zlib
+import csv
+import gzip
+import hmac
+import hashlib
+import logging
+import queue
+import traceback
+import tempfile
+import asyncio
+import functools
+import contextvars
+import contextlib
+from bisect import bisect_left
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from flask import Flask, request, jsonify
+from typing import Callable, NamedTuple
+from flask import Flask, request, jsonify, Response
 import telebot
+from telebot import apihelper
 from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton, LabeledPrice
+from storage import open_storage, SQLiteStorage, Limits, STATE_FILTER, now_epoch, epoch_text, migrate_sqlite_epochs
+try:
+    import orjson  # optional, parses webhook bodies several times faster than json
+except ImportError:
+    orjson = None
 
 # ================= ENV =================
 TOKEN = os.getenv("BOT_TOKEN")
@@ -18,12 +45,24 @@ RENDER_EXTERNAL_URL = os.getenv("RENDER_EXTERNAL_URL")
 GITHUB_TOKEN = os.getenv("GITHUB_TOKEN")
 GITHUB_REPO = os.getenv("GITHUB_REPO")
 GITHUB_FILE_PATH = "pulse_profit.db"
+EXPORT_TOKEN = os.getenv("EXPORT_TOKEN")
+REPLICA_PATH = os.getenv("REPLICA_DB_PATH", "pulse_profit_replica.db")
+DB_PATH = os.getenv("DB_PATH", "pulse_profit.db")
+DATABASE_URL = os.getenv("DATABASE_URL")  # postgres://... switches storage to PostgreSQL
+RUNTIME = os.getenv("RUNTIME", "sync")  # "async" runs handlers on AsyncTeleBot behind an ASGI server
+UPDATE_MODE = os.getenv("UPDATE_MODE", "auto")  # "webhook", "polling", or auto: webhook when RENDER_EXTERNAL_URL is set
+ARCHIVE_PATH = os.getenv("ARCHIVE_DB_PATH", os.path.splitext(DB_PATH)[0] + "_archive.db")
+# Telegram echoes this in X-Telegram-Bot-Api-Secret-Token; derived from the token unless set explicitly
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or hashlib.sha256(f"webhook:{TOKEN}".encode()).hexdigest()
+WEBHOOK_SECRET_SET = bool(os.getenv("WEBHOOK_SECRET"))
 
-bot = telebot.TeleBot(TOKEN)
+# Updates reach handlers through UpdateLanes (see UPDATE LANES), not TeleBot's own worker pool
+bot = telebot.TeleBot(TOKEN, threaded=False)
 app = Flask(__name__)
 
 # ================= ADMINS =================
-ADMIN_IDS = [7475473197, 7713987088]  # Replace with your admin IDs
+ADMIN_IDS = [7475473197, 7713987088]  # Replace with your admin IDs (owners, always synced as admins)
+admins = set(ADMIN_IDS)  # Loaded from users_wallet.role at startup, refreshed every ADMIN_REFRESH seconds
 
 # ================= REQUIRED CHANNEL =================
 REQUIRED_CHANNEL = "@PulseProfit012"
@@ -46,132 +85,716 @@ STAR_PACKAGES = {
     "1000": 750
 }
 
+# ================= METRICS =================
+HISTOGRAM_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Metrics:
+    """Counters and histograms sharded per thread, so recording never takes a lock."""
+
+    def __init__(self):
+        self._local = threading.local()
+        # A context variable rather than a thread-local, so concurrent handler tasks on one event loop stay apart
+        self._handler = contextvars.ContextVar("handler_context", default=None)
+        self._shards = []
+        self._retired = {"counters": defaultdict(float), "histograms": {}}
+        self._registry_lock = threading.Lock()
+
+    def _shard(self):
+        shard = getattr(self._local, "shard", None)
+        if shard is None:
+            shard = {"counters": defaultdict(float), "histograms": {}}
+            with self._registry_lock:
+                # Fold shards of finished threads so short-lived threads don't accumulate
+                alive = []
+                for thread, old in self._shards:
+                    if thread.is_alive():
+                        alive.append((thread, old))
+                    else:
+                        self._merge(self._retired, old)
+                alive.append((threading.current_thread(), shard))
+                self._shards = alive
+            self._local.shard = shard
+        return shard
+
+    @staticmethod
+    def _merge(target, shard):
+        for key, value in list(shard["counters"].items()):
+            target["counters"][key] += value
+        for key, hist in list(shard["histograms"].items()):
+            merged = target["histograms"].setdefault(key, [0] * (len(HISTOGRAM_BUCKETS) + 1) + [0.0])
+            for i, value in enumerate(hist):
+                merged[i] += value
+
+    def inc(self, name, labels=(), value=1):
+        self._shard()["counters"][(name, labels)] += value
+
+    def observe(self, name, labels, value):
+        histograms = self._shard()["histograms"]
+        hist = histograms.get((name, labels))
+        if hist is None:
+            hist = histograms[(name, labels)] = [0] * (len(HISTOGRAM_BUCKETS) + 1) + [0.0]
+        hist[bisect_left(HISTOGRAM_BUCKETS, value)] += 1
+        hist[-1] += value
+
+    def context(self):
+        """Accounting for the handler running in the current thread or asyncio task."""
+        ctx = self._handler.get()
+        if ctx is None:
+            ctx = self.enter("background")
+        return ctx
+
+    def enter(self, handler):
+        """Start fresh accounting for `handler` in the current context. Returns the new accounting dict."""
+        ctx = {"handler": handler, "sql_count": 0, "sql_time": 0.0, "api_calls": 0}
+        self._handler.set(ctx)
+        return ctx
+
+    def snapshot(self):
+        total = {"counters": defaultdict(float), "histograms": {}}
+        with self._registry_lock:
+            shards = [shard for _, shard in self._shards]
+            self._merge(total, self._retired)
+        for shard in shards:
+            self._merge(total, shard)
+        return total
+
+    def render(self):
+        """Prometheus text exposition format."""
+        def fmt(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            if not pairs:
+                return ""
+            return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+        total = self.snapshot()
+        lines = []
+        typed = set()
+        for (name, labels), value in sorted(total["counters"].items()):
+            if name not in typed:
+                lines.append(f"# TYPE {name} counter")
+                typed.add(name)
+            lines.append(f"{name}{fmt(labels)} {value:g}")
+        for (name, labels), hist in sorted(total["histograms"].items()):
+            if name not in typed:
+                lines.append(f"# TYPE {name} histogram")
+                typed.add(name)
+            cumulative = 0
+            for bound, count in zip(HISTOGRAM_BUCKETS, hist):
+                cumulative += count
+                lines.append(f"{name}_bucket{fmt(labels, [('le', bound)])} {cumulative}")
+            cumulative += hist[len(HISTOGRAM_BUCKETS)]
+            lines.append(f"{name}_bucket{fmt(labels, [('le', '+Inf')])} {cumulative}")
+            lines.append(f"{name}_sum{fmt(labels)} {hist[-1]:.6f}")
+            lines.append(f"{name}_count{fmt(labels)} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+class InstrumentedCursor(sqlite3.Cursor):
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        except sqlite3.Error:
+            metrics.inc("bot_sql_errors_total", (("handler", metrics.context()["handler"]),))
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            record_sql(elapsed)
+            query_log.record(self.connection, sql, parameters, elapsed)
+
+    def executemany(self, sql, seq_of_parameters):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            elapsed = time.perf_counter() - started
+            record_sql(elapsed)
+            query_log.record(self.connection, sql, None, elapsed)
+
+def record_sql(elapsed):
+    ctx = metrics.context()
+    ctx["sql_count"] += 1
+    ctx["sql_time"] += elapsed
+    metrics.observe("bot_sql_duration_seconds", (("handler", ctx["handler"]),), elapsed)
+
+def record_query(sql, parameters, elapsed):
+    """Statement hook for storage backends without an instrumented cursor (PostgreSQL)."""
+    record_sql(elapsed)
+    query_log.record(None, sql, parameters, elapsed)
+
+_make_request = apihelper._make_request
+
+def instrumented_make_request(token, method_name, *args, **kwargs):
+    labels = (("method", method_name),)
+    metrics.context()["api_calls"] += 1
+    started = time.perf_counter()
+    try:
+        return _make_request(token, method_name, *args, **kwargs)
+    except Exception:
+        metrics.inc("bot_telegram_api_errors_total", labels)
+        raise
+    finally:
+        metrics.observe("bot_telegram_api_duration_seconds", labels, time.perf_counter() - started)
+
+apihelper._make_request = instrumented_make_request
+
+# Set by the long poller around each update so it learns whether its handler failed
+handler_failures = contextvars.ContextVar("handler_failures", default=None)
+
+def instrument_handler(func):
+    name = func.__name__
+
+    async def wrapper(*args, **kwargs):
+        ctx = metrics.enter(name)
+        labels = (("handler", name),)
+        started = time.perf_counter()
+        user = getattr(args[0], "from_user", None) if args else None
+        try:
+            result = await func(*args, **kwargs)
+            log.event("handler", name, user_id=user and user.id, latency_ms=round((time.perf_counter() - started) * 1000, 2),
+                      outcome="ok", sql=ctx["sql_count"], api=ctx["api_calls"])
+            return result
+        except Exception as e:
+            metrics.inc("bot_handler_errors_total", labels)
+            log.error("handler", name, e, user_id=user and user.id,
+                      latency_ms=round((time.perf_counter() - started) * 1000, 2), outcome="error")
+            failures = handler_failures.get()
+            if failures is not None:
+                failures.append(e)
+            raise
+        finally:
+            metrics.observe("bot_handler_duration_seconds", labels, time.perf_counter() - started)
+            metrics.inc("bot_handler_sql_statements_total", labels, ctx["sql_count"])
+            metrics.inc("bot_handler_sql_seconds_total", labels, ctx["sql_time"])
+            metrics.inc("bot_handler_api_calls_total", labels, ctx["api_calls"])
+            ctx["handler"] = "background"
+
+    wrapper.__name__ = name
+    wrapper.__wrapped__ = func
+    return wrapper
+
+# ================= LOGGING =================
+LOG_QUEUE_SIZE = 10000     # records waiting for the writer; beyond this new records are dropped and counted
+LOG_BATCH = 500            # records written per stdout flush
+LOG_ERROR_BURST = 5        # errors logged per (category, event) per window; the rest are counted
+LOG_ERROR_WINDOW = 60
+
+def parse_sample_rates(spec):
+    """"handler=0.01,message=0.1" -> {"handler": 0.01, "message": 0.1}"""
+    rates = {}
+    for part in filter(None, (p.strip() for p in spec.split(","))):
+        category, _, rate = part.partition("=")
+        rates[category.strip()] = float(rate)
+    return rates
+
+# Fraction of records kept per category; categories not listed are always logged. Errors are never sampled.
+LOG_SAMPLE_RATES = parse_sample_rates(os.getenv("LOG_SAMPLE", "handler=0.01,message=0.01"))
+
+class LogPipeline:
+    """Structured JSON logging where the caller only enqueues; one writer thread formats and writes.
+
+    Each record is a JSON line with ts, level, category, event and the caller's fields."""
+
+    def __init__(self, stream=None, queue_size=LOG_QUEUE_SIZE, sample_rates=None):
+        self.stream = stream
+        self.queue = queue.Queue(queue_size)
+        self.sample_rates = sample_rates or {}
+        self.error_windows = {}  # (category, event) -> [window start, logged, suppressed]
+        self.error_lock = threading.Lock()
+        self.writer = None
+
+    def start(self):
+        if self.writer is None:
+            self.writer = threading.Thread(target=self._write_loop, daemon=True)
+            self.writer.start()
+
+    def event(self, category, event, **fields):
+        """Log an info record, subject to the category's sample rate."""
+        rate = self.sample_rates.get(category)
+        if rate is not None:
+            if random.random() >= rate:
+                return
+            fields["sample_rate"] = rate
+        self._put((time.time(), "info", category, event, fields, None))
+
+    def error(self, category, event, exc=None, **fields):
+        """Log an error with its traceback; at most LOG_ERROR_BURST per event and window, then a count of the rest."""
+        now = time.monotonic()
+        with self.error_lock:
+            window = self.error_windows.get((category, event))
+            if window is None or now - window[0] >= LOG_ERROR_WINDOW:
+                suppressed = window[2] if window else 0
+                window = self.error_windows[(category, event)] = [now, 0, 0]
+            else:
+                suppressed = 0
+            if window[1] >= LOG_ERROR_BURST:
+                window[2] += 1
+                metrics.inc("bot_log_suppressed_total", (("category", category),))
+                return
+            window[1] += 1
+        if suppressed:
+            fields["suppressed"] = suppressed
+        if exc is None:
+            exc = sys.exc_info()[1]
+        self._put((time.time(), "error", category, event, fields, exc))
+
+    def _put(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            metrics.inc("bot_log_dropped_total", (("category", record[2]),))
+
+    def format(self, record):
+        ts, level, category, event, fields, exc = record
+        entry = {"ts": round(ts, 3), "level": level, "category": category, "event": event}
+        entry.update(fields)
+        if exc is not None:
+            entry["error"] = f"{type(exc).__name__}: {exc}"
+            entry["traceback"] = "".join(traceback.format_exception(type(exc), exc, exc.__traceback__))
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+    def _write_loop(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < LOG_BATCH:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                stream = self.stream or sys.stdout
+                stream.write("".join(self.format(record) + "\n" for record in batch))
+                stream.flush()
+            except Exception:
+                metrics.inc("bot_log_dropped_total", (("category", "writer"),), len(batch))
+
+class PipelineLogHandler(logging.Handler):
+    """Routes a stdlib logger (pyTelegramBotAPI's) into the pipeline instead of blocking on stderr."""
+
+    def __init__(self, pipeline, category):
+        super().__init__()
+        self.pipeline = pipeline
+        self.category = category
+
+    def emit(self, record):
+        exc = record.exc_info[1] if record.exc_info else None
+        level = "error" if record.levelno >= logging.ERROR else "info"
+        self.pipeline._put((record.created, level, self.category, record.getMessage(), {}, exc))
+
+log = LogPipeline(sample_rates=LOG_SAMPLE_RATES)
+log.start()
+telebot.logger.handlers[:] = [PipelineLogHandler(log, "telebot")]
+telebot.logger.propagate = False
+
+# ================= SAMPLING PROFILER =================
+class SamplingProfiler:
+    """Wall-clock stack sampler producing folded stacks for flamegraph.pl / speedscope."""
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.stacks = defaultdict(int)
+        self.samples = 0
+        self.is_running = False
+        self.thread = None
+
+    def start(self):
+        if self.is_running:
+            return
+        self.stop()
+        self.stacks = defaultdict(int)
+        self.samples = 0
+        self.is_running = True
+        self.thread = threading.Thread(target=self._sample_loop, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Stop sampling and wait for the sampler thread, so no stack is added after this returns."""
+        self.is_running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def _sample_loop(self):
+        own_id = threading.get_ident()
+        while self.is_running:
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+            time.sleep(self.interval)
+
+    def dump(self):
+        stacks = dict(self.stacks)
+        return "\n".join(f"{stack} {count}" for stack, count in sorted(stacks.items())) + "\n"
+
+profiler = SamplingProfiler()
+
+# ================= QUERY LOG =================
+SLOW_QUERY_SECONDS = float(os.getenv("SLOW_QUERY_MS", "100")) / 1000
+
+def normalize_sql(sql):
+    sql = re.sub(r"'(?:[^']|'')*'", "?", sql)
+    sql = re.sub(r"\b\d+(?:\.\d+)?\b", "?", sql)
+    sql = re.sub(r"IN\s*\(\s*\?(?:\s*,\s*\?)*\s*\)", "IN (...)", sql, flags=re.IGNORECASE)
+    return re.sub(r"\s+", " ", sql).strip()
+
+def explain_query_plan(connection, sql, parameters=()):
+    rows = connection.execute("EXPLAIN QUERY PLAN " + sql, parameters or ()).fetchall()
+    return [row[3] for row in rows]
+
+def table_scans(plan):
+    return [detail for detail in plan if detail.startswith("SCAN ") and "USING" not in detail
+            and detail != "SCAN CONSTANT ROW"]
+
+class QueryLog:
+    """Fingerprints statements, keeps per-fingerprint stats and logs slow ones with their plan."""
+
+    def __init__(self, threshold):
+        self.threshold = threshold
+        self.fingerprints = {}
+        self.statements = {}
+
+    def fingerprint(self, sql):
+        fp_id = self.fingerprints.get(sql)
+        if fp_id is None:
+            normalized = normalize_sql(sql)
+            fp_id = format(zlib.crc32(normalized.encode()), "08x")
+            self.statements[fp_id] = normalized
+            if len(self.fingerprints) < 5000:
+                self.fingerprints[sql] = fp_id
+        return fp_id
+
+    def record(self, connection, sql, parameters, elapsed):
+        fp_id = self.fingerprint(sql)
+        labels = (("query", fp_id),)
+        metrics.inc("bot_sql_query_calls_total", labels)
+        metrics.inc("bot_sql_query_seconds_total", labels, elapsed)
+        if elapsed >= self.threshold:
+            metrics.inc("bot_sql_slow_queries_total", labels)
+            self.log_slow(connection, sql, parameters, elapsed, fp_id)
+
+    def log_slow(self, connection, sql, parameters, elapsed, fp_id):
+        try:
+            if parameters is None:
+                plan = ["(executemany)"]
+            elif connection is None:
+                plan = []
+            elif sql.lstrip()[:6].upper() in ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH"):
+                plan = explain_query_plan(connection, sql, parameters)
+            else:
+                plan = []
+        except sqlite3.Error as e:
+            plan = [f"(no plan: {e})"]
+        log.event("sql", "slow_query", query=fp_id, ms=round(elapsed * 1000, 1), sql=self.statements[fp_id],
+                  params=repr(parameters), plan=plan)
+
+    def stats(self):
+        counters = metrics.snapshot()["counters"]
+        rows = []
+        for fp_id, sql in list(self.statements.items()):
+            labels = (("query", fp_id),)
+            calls = counters.get(("bot_sql_query_calls_total", labels), 0)
+            seconds = counters.get(("bot_sql_query_seconds_total", labels), 0.0)
+            rows.append({
+                "fingerprint": fp_id,
+                "sql": sql,
+                "calls": int(calls),
+                "total_ms": round(seconds * 1000, 3),
+                "avg_ms": round(seconds * 1000 / calls, 3) if calls else 0.0,
+                "slow": int(counters.get(("bot_sql_slow_queries_total", labels), 0)),
+            })
+        return sorted(rows, key=lambda r: r["total_ms"], reverse=True)
+
+query_log = QueryLog(SLOW_QUERY_SECONDS)
+
+# Hot lookups that must stay index-backed; check_query_plans() fails if any turns into a table scan
+HOT_QUERIES = {
+    "cooldown": ("SELECT action_time FROM user_actions WHERE user_id=? AND action_type=? ORDER BY action_time DESC LIMIT 1", (1, "earn")),
+    "pending_action": (f"""SELECT a.action_type, s.session_data, a.action_time FROM user_actions a
+        LEFT JOIN admin_sessions s ON s.admin_id = a.user_id
+        WHERE a.user_id=? AND {STATE_FILTER} ORDER BY a.action_time DESC LIMIT 1""", (1,)),
+    "wallet": ("SELECT user_id, stars, total_earned, referrals, premium, tasks_done, daily_withdrawn, role FROM users_wallet WHERE user_id=?", (1,)),
+    "joined_channel": ("SELECT joined_channel FROM users WHERE user_id=?", (1,)),
+    "referral_exists": ("SELECT referrer_id FROM referrals WHERE referred_id=?", (1,)),
+    "task_done": ("SELECT id FROM user_tasks WHERE user_id=? AND task_id=?", (1, 1)),
+    "code_lookup": ("SELECT id, amount, max_uses, used_count, expires_at, active FROM redeem_codes WHERE code=?", ("X",)),
+    "code_redeemed": ("SELECT id FROM redeemed_codes WHERE code_id=? AND user_id=?", (1, 1)),
+    "premium_pending": ("SELECT id FROM premium_requests WHERE user_id=? AND status='pending'", (1,)),
+    "claim_withdrawals": ("""SELECT id FROM withdraw_requests
+        WHERE status IN ('pending', 'processing') AND withdrawal_type='stars' AND (status='pending' OR claimed_at < ?)
+        ORDER BY id LIMIT ?""",
+        (0, 50)),
+    "leaderboard": ("SELECT user_id, stars FROM users_wallet WHERE role='user' ORDER BY stars DESC LIMIT ?", (10,)),
+    "user_totals": ("SELECT COUNT(*), SUM(stars), AVG(stars) FROM users_wallet WHERE role='user'", ()),
+    "verify_task": ("""SELECT ut.id, t.reward FROM user_tasks ut JOIN tasks t ON ut.task_id = t.id
+        WHERE ut.user_id=? AND t.task_name LIKE ? AND ut.verified=0 ORDER BY ut.completed_at DESC LIMIT 1""", (1, "%x%")),
+    "admins": ("SELECT user_id FROM users_wallet WHERE role='admin'", ()),
+    "payments_window": ("SELECT charge_id FROM payments WHERE created_at >= ? AND created_at < ?", (0, 1)),
+}
+
+def check_query_plans(connection):
+    """Return {query_name: [scan details]} for hot queries whose plan contains a full table scan."""
+    regressions = {}
+    for name, (sql, params) in HOT_QUERIES.items():
+        scans = table_scans(explain_query_plan(connection, sql, params))
+        if scans:
+            regressions[name] = scans
+    return regressions
+
 # ================= DATABASE =================
-conn = sqlite3.connect("pulse_profit.db", check_same_thread=False)
-cursor = conn.cursor()
-
-# Create all tables
-cursor.execute("""
-CREATE TABLE IF NOT EXISTS users (
-    user_id INTEGER PRIMARY KEY,
-    username TEXT,
-    first_name TEXT,
-    joined_channel INTEGER DEFAULT 0
-)
-""")
-
-cursor.execute("""
-CREATE TABLE IF NOT EXISTS users_wallet (
-    user_id INTEGER PRIMARY KEY,
-    stars INTEGER DEFAULT 0,
-    total_earned INTEGER DEFAULT 0,
-    referrals INTEGER DEFAULT 0,
-    premium INTEGER DEFAULT 0,
-    tasks_done INTEGER DEFAULT 0,
-    daily_withdrawn INTEGER DEFAULT 0
-)
-""")
-
-cursor.execute("""
-CREATE TABLE IF NOT EXISTS referrals (
-    referrer_id INTEGER,
-    referred_id INTEGER UNIQUE
-)
-""")
-
-cursor.execute("""
-CREATE TABLE IF NOT EXISTS withdraw_requests (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    user_id INTEGER,
-    amount INTEGER,
-    withdrawal_type TEXT DEFAULT 'admin',
-    status TEXT DEFAULT 'pending',
-    request_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-)
-""")
-
-cursor.execute("""
-CREATE TABLE IF NOT EXISTS premium_requests (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    user_id INTEGER,
-    status TEXT DEFAULT 'pending',
-    request_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-)
-""")
-
-cursor.execute("""
-CREATE TABLE IF NOT EXISTS user_actions (
-    user_id INTEGER,
-    action_type TEXT,
-    action_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-)
-""")
-
-cursor.execute("""
-CREATE TABLE IF NOT EXISTS tasks (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    task_name TEXT,
-    task_type TEXT,
-    task_data TEXT,
-    reward INTEGER,
-    active INTEGER DEFAULT 1,
-    created_by INTEGER,
-    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-)
-""")
-
-cursor.execute("""
-CREATE TABLE IF NOT EXISTS user_tasks (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    user_id INTEGER,
-    task_id INTEGER,
-    completed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-    verified INTEGER DEFAULT 0
-)
-""")
-
-cursor.execute("""
-CREATE TABLE IF NOT EXISTS redeem_codes (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    code TEXT UNIQUE,
-    amount INTEGER,
-    max_uses INTEGER DEFAULT 1,
-    used_count INTEGER DEFAULT 0,
-    expires_at TIMESTAMP,
-    created_by INTEGER,
-    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-    active INTEGER DEFAULT 1
-)
-""")
-
-cursor.execute("""
-CREATE TABLE IF NOT EXISTS redeemed_codes (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    code_id INTEGER,
-    user_id INTEGER,
-    redeemed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-)
-""")
-
-cursor.execute("""
-CREATE TABLE IF NOT EXISTS admin_sessions (
-    admin_id INTEGER PRIMARY KEY,
-    session_data TEXT,
-    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-)
-""")
-
-cursor.execute("""
-CREATE TABLE IF NOT EXISTS backup_log (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    backup_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-    backup_type TEXT,
-    status TEXT,
-    details TEXT
-)
-""")
-
-conn.commit()
+store = open_storage(DATABASE_URL, DB_PATH, cursor_factory=InstrumentedCursor, on_query=record_query)
+store.create_schema()
+
+# Replica, rollups, retention, exports and GitHub backups work on the SQLite file itself
+SQLITE = store.kind == "sqlite"
+conn = store.conn if SQLITE else None
+
+# ================= UPDATE LANES =================
+# Telegram cancels a checkout whose pre_checkout_query is not answered within 10 seconds, so checkouts
+# and payments get workers of their own that dashboard renders and other slow handlers cannot occupy.
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", "2"))  # default lane under the sync runtime
+PAYMENT_WORKERS = 2         # reserved for payment updates; nothing else ever runs on them
+PAYMENT_SLO_SECONDS = 2.0   # receipt to handled; well inside Telegram's 10 s checkout limit
+
+current_lane = contextvars.ContextVar("current_lane", default="default")
+
+def update_lane(update):
+    """'payment' for pre-checkout queries and successful payments, 'default' for everything else."""
+    if update.pre_checkout_query or (update.message and update.message.successful_payment):
+        return "payment"
+    return "default"
+
+def observe_lane(lane, received):
+    """Record one update's time from receipt to handled, and whether a payment met its SLO."""
+    elapsed = time.perf_counter() - received
+    metrics.observe("bot_update_lane_seconds", (("lane", lane),), elapsed)
+    if lane == "payment":
+        metrics.inc("bot_payment_slo_total", (("outcome", "met" if elapsed <= PAYMENT_SLO_SECONDS else "missed"),))
+
+class UpdateLanes:
+    """Strict-priority dispatch for the sync runtime: one executor per lane.
+
+    Default updates queue on UPDATE_WORKERS threads; payment updates only ever queue behind other
+    payments, so however slow the default lane gets a checkout waits for at most PAYMENT_WORKERS peers."""
+
+    def __init__(self, workers=UPDATE_WORKERS, payment_workers=PAYMENT_WORKERS):
+        self.executors = {
+            "default": ThreadPoolExecutor(workers, thread_name_prefix="lane-default"),
+            "payment": ThreadPoolExecutor(payment_workers, thread_name_prefix="lane-payment"),
+        }
+
+    def submit(self, update, received, handle=None):
+        """Queue an update on its lane. Returns the future of handle(update), by default process_new_updates."""
+        lane = update_lane(update)
+        return self.executors[lane].submit(self.run, lane, update, received, handle or self.process)
+
+    def process(self, update):
+        try:
+            bot.process_new_updates([update])
+        except Exception as e:
+            log.error("webhook", "update_failed", e, update_id=update.update_id)
+
+    def run(self, lane, update, received, handle):
+        token = current_lane.set(lane)
+        try:
+            return handle(update)
+        finally:
+            current_lane.reset(token)
+            observe_lane(lane, received)
+
+lanes = UpdateLanes()
+
+# ================= RUNTIME =================
+# Handlers are coroutines written once for both runtimes. Under "sync" TeleBot's worker threads drive
+# them inline and every await completes immediately; under "async" they run on AsyncTeleBot's event
+# loop, Bot API calls go through aiohttp and blocking database work runs on db_executor.
+DB_WORKERS = int(os.getenv("DB_WORKERS", "8"))
+API_CONNECTIONS = 200  # concurrent aiohttp connections to the Bot API (library default is 50)
+
+db_executor = ThreadPoolExecutor(DB_WORKERS, thread_name_prefix="db") if RUNTIME == "async" else None
+# Database work of payment updates never queues behind the default lane's queries
+payment_db_executor = ThreadPoolExecutor(PAYMENT_WORKERS, thread_name_prefix="db-payment") if RUNTIME == "async" else None
+
+async def offload(func, *args, **kwargs):
+    """Run a blocking call off the event loop; inline under the sync runtime."""
+    if db_executor is None:
+        return func(*args, **kwargs)
+    executor = payment_db_executor if current_lane.get() == "payment" else db_executor
+    # The copied context carries the handler's metrics accounting into the worker thread
+    call = functools.partial(contextvars.copy_context().run, func, *args, **kwargs)
+    return await asyncio.get_running_loop().run_in_executor(executor, call)
+
+class AsyncStore:
+    """Awaitable view of `store` for handlers."""
+
+    def __getattr__(self, name):
+        method = getattr(store, name)
+
+        async def call(*args, **kwargs):
+            return await offload(method, *args, **kwargs)
+        return call
+
+class InlineApi:
+    """Awaitable view of the sync TeleBot, so handlers await Bot API calls the same way under both runtimes."""
+
+    def __init__(self, bot):
+        self.bot = bot
+
+    def __getattr__(self, name):
+        method = getattr(self.bot, name)
+
+        async def call(*args, **kwargs):
+            return method(*args, **kwargs)
+        return call
+
+def run_inline(coro):
+    """Drive a handler coroutine to completion on the calling thread (sync runtime)."""
+    try:
+        coro.send(None)
+    except StopIteration as done:
+        return done.value
+    coro.close()
+    raise RuntimeError("handler awaited real I/O under the sync runtime")
+
+def inline_handler(func):
+    def wrapper(*args, **kwargs):
+        return run_inline(func(*args, **kwargs))
+
+    wrapper.__name__ = func.__name__
+    wrapper.__wrapped__ = func
+    return wrapper
+
+astore = AsyncStore()
+
+if RUNTIME == "async":
+    from telebot.async_telebot import AsyncTeleBot
+    from telebot import asyncio_helper
+
+    asyncio_helper.REQUEST_LIMIT = API_CONNECTIONS
+    _process_request = asyncio_helper._process_request
+
+    async def instrumented_process_request(token, method_name, *args, **kwargs):
+        labels = (("method", method_name),)
+        metrics.context()["api_calls"] += 1
+        started = time.perf_counter()
+        try:
+            return await _process_request(token, method_name, *args, **kwargs)
+        except Exception:
+            metrics.inc("bot_telegram_api_errors_total", labels)
+            raise
+        finally:
+            metrics.observe("bot_telegram_api_duration_seconds", labels, time.perf_counter() - started)
+
+    asyncio_helper._process_request = instrumented_process_request
+    api = AsyncTeleBot(TOKEN)
+else:
+    api = InlineApi(bot)
+
+# ================= USER LOCKS =================
+USER_LOCK_STRIPES = 256
+USER_LOCK_TTL = 30        # seconds before a lock row left behind by a crashed process can be taken over
+USER_LOCK_POLL = 0.02     # seconds between attempts on a lock row held elsewhere
+# "shared" also holds a lock row in the database, for several processes or instances on one database
+USER_LOCKS = os.getenv("USER_LOCKS", "shared" if DATABASE_URL else "process")
+
+class StripedLock:
+    """Per-key mutual exclusion over a fixed pool of lock stripes.
+
+    `async with user_locks(user_id):` serializes one user's read-check-write sequences while users on other
+    stripes proceed in parallel. Stripes are thread locks under the sync runtime (handlers run on worker
+    threads) and asyncio locks under the asyncio runtime, so waiting never blocks the event loop. With
+    shared=True the holder also takes the key's row in user_locks, which extends the exclusion to other
+    processes; the local stripe is taken first so only one waiter per process polls the database.
+    """
+
+    def __init__(self, name, stripes=USER_LOCK_STRIPES, shared=False):
+        self.labels = (("lock", name),)
+        self.shared = shared
+        lock_type = asyncio.Lock if RUNTIME == "async" else threading.Lock
+        self.stripes = [lock_type() for _ in range(stripes)]
+
+    @contextlib.asynccontextmanager
+    async def __call__(self, key):
+        lock = self.stripes[hash(key) % len(self.stripes)]
+        started = time.perf_counter()
+        contended = lock.locked()
+        if RUNTIME == "async":
+            await lock.acquire()
+        else:
+            lock.acquire()
+        try:
+            owner = await self._acquire_shared(key) if self.shared else None
+            acquired = time.perf_counter()
+            metrics.inc("bot_lock_acquired_total", self.labels)
+            if contended:
+                metrics.inc("bot_lock_contended_total", self.labels)
+            metrics.observe("bot_lock_wait_seconds", self.labels, acquired - started)
+            try:
+                yield
+            finally:
+                if owner:
+                    await astore.unlock_user(key, owner)
+                metrics.observe("bot_lock_held_seconds", self.labels, time.perf_counter() - acquired)
+        finally:
+            lock.release()
+
+    async def _acquire_shared(self, key):
+        owner = f"{os.getpid()}:{os.urandom(6).hex()}"
+        while not await astore.lock_user(key, owner, USER_LOCK_TTL):
+            metrics.inc("bot_lock_shared_retries_total", self.labels)
+            if RUNTIME == "async":
+                await asyncio.sleep(USER_LOCK_POLL)
+            else:
+                time.sleep(USER_LOCK_POLL)
+        return owner
+
+user_locks = StripedLock("user", shared=USER_LOCKS == "shared")
+
+def serialized_per_user(func):
+    """Run a handler under its user's lock, so one user's concurrent updates never interleave."""
+    @functools.wraps(func)
+    async def wrapper(update, *args, **kwargs):
+        async with user_locks(update.from_user.id):
+            return await func(update, *args, **kwargs)
+    return wrapper
+
+# ================= ADMIN ROLES =================
+ADMIN_REFRESH = 15  # seconds before a role change made on another instance applies here
+
+def load_admins():
+    replace_admins(store.sync_admins(ADMIN_IDS))
+
+def replace_admins(loaded):
+    # Drop revoked ids, then add new ones, so a current admin is never missing in between
+    loaded = set(loaded) | set(ADMIN_IDS)
+    admins.intersection_update(loaded)
+    admins.update(loaded)
+
+def admin_refresh_loop():
+    """Pick up /add_admin and /remove_admin run on other instances sharing the database."""
+    while True:
+        time.sleep(ADMIN_REFRESH)
+        try:
+            replace_admins(store.admin_ids())
+        except Exception as e:
+            log.error("admins", "refresh_failed", e)
+
+async def set_role(user_id, role):
+    await astore.set_role(user_id, role)
+    if role == 'admin':
+        admins.add(user_id)
+    else:
+        admins.discard(user_id)
+
+load_admins()
+threading.Thread(target=admin_refresh_loop, daemon=True).start()
 
 # ================= KEEP-ALIVE SERVICE =================
 class KeepAliveService:
@@ -188,16 +811,56 @@ class KeepAliveService:
                     self.ping_count += 1
                     if self.health_url:
                         requests.get(self.health_url, timeout=15)
-                        print(f"✅ Keep-alive ping #{self.ping_count}")
+                        log.event("keepalive", "ping", count=self.ping_count)
                     time.sleep(240)
-                except:
+                except Exception as e:
+                    log.error("keepalive", "ping_failed", e)
                     time.sleep(60)
         thread = threading.Thread(target=ping_loop, daemon=True)
         thread.start()
-        print("🔄 Keep-alive service started")
+        log.event("keepalive", "started")
 
 keep_alive = KeepAliveService()
 
+# ================= WEBHOOK TRIAGE =================
+json_loads = orjson.loads if orjson else json.loads
+known_commands = set()  # filled from the registered command handlers at startup
+
+def webhook_authorized(secret):
+    # A derived secret is only known to Telegram once this process registered it; before that (a webhook
+    # set by an older deployment) updates arrive without the header and must still get through
+    if not WEBHOOK_SECRET_SET and not webhook_registered:
+        return True
+    return hmac.compare_digest(secret.encode() if isinstance(secret, str) else secret, WEBHOOK_SECRET.encode())
+
+def peek_update(body):
+    """Decide from the raw JSON whether any handler would take an update, before building telebot objects.
+
+    Returns (data, None) to handle it, (data, user_id) for plain text that only matters while that user
+    has a pending state, or (None, reason) to drop it.
+    """
+    data = json_loads(body)
+    message = data.get("message")
+    if message is not None:
+        if "successful_payment" in message:
+            return data, None
+        text = message.get("text")
+        if text is None:
+            return None, "content_type"
+        if text.startswith("/") and text.split(maxsplit=1)[0][1:].split("@")[0] in known_commands:
+            return data, None
+        return data, message["from"]["id"]
+    query = data.get("callback_query")
+    if query is not None:
+        handler, _ = callback_router.resolve(query.get("data") or "")
+        return (data, None) if handler else (None, "unrouted")
+    if "pre_checkout_query" in data:
+        return data, None
+    return None, "update_type"
+
+def webhook_outcome(outcome):
+    metrics.inc("bot_webhook_updates_total", (("outcome", outcome),))
+
 # ================= FLASK ENDPOINTS =================
 @app.route('/')
 def home():
@@ -207,21 +870,178 @@ def home():
 def health():
     return jsonify({'status': 'healthy', 'pings': keep_alive.ping_count}), 200
 
+@app.route('/metrics')
+def metrics_endpoint():
+    return metrics.render(), 200, {'Content-Type': 'text/plain; version=0.0.4'}
+
+@app.route('/metrics/queries')
+def query_stats_endpoint():
+    return jsonify(query_log.stats())
+
+def export_request_error(table, fmt, auth):
+    """(status, error) if an export request must be refused, else None."""
+    if not EXPORT_TOKEN or not hmac.compare_digest(auth, f"Bearer {EXPORT_TOKEN}"):
+        return 401, 'unauthorized'
+    if table not in EXPORTS or fmt not in EXPORT_FORMATS:
+        return 404, 'unknown export'
+    return None
+
+def gzip_export(table, fmt, path):
+    compressor = zlib.compressobj(wbits=31)  # gzip container
+    for chunk in export_chunks(table, fmt, path=path):
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+def export_filename(table, fmt, snapshot):
+    """Named after the data's snapshot time, which trails the request by up to REPLICA_INTERVAL."""
+    return f"{table}_{snapshot.strftime('%Y%m%d_%H%M%S')}.{fmt}.gz"
+
+def export_headers(table, fmt, snapshot):
+    return {'Content-Disposition': f'attachment; filename="{export_filename(table, fmt, snapshot)}"',
+            'X-Export-Snapshot': snapshot.isoformat(timespec='seconds')}
+
+@app.route('/export/<table>.<fmt>')
+def export_endpoint(table, fmt):
+    error = export_request_error(table, fmt, request.headers.get('Authorization', ''))
+    if error:
+        return jsonify({'error': error[1]}), error[0]
+    
+    path, snapshot = export_source()
+    return Response(gzip_export(table, fmt, path), mimetype='application/gzip', headers=export_headers(table, fmt, snapshot))
+
 @app.route(f'/{TOKEN}', methods=['POST'])
 def webhook():
+    if not webhook_authorized(request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')):
+        webhook_outcome("rejected")
+        return 'FORBIDDEN', 403
+    poller.last_webhook = time.time()
+    received = time.perf_counter()
     try:
-        update = telebot.types.Update.de_json(request.stream.read().decode('utf-8'))
-        bot.process_new_updates([update])
+        data, detail = peek_update(request.get_data())
+    except (ValueError, AttributeError, KeyError):
+        webhook_outcome("malformed")
+        return 'BAD REQUEST', 400
+    if data is None:
+        webhook_outcome(detail)
         return 'OK', 200
-    except:
+    if detail and not flows.peek(detail):
+        webhook_outcome("no_state")
+        return 'OK', 200
+    try:
+        webhook_outcome("handled")
+        lanes.submit(telebot.types.Update.de_json(data), received)
+        return 'OK', 200
+    except Exception as e:
+        log.error("webhook", "update_failed", e, update_id=data.get("update_id"))
         return 'ERROR', 500
 
+# ================= ASGI SERVER =================
+# The asyncio runtime serves the same endpoints without Flask: uvicorn bot:asgi_app (with RUNTIME=async)
+async def read_body(receive):
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            return body
+
+async def respond(send, status, body, content_type=b"application/json", headers=()):
+    await send({"type": "http.response.start", "status": status,
+                "headers": [(b"content-type", content_type), *headers]})
+    await send({"type": "http.response.body", "body": body})
+
+async def respond_json(send, status, payload):
+    await respond(send, status, json.dumps(payload).encode())
+
+async def asgi_export(scope, send, table, fmt):
+    headers = dict(scope["headers"])
+    error = export_request_error(table, fmt, headers.get(b"authorization", b"").decode())
+    if error:
+        return await respond_json(send, error[0], {'error': error[1]})
+    
+    path, snapshot = export_source()
+    await send({"type": "http.response.start", "status": 200,
+                "headers": [(b"content-type", b"application/gzip")]
+                           + [(name.lower().encode(), value.encode()) for name, value in export_headers(table, fmt, snapshot).items()]})
+    chunks = gzip_export(table, fmt, path)
+    while True:
+        # Each batch is read on the executor so the export never blocks the event loop
+        chunk = await offload(next, chunks, None)
+        if chunk is None:
+            break
+        await send({"type": "http.response.body", "body": chunk, "more_body": True})
+    await send({"type": "http.response.body", "body": b""})
+
+async def asgi_app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                poller.loop = asyncio.get_running_loop()
+                if poller.enabled:
+                    poller.loop.create_task(poller.run_async())
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await api.close_session()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+    if scope["type"] != "http":
+        return
+    
+    path = scope["path"]
+    if path == f"/{TOKEN}" and scope["method"] == "POST":
+        secret = dict(scope["headers"]).get(b"x-telegram-bot-api-secret-token", b"")
+        if not webhook_authorized(secret):
+            webhook_outcome("rejected")
+            return await respond(send, 403, b"FORBIDDEN", b"text/plain")
+        poller.last_webhook = time.time()
+        received = time.perf_counter()
+        try:
+            data, detail = peek_update(await read_body(receive))
+        except (ValueError, AttributeError, KeyError):
+            webhook_outcome("malformed")
+            return await respond(send, 400, b"BAD REQUEST", b"text/plain")
+        if data is None:
+            webhook_outcome(detail)
+            return await respond(send, 200, b"OK", b"text/plain")
+        if detail and not await flows.get(detail):
+            webhook_outcome("no_state")
+            return await respond(send, 200, b"OK", b"text/plain")
+        update = telebot.types.Update.de_json(data)
+        lane = update_lane(update)
+        token = current_lane.set(lane)
+        try:
+            webhook_outcome("handled")
+            await api.process_new_updates([update])
+            await respond(send, 200, b"OK", b"text/plain")
+        except Exception as e:
+            log.error("webhook", "update_failed", e, update_id=data.get("update_id"))
+            await respond(send, 500, b"ERROR", b"text/plain")
+        finally:
+            current_lane.reset(token)
+            observe_lane(lane, received)
+    elif path == "/":
+        await respond_json(send, 200, {'status': 'running', 'service': 'Pulse Profit Bot'})
+    elif path == "/health":
+        await respond_json(send, 200, {'status': 'healthy', 'pings': keep_alive.ping_count})
+    elif path == "/metrics":
+        await respond(send, 200, metrics.render().encode(), b"text/plain; version=0.0.4")
+    elif path == "/metrics/queries":
+        await respond_json(send, 200, query_log.stats())
+    elif path.startswith("/export/") and path.count(".") == 1:
+        table, fmt = path[len("/export/"):].split(".")
+        await asgi_export(scope, send, table, fmt)
+    else:
+        await respond_json(send, 404, {'error': 'not found'})
+
 # ================= GITHUB BACKUP SYSTEM =================
 def backup_to_github(backup_type="auto", details=""):
-    if not GITHUB_TOKEN or not GITHUB_REPO:
+    if not GITHUB_TOKEN or not GITHUB_REPO or not SQLITE:
         return False
     try:
-        with open("pulse_profit.db", "rb") as f:
+        with open(DB_PATH, "rb") as f:
             content = base64.b64encode(f.read()).decode()
         url = f"https://api.github.com/repos/{GITHUB_REPO}/contents/{GITHUB_FILE_PATH}"
         headers = {"Authorization": f"token {GITHUB_TOKEN}"}
@@ -237,12 +1057,11 @@ def backup_to_github(backup_type="auto", details=""):
             data["sha"] = sha
         response = requests.put(url, json=data, headers=headers)
         if response.status_code in [200, 201]:
-            cursor.execute("INSERT INTO backup_log (backup_type, status, details) VALUES (?,?,?)",
-                          (backup_type, "success", details))
-            conn.commit()
+            store.log_backup(backup_type, "success", details)
             return True
-    except:
-        pass
+        log.error("backup", "upload_rejected", status=response.status_code, backup_type=backup_type)
+    except Exception as e:
+        log.error("backup", "failed", e, backup_type=backup_type)
     return False
 
 def backup_loop():
@@ -250,31 +1069,62 @@ def backup_loop():
         time.sleep(3600)
         backup_to_github("hourly", "Automatic hourly backup")
 
-if GITHUB_TOKEN and GITHUB_REPO:
+if GITHUB_TOKEN and GITHUB_REPO and SQLITE:
     threading.Thread(target=backup_loop, daemon=True).start()
-    print("✅ GitHub backup system started")
+    log.event("backup", "started")
+
+# ================= WALLET ACCESS =================
+# Users whose wallet row is known to exist, so provisioning is skipped for them
+KNOWN_USERS_MAX = 200000
+known_users = set()
+
+def remember_user(user_id):
+    if len(known_users) >= KNOWN_USERS_MAX:
+        known_users.clear()
+    known_users.add(user_id)
+
+async def provision_wallet(user_id):
+    """Create the wallet if missing in one statement. Returns the new Wallet, or None if it already existed."""
+    created = await astore.create_wallet(user_id)
+    remember_user(user_id)
+    return created
+
+async def ensure_wallet(user_id):
+    if user_id not in known_users:
+        await provision_wallet(user_id)
+
+async def get_wallet(user_id):
+    wallet = await astore.get_wallet(user_id)
+    if wallet:
+        remember_user(user_id)
+        return wallet
+    # Another thread may have created it in between; fall back to reading that row
+    return await provision_wallet(user_id) or await get_wallet(user_id)
+
+async def provision_user(user_id, username=None, first_name=None):
+    """Mark a user as having joined the channel and make sure their wallet exists, in one commit."""
+    await astore.provision_user(user_id, username, first_name, with_wallet=user_id not in known_users)
+    remember_user(user_id)
+
+async def get_balance(user_id):
+    balance = await astore.get_balance(user_id)
+    return balance if balance is not None else (await get_wallet(user_id)).stars
+
+async def get_limits(user_id):
+    limits = await astore.get_limits(user_id)
+    if not limits:
+        wallet = await get_wallet(user_id)
+        return Limits(wallet.stars, wallet.premium, wallet.daily_withdrawn)
+    return limits
 
 # ================= HELPER FUNCTIONS =================
-def get_wallet(user_id):
-    cursor.execute("SELECT * FROM users_wallet WHERE user_id=?", (user_id,))
-    user = cursor.fetchone()
-    if not user:
-        cursor.execute("INSERT INTO users_wallet (user_id) VALUES (?)", (user_id,))
-        conn.commit()
-        return get_wallet(user_id)
-    return user
-
-def add_stars(user_id, amount):
-    cursor.execute("UPDATE users_wallet SET stars = stars + ?, total_earned = total_earned + ? WHERE user_id=?", 
-                  (amount, amount, user_id))
-    conn.commit()
 
 def is_admin(user_id):
-    return user_id in ADMIN_IDS
+    return user_id in admins
 
-def get_user_name(user_id):
+async def get_user_name(user_id):
     try:
-        user = bot.get_chat_member(user_id, user_id).user
+        user = (await api.get_chat_member(user_id, user_id)).user
         name = user.first_name
         if user.username:
             name += f" (@{user.username})"
@@ -282,33 +1132,32 @@ def get_user_name(user_id):
     except:
         return f"User {user_id}"
 
-def check_channel(user_id):
+def admin_event(user, details, commands):
+    """One HTML line describing a user's request, built from the update so no API call is needed."""
+    name = html.escape(user.first_name or f"User {user.id}")
+    if user.username:
+        name += f" (@{html.escape(user.username)})"
+    return (f"👤 {name} · <code>{user.id}</code> · {html.escape(details)}\n"
+            + " · ".join(f"<code>{html.escape(command)}</code>" for command in commands))
+
+async def check_channel(user_id):
     try:
-        member = bot.get_chat_member(REQUIRED_CHANNEL, user_id)
+        member = await api.get_chat_member(REQUIRED_CHANNEL, user_id)
         return member.status in ['member', 'administrator', 'creator']
     except:
         return False
 
-def check_cooldown(user_id, action, seconds):
-    cursor.execute("SELECT action_time FROM user_actions WHERE user_id=? AND action_type=? ORDER BY action_time DESC LIMIT 1", 
-                  (user_id, action))
-    last = cursor.fetchone()
-    if last:
-        last_time = datetime.strptime(last[0], '%Y-%m-%d %H:%M:%S')
-        diff = (datetime.now() - last_time).total_seconds()
+async def check_cooldown(user_id, action, seconds):
+    last = await astore.last_action_time(user_id, action)
+    if last is not None:
+        diff = now_epoch() - last
         if diff < seconds:
-            return int(seconds - diff)
+            return seconds - diff
     return 0
 
-def log_action(user_id, action):
-    cursor.execute("INSERT INTO user_actions (user_id, action_type, action_time) VALUES (?, ?, ?)", 
-                   (user_id, action, datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
-    conn.commit()
-
 def reset_daily_withdrawals():
-    cursor.execute("UPDATE users_wallet SET daily_withdrawn = 0")
-    conn.commit()
-    print("✅ Daily withdrawal limits reset")
+    store.reset_daily_withdrawals()
+    log.event("jobs", "daily_withdrawals_reset")
 
 def generate_code():
     """Generate a random 8-character code in format XXXX-XXXX"""
@@ -319,241 +1168,1088 @@ def generate_code():
     return f"{code[:4]}-{code[4:]}"
 
 # ================= AUTO WITHDRAWAL PROCESSOR =================
+WITHDRAWAL_BATCH = 50  # requests claimed per pass; other instances take the rest
+
 def process_withdrawals():
     while True:
         time.sleep(300)
-        cursor.execute("SELECT id, user_id, amount FROM withdraw_requests WHERE status='pending' AND withdrawal_type='stars'")
-        pending = cursor.fetchall()
-        for req_id, user_id, amount in pending:
-            try:
-                prices = [LabeledPrice(label=f"Withdrawal of {amount} Stars", amount=amount)]
-                bot.send_invoice(
-                    user_id,
-                    title="Pulse Profit Withdrawal",
-                    description=f"Your withdrawal of {amount} 🟡⭐ stars",
-                    invoice_payload=f"withdraw_{req_id}",
-                    provider_token="",
-                    currency="XTR",
-                    prices=prices,
-                    start_parameter="withdraw"
-                )
-                cursor.execute("UPDATE withdraw_requests SET status='approved' WHERE id=?", (req_id,))
-                conn.commit()
-            except:
-                pass
+        while True:
+            claimed = store.claim_withdrawals(WITHDRAWAL_BATCH)
+            for req_id, user_id, amount in claimed:
+                send_withdrawal(req_id, user_id, amount)
+            if len(claimed) < WITHDRAWAL_BATCH:
+                break
         time.sleep(300)
 
+def send_withdrawal(req_id, user_id, amount):
+    try:
+        prices = [LabeledPrice(label=f"Withdrawal of {amount} Stars", amount=amount)]
+        bot.send_invoice(
+            user_id,
+            title="Pulse Profit Withdrawal",
+            description=f"Your withdrawal of {amount} 🟡⭐ stars",
+            invoice_payload=f"withdraw_{req_id}",
+            provider_token="",
+            currency="XTR",
+            prices=prices,
+            start_parameter="withdraw"
+        )
+        store.complete_withdrawal(req_id)
+    except Exception as e:
+        # Left claimed; it is picked up again once the claim times out
+        log.error("withdrawals", "send_failed", e, request_id=req_id, user_id=user_id, amount=amount)
+
 threading.Thread(target=process_withdrawals, daemon=True).start()
 
-# ================= MAIN MENU =================
-def main_menu(user_id):
-    markup = InlineKeyboardMarkup()
-    markup.row(
-        InlineKeyboardButton("💰 EARN STARS", callback_data="earn"),
-        InlineKeyboardButton("📋 TASKS", callback_data="show_tasks")
-    )
-    markup.row(
-        InlineKeyboardButton("👥 REFER", callback_data="refer"),
-        InlineKeyboardButton("👤 PROFILE", callback_data="profile")
-    )
-    markup.row(
-        InlineKeyboardButton("🏆 LEADERBOARD", callback_data="leaderboard"),
-        InlineKeyboardButton("💎 PREMIUM", callback_data="premium")
-    )
-    markup.row(
-        InlineKeyboardButton("🟡 BUY STARS", callback_data="buy_menu"),
-        InlineKeyboardButton("💳 WITHDRAW", callback_data="withdraw_menu")
-    )
-    markup.row(
-        InlineKeyboardButton("🎫 REDEEM CODE", callback_data="redeem_menu")
-    )
-    if is_admin(user_id):
-        markup.row(
-            InlineKeyboardButton("👑 ADMIN PANEL", callback_data="admin_panel")
-        )
-    return markup
+# ================= BROADCAST ENGINE =================
+BROADCAST_RATE = 25        # messages/second, below Telegram's ~30/s global limit
+BROADCAST_WORKERS = 8
+BROADCAST_CHUNK = 500
+BROADCAST_PROGRESS_INTERVAL = 5
+BROADCAST_LEASE = 300      # seconds an instance owns a broadcast without renewing; renewed every chunk
 
-# ================= START COMMAND =================
-@bot.message_handler(commands=['start'])
-def start_handler(message):
-    user_id = message.from_user.id
-    username = message.from_user.username or ""
-    first_name = message.from_user.first_name
-    
-    # Check for referral
-    args = message.text.split()
-    if len(args) > 1:
-        try:
-            referrer_id = int(args[1])
-            if referrer_id != user_id:
-                cursor.execute("SELECT * FROM referrals WHERE referred_id=?", (user_id,))
-                if not cursor.fetchone():
-                    cooldown = check_cooldown(referrer_id, "refer", COOLDOWN_TIME)
-                    if cooldown == 0:
-                        cursor.execute("INSERT INTO referrals VALUES (?,?)", (referrer_id, user_id))
-                        cursor.execute("UPDATE users_wallet SET referrals = referrals + 1 WHERE user_id=?", (referrer_id,))
-                        add_stars(referrer_id, 5)
-                        log_action(referrer_id, "refer")
-                        conn.commit()
-                        try:
-                            bot.send_message(referrer_id, f"🎉 You earned 5 🟡⭐ from a new referral!")
-                        except:
-                            pass
-        except:
-            pass
-    
-    # Check channel membership
-    cursor.execute("SELECT joined_channel FROM users WHERE user_id=?", (user_id,))
-    user = cursor.fetchone()
-    
-    if user and user[0] == 1:
-        get_wallet(user_id)
-        text = f"⚡ Welcome back to Pulse Profit!\n\n💰 Balance: {get_wallet(user_id)[1]} 🟡⭐"
-        bot.send_message(user_id, text, reply_markup=main_menu(user_id))
-    elif check_channel(user_id):
-        cursor.execute("INSERT OR REPLACE INTO users (user_id, username, first_name, joined_channel) VALUES (?,?,?,1)", 
-                      (user_id, username, first_name))
-        conn.commit()
-        get_wallet(user_id)
-        text = f"⚡ Welcome to Pulse Profit!\n\n💰 Balance: 0 🟡⭐"
-        bot.send_message(user_id, text, reply_markup=main_menu(user_id))
-    else:
-        text = f"""
-🔒 CHANNEL REQUIRED
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
 
-Please join our channel first:
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
 
-📢 {REQUIRED_CHANNEL}
-🔗 {CHANNEL_LINK}
+class BroadcastEngine:
+    """Sends one broadcast at a time, checkpointing progress per chunk so it can resume after restart."""
 
-After joining, click the button below.
-"""
-        markup = InlineKeyboardMarkup()
-        markup.row(
-            InlineKeyboardButton("📢 JOIN", url=CHANNEL_LINK),
-            InlineKeyboardButton("✅ VERIFY", callback_data="verify_channel")
-        )
-        bot.send_message(user_id, text, reply_markup=markup)
+    def __init__(self, rate=BROADCAST_RATE, workers=BROADCAST_WORKERS, chunk_size=BROADCAST_CHUNK):
+        self.bucket = TokenBucket(rate)
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.active_id = None
+        self.cancelled = False
+        self.owner = f"{os.getpid()}:{os.urandom(6).hex()}"
+        self.lock = threading.Lock()
 
-# ================= VERIFY CHANNEL =================
-@bot.callback_query_handler(func=lambda c: c.data == "verify_channel")
-def verify_channel_callback(call):
-    user_id = call.from_user.id
-    if check_channel(user_id):
-        cursor.execute("INSERT OR REPLACE INTO users (user_id, joined_channel) VALUES (?,1)", (user_id,))
-        conn.commit()
-        get_wallet(user_id)
-        bot.answer_callback_query(call.id, "✅ Verified!")
-        text = f"⚡ Welcome to Pulse Profit!\n\n💰 Balance: 0 🟡⭐"
-        bot.edit_message_text(text, call.message.chat.id, call.message.message_id, reply_markup=main_menu(user_id))
-    else:
-        bot.answer_callback_query(call.id, "❌ You haven't joined yet!", show_alert=True)
+    def start(self, broadcast_id):
+        with self.lock:
+            if self.active_id is not None:
+                return False
+            self.active_id = broadcast_id
+            self.cancelled = False
+        threading.Thread(target=self._run, args=(broadcast_id,), daemon=True).start()
+        return True
 
-# ================= EARN STARS =================
-@bot.callback_query_handler(func=lambda c: c.data == "earn")
-def earn_callback(call):
-    user_id = call.from_user.id
-    
-    cursor.execute("SELECT joined_channel FROM users WHERE user_id=?", (user_id,))
-    user = cursor.fetchone()
-    if not user or user[0] != 1:
-        verify_channel_callback(call)
+    def cancel(self):
+        self.cancelled = True
+
+    def _send(self, user_id, text):
+        """Returns 'sent', 'blocked' or 'failed'."""
+        for _ in range(3):
+            self.bucket.acquire()
+            try:
+                bot.send_message(user_id, text)
+                return "sent"
+            except telebot.apihelper.ApiTelegramException as e:
+                if e.error_code == 429:
+                    time.sleep((e.result_json.get("parameters") or {}).get("retry_after", 1))
+                    continue
+                if e.error_code == 403 or "chat not found" in e.description:
+                    return "blocked"
+                return "failed"
+            except Exception:
+                return "failed"
+        return "failed"
+
+    def _send_chunk(self, user_ids, text):
+        outcome = {"sent": 0, "failed": 0, "blocked_ids": []}
+        lock = threading.Lock()
+        pending = list(user_ids)
+
+        def worker():
+            sent = failed = 0
+            blocked_ids = []
+            while not self.cancelled:
+                with lock:
+                    if not pending:
+                        break
+                    user_id = pending.pop()
+                result = self._send(user_id, text)
+                if result == "sent":
+                    sent += 1
+                elif result == "blocked":
+                    blocked_ids.append(user_id)
+                else:
+                    failed += 1
+            with lock:
+                outcome["sent"] += sent
+                outcome["failed"] += failed
+                outcome["blocked_ids"].extend(blocked_ids)
+
+        threads = [threading.Thread(target=worker, daemon=True) for _ in range(min(self.workers, len(user_ids)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return outcome
+
+    def _report(self, row, started, sent_since_start, final=False):
+        broadcast_id, _, status, _, sent, failed, blocked, chat_id, message_id = row
+        if not chat_id or not message_id:
+            return
+        elapsed = max(time.monotonic() - started, 0.001)
+        icon = {"running": "📣", "done": "✅", "cancelled": "⏹"}.get(status, "📣")
+        text = f"""
+{icon} BROADCAST #{broadcast_id} - {status.upper()}
+
+✅ Sent: {sent}
+🚫 Blocked: {blocked}
+❌ Failed: {failed}
+⚡ Rate: {sent_since_start / elapsed:.1f} msg/s
+"""
+        markup = None
+        if not final:
+            markup = InlineKeyboardMarkup()
+            markup.row(InlineKeyboardButton("⏹ CANCEL", callback_data="admin_broadcast_cancel"))
+        try:
+            bot.edit_message_text(text, chat_id, message_id, reply_markup=markup)
+        except:
+            pass
+
+    def _run(self, broadcast_id):
+        started = time.monotonic()
+        sent_since_start = 0
+        last_report = 0
+        try:
+            row = store.get_broadcast(broadcast_id)
+            text, last_user_id = row[1], row[3]
+            while not self.cancelled:
+                # Fails once any instance cancelled the broadcast or another one took it over
+                if not store.claim_broadcast(broadcast_id, self.owner, BROADCAST_LEASE):
+                    break
+                user_ids = store.broadcast_recipients(last_user_id, self.chunk_size)
+                if not user_ids:
+                    store.finish_broadcast(broadcast_id, "done")
+                    break
+                outcome = self._send_chunk(user_ids, text)
+                if self.cancelled:
+                    break
+                last_user_id = user_ids[-1]
+                sent_since_start += outcome["sent"]
+                store.checkpoint_broadcast(broadcast_id, last_user_id, outcome["sent"], outcome["failed"], outcome["blocked_ids"])
+                if time.monotonic() - last_report >= BROADCAST_PROGRESS_INTERVAL:
+                    last_report = time.monotonic()
+                    self._report(store.get_broadcast(broadcast_id), started, sent_since_start)
+
+            row = store.get_broadcast(broadcast_id)
+            if row[2] != "running":
+                self._report(row, started, sent_since_start, final=True)
+        except Exception as e:
+            log.error("broadcast", "stopped", e, broadcast_id=broadcast_id)
+        finally:
+            with self.lock:
+                self.active_id = None
+
+def resume_broadcasts():
+    """Take over a running broadcast whose sender stopped: at start, then whenever its lease runs out."""
+    while True:
+        try:
+            broadcast_id = store.running_broadcast()
+            if (broadcast_id and broadcaster.active_id is None
+                    and store.claim_broadcast(broadcast_id, broadcaster.owner, BROADCAST_LEASE)
+                    and broadcaster.start(broadcast_id)):
+                log.event("broadcast", "resumed", broadcast_id=broadcast_id)
+        except Exception as e:
+            log.error("broadcast", "resume_failed", e)
+        time.sleep(BROADCAST_LEASE // 5)
+
+broadcaster = BroadcastEngine()
+threading.Thread(target=resume_broadcasts, daemon=True).start()
+
+# ================= ADMIN NOTIFICATIONS =================
+NOTIFY_DIGEST_INTERVAL = int(os.getenv("NOTIFY_DIGEST_INTERVAL", "300"))  # seconds a digest collects events
+NOTIFY_DIGEST_MAX = 25             # events that flush a digest early; also the most listed in one message
+NOTIFY_URGENT_WITHDRAWAL = 1000    # admin withdrawals of at least this many stars skip the digest
+NOTIFY_PREFS_REFRESH = 60          # seconds between reloads of preferences other instances may have changed
+NOTIFY_MODES = ("digest", "instant", "off")
+NOTIFY_CATEGORIES = {
+    "task": "📋 Task verifications",
+    "withdrawal": "💳 Admin withdrawals",
+    "premium": "👑 Premium requests",
+    "payments": "💰 Payment reconciliation",
+}
+
+class AdminNotifier:
+    """Buffers admin events per (admin, category) and sends each buffer as one digest message.
+
+    Handlers only queue a line; a single thread does the sending, so admin traffic is bounded by
+    the flush interval rather than by how many events arrive."""
+
+    def __init__(self, interval=NOTIFY_DIGEST_INTERVAL, max_events=NOTIFY_DIGEST_MAX):
+        self.interval = interval
+        self.max_events = max_events
+        self.buffers = {}  # (admin_id, category) -> [first event time, lines, flush now]
+        self.prefs = {}
+        self.prefs_loaded = 0
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+
+    def start(self):
+        self.reload_prefs()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def reload_prefs(self):
+        self.prefs = store.notify_prefs()
+        self.prefs_loaded = time.monotonic()
+
+    def mode(self, admin_id, category):
+        return self.prefs.get((admin_id, category), "digest")
+
+    def set_mode(self, admin_id, category, mode):
+        store.set_notify_pref(admin_id, category, mode)
+        self.prefs[(admin_id, category)] = mode
+
+    def notify(self, category, line, urgent=False):
+        """Queue one event for every admin who wants this category; never waits on the Bot API."""
+        now = time.monotonic()
+        due = False
+        with self.lock:
+            for admin_id in list(admins):
+                mode = self.mode(admin_id, category)
+                if mode == "off":
+                    continue
+                entry = self.buffers.setdefault((admin_id, category), [now, [], False])
+                entry[1].append(line)
+                if urgent or mode == "instant" or len(entry[1]) >= self.max_events:
+                    entry[2] = due = True
+        metrics.inc("bot_admin_events_total", (("category", category),))
+        if due:
+            self.wake.set()
+
+    def flush(self, force=False):
+        """Send every buffer that is due (or all of them). Returns the number of messages sent."""
+        now = time.monotonic()
+        with self.lock:
+            due = [key for key, (first, _, urgent) in self.buffers.items()
+                   if force or urgent or now - first >= self.interval]
+            batches = [(key, self.buffers.pop(key)[1]) for key in due]
+        sent = 0
+        for (admin_id, category), lines in batches:
+            try:
+                bot.send_message(admin_id, self.render(category, lines), parse_mode="HTML")
+                sent += 1
+                metrics.inc("bot_admin_digests_total", (("category", category),))
+            except Exception as e:
+                log.error("notify", "send_failed", e, admin_id=admin_id, category=category)
+        return sent
+
+    def render(self, category, lines):
+        title = NOTIFY_CATEGORIES[category]
+        if len(lines) == 1:
+            return f"🔔 <b>{title}</b>\n\n{lines[0]}"
+        text = f"🔔 <b>{title}</b>: {len(lines)} new\n\n" + "\n\n".join(lines[:self.max_events])
+        if len(lines) > self.max_events:
+            text += f"\n\n…and {len(lines) - self.max_events} more in the admin panel"
+        return text
+
+    def _run(self):
+        while True:
+            self.wake.wait(1)
+            self.wake.clear()
+            try:
+                if time.monotonic() - self.prefs_loaded >= NOTIFY_PREFS_REFRESH:
+                    self.reload_prefs()
+                self.flush()
+            except Exception as e:
+                log.error("notify", "flush_failed", e)
+
+notifier = AdminNotifier()
+notifier.start()
+
+# ================= READ REPLICA =================
+REPLICA_INTERVAL = int(os.getenv("REPLICA_INTERVAL", "300"))  # seconds, 0 disables the replica
+REPLICA_PAGES = 256          # pages copied per backup step
+REPLICA_STEP_DELAY = 0.005   # pause between steps so writers on the primary are not stalled
+
+# Indexes that help analytics but would slow the primary's writes
+REPLICA_INDEXES = [
+    "CREATE INDEX IF NOT EXISTS idx_user_actions_time ON user_actions (action_time, action_type)",
+    "CREATE INDEX IF NOT EXISTS idx_user_tasks_verified ON user_tasks (verified, completed_at)",
+    "CREATE INDEX IF NOT EXISTS idx_redeemed_codes_time ON redeemed_codes (redeemed_at)",
+    "CREATE INDEX IF NOT EXISTS idx_withdraw_requests_time ON withdraw_requests (request_time, status)",
+]
+
+class ReadReplica:
+    """Periodically rebuilt read-only copy of the primary for heavy analytics reads."""
+
+    def __init__(self, path, interval=REPLICA_INTERVAL):
+        self.path = path
+        self.interval = interval
+        self.conn = None
+        self.storage = None
+        self.refreshed_at = None
+        self.lock = threading.Lock()
+
+    def refresh(self):
+        started = time.time()
+        tmp_path = self.path + ".tmp"
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        target = sqlite3.connect(tmp_path)
+        try:
+            # Backing up from the primary connection itself means its writes don't restart the copy
+            conn.backup(target, pages=REPLICA_PAGES, progress=lambda *args: time.sleep(REPLICA_STEP_DELAY))
+            db = target.cursor()
+            for sql in REPLICA_INDEXES:
+                db.execute(sql)
+            db.execute("DROP TABLE IF EXISTS analytics_totals")
+            db.execute("CREATE TABLE analytics_totals (name TEXT PRIMARY KEY, value INTEGER)")
+            db.executemany("INSERT INTO analytics_totals VALUES (?,?)", SQLiteStorage(target).totals().items())
+            target.commit()
+            db.execute("ANALYZE")
+        finally:
+            target.close()
+        os.replace(tmp_path, self.path)
+        replica_conn = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True, check_same_thread=False)
+        with self.lock:
+            old, self.conn = self.conn, replica_conn
+            self.storage = SQLiteStorage(replica_conn, InstrumentedCursor)
+            self.refreshed_at = datetime.now()
+        # Readers that already hold the old connection keep using the unlinked file until it closes
+        if old:
+            threading.Timer(60, old.close).start()
+        log.event("replica", "refreshed", seconds=round(time.time() - started, 2))
+
+    def start(self):
+        def refresh_loop():
+            while True:
+                try:
+                    self.refresh()
+                except Exception as e:
+                    log.error("replica", "refresh_failed", e)
+                time.sleep(self.interval)
+        threading.Thread(target=refresh_loop, daemon=True).start()
+
+    def store(self):
+        """Storage reading the replica, or the primary until the first refresh completes."""
+        with self.lock:
+            return self.storage or store
+
+    def totals(self):
+        with self.lock:
+            replica_conn = self.conn
+        if not replica_conn:
+            return None
+        return dict(replica_conn.execute("SELECT name, value FROM analytics_totals").fetchall())
+
+replica = ReadReplica(REPLICA_PATH)
+if REPLICA_INTERVAL > 0 and SQLITE:
+    replica.start()
+
+# ================= ROLLUPS =================
+ROLLUP_INTERVAL = 60
+ROLLUP_BATCH = 100000  # max events folded per run
+
+# Triggers (storage.SQLITE_ROLLUP_SCHEMA) queue one rollup_events row per fact as it happens;
+# each run folds the oldest events into buckets and deletes them.
+# kind -> (count metric, metric the summed amount adds to)
+ROLLUP_METRICS = {
+    "signup": ("signups", None),
+    "earn": ("earns", "stars_minted"),
+    "refer": ("referrals", "stars_minted"),
+    "task_verified": ("tasks_completed", "stars_minted"),
+    "task_submitted": ("tasks_submitted", None),
+    "redeem": ("redemptions", "stars_minted"),
+    "withdraw_stars": ("withdrawals_stars", "stars_burned"),
+    "withdraw_admin": ("withdrawals_admin", "stars_burned"),
+    "payment": ("payments", "stars_bought"),
+}
+
+def run_rollups():
+    """Fold one batch of rollup events into hourly and daily buckets. Returns events folded."""
+    with store.transaction() as db:
+        upper = db.execute("SELECT MAX(id) FROM (SELECT id FROM rollup_events ORDER BY id LIMIT ?)",
+                           (ROLLUP_BATCH,)).fetchone()[0]
+        if upper is None:
+            return 0
+        
+        folded = 0
+        buckets = defaultdict(int)
+        for hour, kind, count, amount in db.execute("""
+            SELECT event_time / 3600, kind, COUNT(*), COALESCE(SUM(amount), 0)
+            FROM rollup_events WHERE id <= ? GROUP BY 1, 2
+        """, (upper,)).fetchall():
+            folded += count
+            if hour is None or kind not in ROLLUP_METRICS:
+                continue
+            count_metric, amount_metric = ROLLUP_METRICS[kind]
+            hour = epoch_text(hour * 3600, '%Y-%m-%d %H')
+            for size, start in (("hour", hour), ("day", hour[:10])):
+                buckets[(size, start, count_metric)] += count
+                if amount_metric:
+                    buckets[(size, start, amount_metric)] += amount
+        
+        db.executemany("""
+            INSERT INTO rollups (bucket_size, bucket_start, metric, value) VALUES (?,?,?,?)
+            ON CONFLICT (bucket_size, bucket_start, metric) DO UPDATE SET value = value + excluded.value
+        """, [(size, start, metric, value) for (size, start, metric), value in buckets.items()])
+        db.execute("DELETE FROM rollup_events WHERE id <= ?", (upper,))
+        return folded
+
+def rollup_loop():
+    while True:
+        try:
+            # Drain backlogs quickly, then settle into the regular interval
+            while run_rollups():
+                pass
+        except Exception as e:
+            log.error("rollup", "failed", e)
+        time.sleep(ROLLUP_INTERVAL)
+
+if SQLITE:
+    threading.Thread(target=rollup_loop, daemon=True).start()
+
+SPARK_CHARS = "▁▂▃▄▅▆▇█"
+
+def sparkline(values):
+    peak = max(values) if values else 0
+    if not peak:
+        return SPARK_CHARS[0] * len(values)
+    return "".join(SPARK_CHARS[min(len(SPARK_CHARS) - 1, int(v * (len(SPARK_CHARS) - 1) / peak))] for v in values)
+
+def rollup_series(size, count, metrics_wanted):
+    """Return ([bucket keys], {metric: [values]}) for the last `count` buckets, zero-filled."""
+    now = now_epoch()
+    if size == "hour":
+        keys = [epoch_text(now - i * 3600, '%Y-%m-%d %H') for i in range(count - 1, -1, -1)]
+    else:
+        keys = [epoch_text(now - i * 86400, '%Y-%m-%d') for i in range(count - 1, -1, -1)]
+    placeholders = ','.join('?' * len(metrics_wanted))
+    with store.transaction() as db:
+        rows = db.execute(f"""
+            SELECT bucket_start, metric, value FROM rollups
+            WHERE bucket_size=? AND bucket_start >= ? AND metric IN ({placeholders})
+        """, [size, keys[0]] + list(metrics_wanted)).fetchall()
+    values = {(start, metric): value for start, metric, value in rows}
+    return keys, {metric: [values.get((key, metric), 0) for key in keys] for metric in metrics_wanted}
+
+# ================= RETENTION =================
+RETENTION_INTERVAL = int(os.getenv("RETENTION_INTERVAL", "21600"))  # seconds, 0 disables the job
+RETENTION_BATCH = 500         # rows moved per transaction
+RETENTION_STEP_DELAY = 0.05   # pause between batches so handlers can take the write lock
+VACUUM_PAGES = 1000           # free pages released per incremental_vacuum step
+
+# (table, timestamp column, max age, extra condition); the condition may use ? for the current time
+RETENTION_POLICIES = [
+    # Cooldowns only look back an hour; everything else about these rows lives in rollups
+    ("user_actions", "action_time", timedelta(hours=24), f"NOT ({STATE_FILTER})"),
+    # Conversation states nobody finished
+    ("user_actions", "action_time", timedelta(days=7), STATE_FILTER),
+    # Redemptions are needed for the "already used" check while the code can still be redeemed
+    ("redeemed_codes", "redeemed_at", timedelta(days=30), """code_id IN (SELECT id FROM redeem_codes
+        WHERE active=0 OR used_count >= max_uses OR expires_at < ?)"""),
+    ("withdraw_requests", "request_time", timedelta(days=90), "status NOT IN ('pending', 'processing')"),
+    ("premium_requests", "request_time", timedelta(days=90), "status != 'pending'"),
+    ("backup_log", "backup_time", timedelta(days=30), None),
+]
+
+retention_lock = threading.Lock()
+retention_report = None
+
+def archive_columns(db, table):
+    """Create archive.<table> or add columns main.<table> gained since; returns the column list."""
+    columns = [row[1] for row in db.execute(f"PRAGMA main.table_info({table})").fetchall()]
+    db.execute(f"CREATE TABLE IF NOT EXISTS archive.{table} AS SELECT * FROM main.{table} WHERE 0")
+    archived = {row[1] for row in db.execute(f"PRAGMA archive.table_info({table})").fetchall()}
+    for column in columns:
+        if column not in archived:
+            db.execute(f"ALTER TABLE archive.{table} ADD COLUMN {column}")
+    return columns
+
+def archive_policy(db, table, time_column, max_age, condition):
+    """Move rows matching one policy to the archive in small transactions. Returns rows moved."""
+    now = now_epoch()
+    where = [f"{time_column} < ?"]
+    params = [now - int(max_age.total_seconds())]
+    if condition:
+        where.append(f"({condition})")
+        params += [now] * condition.count("?")
+    select = f"SELECT rowid FROM main.{table} WHERE {' AND '.join(where)} LIMIT {RETENTION_BATCH}"
+    
+    columns = ", ".join(archive_columns(db, table))
+    moved = 0
+    while True:
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            rowids = [row[0] for row in db.execute(select, params).fetchall()]
+            if rowids:
+                placeholders = ','.join('?' * len(rowids))
+                db.execute(f"""INSERT INTO archive.{table} ({columns})
+                    SELECT {columns} FROM main.{table} WHERE rowid IN ({placeholders})""", rowids)
+                db.execute(f"DELETE FROM main.{table} WHERE rowid IN ({placeholders})", rowids)
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+        moved += len(rowids)
+        if len(rowids) < RETENTION_BATCH:
+            return moved
+        time.sleep(RETENTION_STEP_DELAY)
+
+def reclaim_space(db):
+    """Return free pages to the filesystem. Returns bytes released from the main file."""
+    page_size = db.execute("PRAGMA main.page_size").fetchone()[0]
+    if db.execute("PRAGMA main.auto_vacuum").fetchone()[0] != 2:
+        # Switching modes takes a full VACUUM that locks the file, so it is left to /retention vacuum
+        log.event("retention", "vacuum_mode_pending")
+        return None
+    
+    # Count pages per step rather than diffing page_count, which concurrent writers also move
+    released = 0
+    free = db.execute("PRAGMA main.freelist_count").fetchone()[0]
+    while free:
+        # execute() steps the pragma once, which frees a single page; executescript runs it to completion
+        db.executescript(f"PRAGMA main.incremental_vacuum({VACUUM_PAGES})")
+        remaining = db.execute("PRAGMA main.freelist_count").fetchone()[0]
+        if remaining >= free:
+            break
+        released += free - remaining
+        free = remaining
+        time.sleep(RETENTION_STEP_DELAY)
+    return released * page_size
+
+def run_retention():
+    """Apply every retention policy, then vacuum. Returns a report of rows moved and bytes reclaimed."""
+    global retention_report
+    with retention_lock:
+        started = time.time()
+        # A dedicated connection keeps each move atomic across both files without touching the shared one
+        db = sqlite3.connect(DB_PATH, timeout=30, isolation_level=None, check_same_thread=False)
+        try:
+            db.execute("ATTACH DATABASE ? AS archive", (ARCHIVE_PATH,))
+            migrate_sqlite_epochs(db, "archive")
+            moved = defaultdict(int)
+            for table, time_column, max_age, condition in RETENTION_POLICIES:
+                moved[table] += archive_policy(db, table, time_column, max_age, condition)
+            released = reclaim_space(db)
+            reclaimed = released or 0
+        finally:
+            db.close()
+        for table, rows in moved.items():
+            metrics.inc("bot_retention_rows_moved_total", (("table", table),), rows)
+        metrics.inc("bot_retention_bytes_reclaimed_total", (), reclaimed)
+        retention_report = {
+            "moved": dict(moved),
+            "reclaimed": reclaimed,
+            "vacuum_pending": released is None,
+            "seconds": time.time() - started,
+            "finished_at": datetime.now(),
+        }
+        log.event("retention", "finished", moved=dict(moved), reclaimed_bytes=reclaimed)
+        return retention_report
+
+def switch_vacuum_mode():
+    """One-off full VACUUM that turns on incremental vacuum. Returns (bytes released, seconds)."""
+    with retention_lock:
+        started = time.time()
+        log.event("retention", "vacuum_mode_switch_started", size_bytes=os.path.getsize(DB_PATH))
+        released = store.enable_incremental_vacuum()
+        seconds = time.time() - started
+    metrics.inc("bot_vacuum_mode_switches_total")
+    metrics.inc("bot_retention_bytes_reclaimed_total", (), released)
+    log.event("retention", "vacuum_mode_switched", released_bytes=released, seconds=round(seconds, 1))
+    return released, seconds
+
+def retention_loop():
+    while True:
+        time.sleep(RETENTION_INTERVAL)
+        try:
+            run_retention()
+        except Exception as e:
+            log.error("retention", "failed", e)
+
+if RETENTION_INTERVAL > 0 and SQLITE:
+    threading.Thread(target=retention_loop, daemon=True).start()
+
+# ================= DATA EXPORT =================
+EXPORT_BATCH = 5000
+EXPORT_FORMATS = ("csv", "jsonl")
+
+# Each export pages by its first column (keyset), so no read transaction is held between batches
+EXPORTS = {
+    "users": """
+        SELECT u.user_id, u.username, u.first_name, u.joined_channel, u.blocked, w.stars, w.total_earned,
+               w.referrals, w.premium, w.tasks_done, w.daily_withdrawn, w.role
+        FROM users u LEFT JOIN users_wallet w ON w.user_id = u.user_id
+        WHERE u.user_id > ? ORDER BY u.user_id LIMIT ?
+    """,
+    "withdrawals": """
+        SELECT id, user_id, amount, withdrawal_type, status, request_time
+        FROM withdraw_requests WHERE id > ? ORDER BY id LIMIT ?
+    """,
+    "redemptions": """
+        SELECT rc.id, rc.code_id, c.code, rc.user_id, c.amount, rc.redeemed_at
+        FROM redeemed_codes rc LEFT JOIN redeem_codes c ON c.id = rc.code_id
+        WHERE rc.id > ? ORDER BY rc.id LIMIT ?
+    """,
+    "user_tasks": """
+        SELECT ut.id, ut.user_id, ut.task_id, t.task_name, t.reward, ut.verified, ut.completed_at
+        FROM user_tasks ut LEFT JOIN tasks t ON t.id = ut.task_id
+        WHERE ut.id > ? ORDER BY ut.id LIMIT ?
+    """,
+}
+
+def export_source():
+    """(SQLite file to read, time its data is from): the replica's last refresh while it is warm, else now."""
+    if not SQLITE:
+        return None, datetime.now()
+    with replica.lock:
+        if replica.conn:
+            return replica.path, replica.refreshed_at
+    return DB_PATH, datetime.now()
+
+def export_chunks(table, fmt, batch_size=EXPORT_BATCH, stats=None, path=None):
+    """Yield the export as encoded byte chunks, one batch of rows at a time."""
+    if SQLITE:
+        path = path or export_source()[0]
+        # Under the asyncio runtime each batch may be read on a different executor thread
+        source = SQLiteStorage(sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False), InstrumentedCursor)
+    else:
+        source = store
+    try:
+        last_key = -1
+        columns = None
+        while True:
+            with source.transaction() as cur:
+                cur.execute(EXPORTS[table], (last_key, batch_size))
+                rows = cur.fetchall()
+                if columns is None:
+                    columns = [d[0] for d in cur.description]
+            if fmt == "csv" and last_key == -1:
+                buffer = io.StringIO()
+                csv.writer(buffer).writerow(columns)
+                yield buffer.getvalue().encode()
+            if not rows:
+                break
+            buffer = io.StringIO()
+            if fmt == "csv":
+                csv.writer(buffer).writerows(rows)
+            else:
+                for row in rows:
+                    buffer.write(json.dumps(dict(zip(columns, row)), ensure_ascii=False) + "\n")
+            yield buffer.getvalue().encode()
+            if stats is not None:
+                stats["rows"] = stats.get("rows", 0) + len(rows)
+            last_key = rows[-1][0]
+            if len(rows) < batch_size:
+                break
+    finally:
+        if source is not store:
+            source.close()
+
+def export_to_file(table, fmt):
+    """Write a gzip-compressed export to a temp file and return (path, rows, snapshot time)."""
+    handle, path = tempfile.mkstemp(prefix=f"export_{table}_", suffix=f".{fmt}.gz")
+    os.close(handle)
+    stats = {"rows": 0}
+    source, snapshot = export_source()
+    with gzip.open(path, "wb") as f:
+        for chunk in export_chunks(table, fmt, stats=stats, path=source):
+            f.write(chunk)
+    return path, stats["rows"], snapshot
+
+def send_export(chat_id, table, fmt):
+    path = None
+    try:
+        started = time.time()
+        path, rows, snapshot = export_to_file(table, fmt)
+        size = os.path.getsize(path)
+        if size > 50 * 1024 * 1024:
+            bot.send_message(chat_id, f"❌ Export is {size // (1024 * 1024)} MB, above Telegram's 50 MB limit. Use the /export HTTP endpoint.")
+            return
+        with open(path, "rb") as f:
+            age = (datetime.now() - snapshot).total_seconds() // 60
+            bot.send_document(chat_id, f, caption=f"📤 {table}: {rows} rows ({time.time() - started:.1f}s)\n"
+                                                  f"🕒 Data as of {snapshot.strftime('%Y-%m-%d %H:%M')} ({age:.0f} min ago)",
+                              visible_file_name=export_filename(table, fmt, snapshot))
+    except Exception as e:
+        log.error("export", "failed", e, table=table, format=fmt)
+        try:
+            bot.send_message(chat_id, f"❌ Export failed: {e}")
+        except:
+            pass
+    finally:
+        if path and os.path.exists(path):
+            os.remove(path)
+
+# ================= CALLBACK ROUTER =================
+class CallbackRouter:
+    """Maps callback data to handlers: exact data through a dict, parameterized data through a prefix trie.
+
+    Lookup costs one dict probe plus a walk over the characters of the data, however many routes exist,
+    and an exact route always wins over a prefix ("buy_menu" over "buy_{stars}"). The router is registered
+    as the bot's only callback query handler.
+    """
+
+    def __init__(self):
+        self.exact = {}
+        self.trie = {}  # char -> child node; the None key holds (handler, parameter name, converter)
+
+    def route(self, pattern, convert=str):
+        """Register a handler for `pattern`: exact data, or a prefix ending in one `{name}` parameter
+        that is parsed with `convert` and passed to the handler as a keyword argument."""
+        def decorator(func):
+            handler = instrument_handler(func)
+            if pattern.endswith("}"):
+                prefix, name = pattern[:-1].split("{")
+                node = self.trie
+                for char in prefix:
+                    node = node.setdefault(char, {})
+                target, key, entry = node, None, (handler, name, convert)
+            else:
+                target, key, entry = self.exact, pattern, (handler, None, None)
+            if key in target:
+                raise ValueError(f"Duplicate callback route: {pattern}")
+            target[key] = entry
+            return func
+        return decorator
+
+    def resolve(self, data):
+        """Return (handler, kwargs) for callback data, or (None, None) when nothing matches."""
+        route = self.exact.get(data)
+        if route:
+            return route[0], {}
+        node, route, end = self.trie, None, 0
+        for i, char in enumerate(data):
+            node = node.get(char)
+            if node is None:
+                break
+            if None in node:
+                route, end = node[None], i + 1
+        if route is None or end == len(data):
+            return None, None
+        handler, name, convert = route
+        try:
+            return handler, {name: convert(data[end:])}
+        except (ValueError, KeyError):
+            return None, None
+
+    async def dispatch(self, call):
+        handler, kwargs = self.resolve(call.data or "")
+        if handler is None:
+            metrics.inc("bot_callback_unrouted_total")
+            return
+        await handler(call, **kwargs)
+
+callback_router = CallbackRouter()
+bot.register_callback_query_handler(callback_router.dispatch, func=None)
+
+# ================= CONVERSATION FLOWS =================
+FLOW_TTL = 1800             # seconds an untouched flow stays alive before it counts as abandoned
+FLOW_SWEEP_INTERVAL = 300
+FLOW_PERSIST = os.getenv("FLOW_PERSIST", "1") != "0"  # "0" keeps flows in memory only (lost on restart)
+
+class FlowStore:
+    """Per-user conversation flows, (state, data), held in memory with a TTL and written through to the database.
+
+    While this process is the database's only writer (SQLite, or persistence off) memory answers every read
+    after the first, "no flow" included, so a step costs one write at most. With a shared PostgreSQL database
+    another instance may have moved the flow on, so reads go to the database there.
+    """
+
+    def __init__(self, ttl=FLOW_TTL, persist=FLOW_PERSIST, authoritative=True):
+        self.ttl = ttl
+        self.persist = persist
+        self.authoritative = authoritative or not persist
+        self.entries = {}  # user_id -> (state or None, data, expires_at)
+        self.next_sweep = time.time() + FLOW_SWEEP_INTERVAL
+
+    def _cached(self, user_id):
+        """(state, data), None for no flow, or False when memory does not know."""
+        entry = self.entries.get(user_id) if self.authoritative else None
+        if entry is None:
+            return False
+        if entry[0] is None or entry[2] < time.time():
+            return None
+        return entry[:2]
+
+    def _put(self, user_id, state, data, touched=None):
+        now = time.time()
+        self.entries[user_id] = (state, data, (touched or now) + self.ttl)
+        if now >= self.next_sweep:
+            self.next_sweep = now + FLOW_SWEEP_INTERVAL
+            for key, entry in list(self.entries.items()):
+                if entry[2] < now:
+                    self.entries.pop(key, None)
+
+    def _loaded(self, user_id, row):
+        """Remember a flow read from the database; one abandoned before a restart expires like one in memory."""
+        if row:
+            state, data, updated_at = row
+            if updated_at + self.ttl >= time.time():
+                self._put(user_id, state, data, updated_at)
+                return state, data
+        self._put(user_id, None, None)
+        return None
+
+    def peek(self, user_id):
+        """Synchronous get, for the Flask webhook."""
+        flow = self._cached(user_id)
+        return self._loaded(user_id, store.load_flow(user_id) if self.persist else None) if flow is False else flow
+
+    async def get(self, user_id):
+        flow = self._cached(user_id)
+        if flow is False:
+            flow = self._loaded(user_id, await astore.load_flow(user_id) if self.persist else None)
+        return flow
+
+    def _had_data(self, user_id):
+        """Whether the database may hold flow data for the user that a write must drop."""
+        entry = self.entries.get(user_id) if self.authoritative else None
+        return entry is None or bool(entry[1])
+
+    async def set(self, user_id, state, data=None):
+        data = data or {}
+        had_data = self._had_data(user_id)
+        self._put(user_id, state, data)
+        if self.persist:
+            await astore.save_flow(user_id, state, data, had_data)
+
+    async def clear(self, user_id):
+        had_data = self._had_data(user_id)
+        self._put(user_id, None, None)
+        if self.persist:
+            await astore.clear_flow(user_id, had_data)
+
+flows = FlowStore(authoritative=SQLITE)
+
+class FlowError(Exception):
+    """Rejects a step's input; the message is sent to the user and the flow ends."""
+
+class FlowStep(NamedTuple):
+    handler: Callable
+    parse: Callable
+    invalid: str
+    needs: tuple
+
+FLOW_STEPS = {}
+
+def flow_step(state, parse=str, invalid="❌ Invalid input!", needs=()):
+    """Declare the handler for text sent while a flow is in `state`.
+
+    `parse` turns the text into the handler's value; a ValueError sends `invalid`, a FlowError its own
+    message, and both end the flow, as does missing one of the data keys in `needs`. The handler returns
+    (next_state, data) to continue the flow, or nothing to finish it.
+    """
+    def decorator(func):
+        if state in FLOW_STEPS:
+            raise ValueError(f"Duplicate flow step: {state}")
+        FLOW_STEPS[state] = FlowStep(func, parse, invalid, needs)
+        return func
+    return decorator
+
+def whole_number(minimum, too_small):
+    """Validator: an integer of at least `minimum`, else FlowError(too_small)."""
+    def parse(text):
+        value = int(text)
+        if value < minimum:
+            raise FlowError(too_small)
+        return value
+    return parse
+
+# ================= MAIN MENU =================
+def main_menu(user_id):
+    markup = InlineKeyboardMarkup()
+    markup.row(
+        InlineKeyboardButton("💰 EARN STARS", callback_data="earn"),
+        InlineKeyboardButton("📋 TASKS", callback_data="show_tasks")
+    )
+    markup.row(
+        InlineKeyboardButton("👥 REFER", callback_data="refer"),
+        InlineKeyboardButton("👤 PROFILE", callback_data="profile")
+    )
+    markup.row(
+        InlineKeyboardButton("🏆 LEADERBOARD", callback_data="leaderboard"),
+        InlineKeyboardButton("💎 PREMIUM", callback_data="premium")
+    )
+    markup.row(
+        InlineKeyboardButton("🟡 BUY STARS", callback_data="buy_menu"),
+        InlineKeyboardButton("💳 WITHDRAW", callback_data="withdraw_menu")
+    )
+    markup.row(
+        InlineKeyboardButton("🎫 REDEEM CODE", callback_data="redeem_menu")
+    )
+    if is_admin(user_id):
+        markup.row(
+            InlineKeyboardButton("👑 ADMIN PANEL", callback_data="admin_panel")
+        )
+    return markup
+
+# ================= START COMMAND =================
+@bot.message_handler(commands=['start'])
+async def start_handler(message):
+    user_id = message.from_user.id
+    username = message.from_user.username or ""
+    first_name = message.from_user.first_name
+    
+    # Check for referral
+    args = message.text.split()
+    if len(args) > 1:
+        try:
+            referrer_id = int(args[1])
+            if referrer_id != user_id and not await astore.has_referrer(user_id):
+                cooldown = await check_cooldown(referrer_id, "refer", COOLDOWN_TIME)
+                if cooldown == 0 and await astore.add_referral(referrer_id, user_id, 5):
+                    try:
+                        await api.send_message(referrer_id, f"🎉 You earned 5 🟡⭐ from a new referral!")
+                    except:
+                        pass
+        except Exception as e:
+            log.error("referrals", "failed", e, user_id=user_id)
+    
+    # Check channel membership and balance in one read
+    user = await astore.start_state(user_id)
+    
+    if user and user[0] == 1:
+        balance = user[1] if user[1] is not None else (await get_wallet(user_id)).stars
+        text = f"⚡ Welcome back to Pulse Profit!\n\n💰 Balance: {balance} 🟡⭐"
+        await api.send_message(user_id, text, reply_markup=main_menu(user_id))
+    elif await check_channel(user_id):
+        await provision_user(user_id, username, first_name)
+        text = f"⚡ Welcome to Pulse Profit!\n\n💰 Balance: 0 🟡⭐"
+        await api.send_message(user_id, text, reply_markup=main_menu(user_id))
+    else:
+        text = f"""
+🔒 CHANNEL REQUIRED
+
+Please join our channel first:
+
+📢 {REQUIRED_CHANNEL}
+🔗 {CHANNEL_LINK}
+
+After joining, click the button below.
+"""
+        markup = InlineKeyboardMarkup()
+        markup.row(
+            InlineKeyboardButton("📢 JOIN", url=CHANNEL_LINK),
+            InlineKeyboardButton("✅ VERIFY", callback_data="verify_channel")
+        )
+        await api.send_message(user_id, text, reply_markup=markup)
+
+# ================= VERIFY CHANNEL =================
+@callback_router.route("verify_channel")
+async def verify_channel_callback(call):
+    user_id = call.from_user.id
+    if await check_channel(user_id):
+        await provision_user(user_id, call.from_user.username, call.from_user.first_name)
+        await api.answer_callback_query(call.id, "✅ Verified!")
+        text = f"⚡ Welcome to Pulse Profit!\n\n💰 Balance: 0 🟡⭐"
+        await api.edit_message_text(text, call.message.chat.id, call.message.message_id, reply_markup=main_menu(user_id))
+    else:
+        await api.answer_callback_query(call.id, "❌ You haven't joined yet!", show_alert=True)
+
+# ================= EARN STARS =================
+@callback_router.route("earn")
+@serialized_per_user
+async def earn_callback(call):
+    user_id = call.from_user.id
+    
+    if not await astore.has_joined(user_id):
+        await verify_channel_callback(call)
         return
     
-    cooldown = check_cooldown(user_id, "earn", COOLDOWN_TIME)
+    cooldown = await check_cooldown(user_id, "earn", COOLDOWN_TIME)
     if cooldown > 0:
-        bot.answer_callback_query(call.id, f"⏳ Wait {cooldown}s", show_alert=True)
+        await api.answer_callback_query(call.id, f"⏳ Wait {cooldown}s", show_alert=True)
         return
     
     reward = random.randint(1, 3)
-    cursor.execute("UPDATE users_wallet SET stars = stars + ?, total_earned = total_earned + ?, tasks_done = tasks_done + 1 WHERE user_id=?", 
-                   (reward, reward, user_id))
-    conn.commit()
-    log_action(user_id, "earn")
-    
-    wallet = get_wallet(user_id)
-    bot.answer_callback_query(call.id, f"✅ +{reward} 🟡⭐")
-    bot.edit_message_text(f"✅ You earned {reward} 🟡⭐\n\n💰 New balance: {wallet[1]} 🟡⭐", 
+    balance = await astore.earn(user_id, reward)
+    
+    await api.answer_callback_query(call.id, f"✅ +{reward} 🟡⭐")
+    await api.edit_message_text(f"✅ You earned {reward} 🟡⭐\n\n💰 New balance: {balance} 🟡⭐", 
                          call.message.chat.id, call.message.message_id, reply_markup=main_menu(user_id))
 
 # ================= PROFILE =================
-@bot.callback_query_handler(func=lambda c: c.data == "profile")
-def profile_callback(call):
+@callback_router.route("profile")
+async def profile_callback(call):
     user_id = call.from_user.id
-    wallet = get_wallet(user_id)
-    name = get_user_name(user_id)
+    wallet = await get_wallet(user_id)
+    name = await get_user_name(user_id)
     
     text = f"""
 👤 PROFILE
 
 User: {name}
-Balance: {wallet[1]} 🟡⭐
-Total Earned: {wallet[2]} 🟡⭐
-Referrals: {wallet[3]}
-Tasks Done: {wallet[5]}
-Premium: {'✅' if wallet[4] else '❌'}
-Daily Withdrawn: {wallet[6]}/{MAX_DAILY_WITHDRAW}
+Balance: {wallet.stars} 🟡⭐
+Total Earned: {wallet.total_earned} 🟡⭐
+Referrals: {wallet.referrals}
+Tasks Done: {wallet.tasks_done}
+Premium: {'✅' if wallet.premium else '❌'}
+Daily Withdrawn: {wallet.daily_withdrawn}/{MAX_DAILY_WITHDRAW}
 """
-    bot.edit_message_text(text, call.message.chat.id, call.message.message_id, reply_markup=main_menu(user_id))
+    await api.edit_message_text(text, call.message.chat.id, call.message.message_id, reply_markup=main_menu(user_id))
 
 # ================= LEADERBOARD =================
-@bot.callback_query_handler(func=lambda c: c.data == "leaderboard")
-def leaderboard_callback(call):
-    placeholders = ','.join('?' * len(ADMIN_IDS))
-    cursor.execute(f"SELECT user_id, stars FROM users_wallet WHERE user_id NOT IN ({placeholders}) ORDER BY stars DESC LIMIT 10", ADMIN_IDS)
-    top = cursor.fetchall()
+@callback_router.route("leaderboard")
+async def leaderboard_callback(call):
+    db = replica.store()
+    top = await offload(db.leaderboard, 10)
     
     text = "🏆 LEADERBOARD\n\n"
     if top:
         for i, (uid, stars) in enumerate(top, 1):
-            name = get_user_name(uid)
+            name = await get_user_name(uid)
             text += f"{i}. {name[:20]} - {stars} 🟡⭐\n"
     else:
         text += "No users yet.\n"
     
-    cursor.execute(f"SELECT COUNT(*) FROM users_wallet WHERE user_id NOT IN ({placeholders})", ADMIN_IDS)
-    total = cursor.fetchone()[0]
-    cursor.execute(f"SELECT SUM(stars) FROM users_wallet WHERE user_id NOT IN ({placeholders})", ADMIN_IDS)
-    total_stars = cursor.fetchone()[0] or 0
+    total, total_stars = await offload(db.user_totals)
     
     text += f"\nTotal Users: {total}\nTotal Stars: {total_stars} 🟡⭐"
     
-    bot.edit_message_text(text, call.message.chat.id, call.message.message_id, reply_markup=main_menu(call.from_user.id))
+    await api.edit_message_text(text, call.message.chat.id, call.message.message_id, reply_markup=main_menu(call.from_user.id))
 
 # ================= REFERRAL =================
-@bot.callback_query_handler(func=lambda c: c.data == "refer")
-def refer_callback(call):
+@callback_router.route("refer")
+async def refer_callback(call):
     user_id = call.from_user.id
-    bot_name = bot.get_me().username
+    bot_name = (await api.get_me()).username
     link = f"https://t.me/{bot_name}?start={user_id}"
     
     text = f"""
 📨 REFER & EARN
 
-Your referrals: {get_wallet(user_id)[3]}
+Your referrals: {(await get_wallet(user_id)).referrals}
 
 Earn 5 🟡⭐ per referral!
 
 Your link:
 `{link}`
 """
-    bot.edit_message_text(text, call.message.chat.id, call.message.message_id, reply_markup=main_menu(user_id))
+    await api.edit_message_text(text, call.message.chat.id, call.message.message_id, reply_markup=main_menu(user_id))
 
 # ================= PREMIUM WITH GUIDE =================
-@bot.callback_query_handler(func=lambda c: c.data == "premium")
-def premium_callback(call):
+@callback_router.route("premium")
+async def premium_callback(call):
     user_id = call.from_user.id
-    wallet = get_wallet(user_id)
+    wallet = await get_limits(user_id)
     
-    if wallet[4] == 1:
+    if wallet.premium == 1:
         text = "💎 PREMIUM ACTIVE\n\nYou have premium access!"
         markup = InlineKeyboardMarkup()
         markup.row(InlineKeyboardButton("🔙 BACK", callback_data="back"))
     else:
-        cursor.execute("SELECT id FROM premium_requests WHERE user_id=? AND status='pending'", (user_id,))
-        existing_request = cursor.fetchone()
-        
-        if existing_request:
+        if await astore.has_pending_premium(user_id):
             text = "⏳ Your premium request is pending admin approval."
             markup = InlineKeyboardMarkup()
             markup.row(InlineKeyboardButton("🔙 BACK", callback_data="back"))
@@ -592,45 +2288,23 @@ Follow these steps to get premium access:
             )
             markup.row(InlineKeyboardButton("🔙 BACK", callback_data="back"))
     
-    bot.edit_message_text(text, call.message.chat.id, call.message.message_id, reply_markup=markup, parse_mode="Markdown")
+    await api.edit_message_text(text, call.message.chat.id, call.message.message_id, reply_markup=markup, parse_mode="Markdown")
 
 # ================= REQUEST PREMIUM =================
-@bot.callback_query_handler(func=lambda c: c.data == "request_premium")
-def request_premium_callback(call):
+@callback_router.route("request_premium")
+@serialized_per_user
+async def request_premium_callback(call):
     user_id = call.from_user.id
-    user_name = get_user_name(user_id)
     
-    cursor.execute("SELECT id FROM premium_requests WHERE user_id=? AND status='pending'", (user_id,))
-    if cursor.fetchone():
-        bot.answer_callback_query(call.id, "You already have a pending request!", show_alert=True)
+    if await astore.has_pending_premium(user_id):
+        await api.answer_callback_query(call.id, "You already have a pending request!", show_alert=True)
         return
     
-    cursor.execute("INSERT INTO premium_requests (user_id) VALUES (?)", (user_id,))
-    conn.commit()
-    
-    # Notify all admins
-    for admin_id in ADMIN_IDS:
-        try:
-            admin_text = f"""
-🔔 **NEW PREMIUM REQUEST** 🔔
-
-━━━━━━━━━━━━━━━━━━━━━
-👤 **User:** {user_name}
-🆔 **ID:** `{user_id}`
-━━━━━━━━━━━━━━━━━━━━━
-
-✅ **To APPROVE:**
-`/approve_premium {user_id}`
-
-❌ **To REJECT:**
-`/reject_premium {user_id}`
-━━━━━━━━━━━━━━━━━━━━━
-"""
-            bot.send_message(admin_id, admin_text, parse_mode="Markdown")
-        except:
-            pass
+    await astore.request_premium(user_id)
+    notifier.notify("premium", admin_event(call.from_user, "premium",
+                                           [f"/approve_premium {user_id}", f"/reject_premium {user_id}"]))
     
-    bot.answer_callback_query(call.id, "✅ Request sent to admins!", show_alert=True)
+    await api.answer_callback_query(call.id, "✅ Request sent to admins!", show_alert=True)
     text = f"""
 ✅ **PREMIUM REQUEST SENT**
 
@@ -642,38 +2316,29 @@ You will be notified once your request is processed.
 ⏱️ **Estimated response time:** 5-30 minutes
 ━━━━━━━━━━━━━━━━━━━━━
 """
-    bot.edit_message_text(text, call.message.chat.id, call.message.message_id, reply_markup=main_menu(user_id), parse_mode="Markdown")
+    await api.edit_message_text(text, call.message.chat.id, call.message.message_id, reply_markup=main_menu(user_id), parse_mode="Markdown")
 
 # ================= APPROVE PREMIUM COMMAND =================
 @bot.message_handler(commands=['approve_premium'])
-def approve_premium(message):
+async def approve_premium(message):
     admin_id = message.from_user.id
     if not is_admin(admin_id):
-        bot.reply_to(message, "❌ You are not authorized to use this command.")
+        await api.reply_to(message, "❌ You are not authorized to use this command.")
         return
     
     try:
         parts = message.text.split()
         if len(parts) < 2:
-            bot.reply_to(message, "❌ Usage: /approve_premium [user_id]")
+            await api.reply_to(message, "❌ Usage: /approve_premium [user_id]")
             return
         
         target_user = int(parts[1])
         
-        # Check if request exists
-        cursor.execute("SELECT id FROM premium_requests WHERE user_id=? AND status='pending'", (target_user,))
-        request = cursor.fetchone()
-        
-        if not request:
-            bot.reply_to(message, f"❌ No pending premium request found for user {target_user}")
+        if not await astore.approve_premium(target_user):
+            await api.reply_to(message, f"❌ No pending premium request found for user {target_user}")
             return
         
-        # Update premium status
-        cursor.execute("UPDATE users_wallet SET premium=1 WHERE user_id=?", (target_user,))
-        cursor.execute("UPDATE premium_requests SET status='approved' WHERE user_id=? AND status='pending'", (target_user,))
-        conn.commit()
-        
-        bot.reply_to(message, f"✅ Premium approved for user {target_user}!")
+        await api.reply_to(message, f"✅ Premium approved for user {target_user}!")
         
         # Notify user
         try:
@@ -695,48 +2360,40 @@ Your premium request has been **APPROVED** by an admin!
 
 Thank you for being a premium member! 🎉
 """
-            bot.send_message(target_user, user_text, parse_mode="Markdown")
-        except:
-            pass
+            await api.send_message(target_user, user_text, parse_mode="Markdown")
+        except Exception as e:
+            log.error("notify", "user_message_failed", e, user_id=target_user)
         
         # Log the action
         if GITHUB_TOKEN and GITHUB_REPO:
             threading.Thread(target=backup_to_github, args=("premium_approved", f"User {target_user} approved by admin {admin_id}"), daemon=True).start()
             
     except ValueError:
-        bot.reply_to(message, "❌ Invalid user ID format. Please provide a valid numeric ID.")
+        await api.reply_to(message, "❌ Invalid user ID format. Please provide a valid numeric ID.")
     except Exception as e:
-        bot.reply_to(message, f"❌ Error: {str(e)}")
+        await api.reply_to(message, f"❌ Error: {str(e)}")
 
 # ================= REJECT PREMIUM COMMAND =================
 @bot.message_handler(commands=['reject_premium'])
-def reject_premium(message):
+async def reject_premium(message):
     admin_id = message.from_user.id
     if not is_admin(admin_id):
-        bot.reply_to(message, "❌ You are not authorized to use this command.")
+        await api.reply_to(message, "❌ You are not authorized to use this command.")
         return
     
     try:
         parts = message.text.split()
         if len(parts) < 2:
-            bot.reply_to(message, "❌ Usage: /reject_premium [user_id]")
+            await api.reply_to(message, "❌ Usage: /reject_premium [user_id]")
             return
         
         target_user = int(parts[1])
         
-        # Check if request exists
-        cursor.execute("SELECT id FROM premium_requests WHERE user_id=? AND status='pending'", (target_user,))
-        request = cursor.fetchone()
-        
-        if not request:
-            bot.reply_to(message, f"❌ No pending premium request found for user {target_user}")
+        if not await astore.reject_premium(target_user):
+            await api.reply_to(message, f"❌ No pending premium request found for user {target_user}")
             return
         
-        # Update request status
-        cursor.execute("UPDATE premium_requests SET status='rejected' WHERE user_id=? AND status='pending'", (target_user,))
-        conn.commit()
-        
-        bot.reply_to(message, f"❌ Premium rejected for user {target_user}!")
+        await api.reply_to(message, f"❌ Premium rejected for user {target_user}!")
         
         # Notify user
         try:
@@ -757,109 +2414,333 @@ Your premium request has been **REJECTED** by an admin.
 ━━━━━━━━━━━━━━━━━━━━━
 Please contact support if you believe this is an error.
 """
-            bot.send_message(target_user, user_text, parse_mode="Markdown")
-        except:
-            pass
+            await api.send_message(target_user, user_text, parse_mode="Markdown")
+        except Exception as e:
+            log.error("notify", "user_message_failed", e, user_id=target_user)
         
     except ValueError:
-        bot.reply_to(message, "❌ Invalid user ID format. Please provide a valid numeric ID.")
+        await api.reply_to(message, "❌ Invalid user ID format. Please provide a valid numeric ID.")
     except Exception as e:
-        bot.reply_to(message, f"❌ Error: {str(e)}")
+        await api.reply_to(message, f"❌ Error: {str(e)}")
 
 # ================= BUY STARS =================
-@bot.callback_query_handler(func=lambda c: c.data == "buy_menu")
-def buy_menu_callback(call):
+INVOICE_LINK_RETRY = 300  # seconds before packages without a link are tried again
+
+def package_invoice(stars, price):
+    """Invoice fields shared by a package's reusable link and its send_invoice fallback."""
+    return {"title": "Pulse Profit", "description": f"Buy {stars} 🟡⭐ stars", "provider_token": "",
+            "currency": "XTR", "prices": [LabeledPrice(label=f"{stars} Stars", amount=price)]}
+
+class InvoiceLinks:
+    """One createInvoiceLink per star package, reused for every buyer.
+
+    The payload only names the package (the payer arrives with the payment), so a link can be shared;
+    invoices whose payload is per user, like withdrawals, still go through send_invoice.
+    Links are keyed by (stars, price), so a package whose price changes gets a new one."""
+
+    def __init__(self):
+        self.links = {}
+        self.lock = threading.Lock()
+        self.refreshing = False
+        self.last_attempt = 0
+
+    def get(self, stars):
+        return self.links.get((stars, STAR_PACKAGES[stars]))
+
+    def refresh(self):
+        """Create links for packages that lack one. Returns how many were created."""
+        created = 0
+        try:
+            for stars, price in list(STAR_PACKAGES.items()):
+                if (stars, price) in self.links:
+                    continue
+                try:
+                    self.links[(stars, price)] = bot.create_invoice_link(payload=f"buy_{stars}", **package_invoice(stars, price))
+                    created += 1
+                    metrics.inc("bot_invoice_links_created_total")
+                except Exception as e:
+                    log.error("payments", "invoice_link_failed", e, stars=stars)
+        finally:
+            with self.lock:
+                self.refreshing = False
+        return created
+
+    def ensure(self):
+        """Start a background refresh if a package has no link and the last attempt is old enough."""
+        if all((stars, price) in self.links for stars, price in STAR_PACKAGES.items()):
+            return
+        with self.lock:
+            if self.refreshing or time.monotonic() - self.last_attempt < INVOICE_LINK_RETRY:
+                return
+            self.refreshing = True
+            self.last_attempt = time.monotonic()
+        threading.Thread(target=self.refresh, daemon=True).start()
+
+invoice_links = InvoiceLinks()
+invoice_links.ensure()
+
+@callback_router.route("buy_menu")
+async def buy_menu_callback(call):
     text = "🟡 BUY STARS\n\nChoose a package:"
     markup = InlineKeyboardMarkup()
     for stars, price in STAR_PACKAGES.items():
-        markup.row(InlineKeyboardButton(f"{stars} Stars - {price} ⭐️", callback_data=f"buy_{stars}"))
+        label = f"{stars} Stars - {price} ⭐️"
+        link = invoice_links.get(stars)
+        # Opening a link shows the invoice without a round trip through the bot
+        markup.row(InlineKeyboardButton(label, url=link) if link else InlineKeyboardButton(label, callback_data=f"buy_{stars}"))
     markup.row(InlineKeyboardButton("🔙 BACK", callback_data="back"))
-    bot.edit_message_text(text, call.message.chat.id, call.message.message_id, reply_markup=markup)
-
-@bot.callback_query_handler(func=lambda c: c.data.startswith("buy_"))
-def buy_callback(call):
-    stars = call.data.split("_")[1]
-    price = STAR_PACKAGES[stars]
-    
-    prices = [LabeledPrice(label=f"{stars} Stars", amount=price)]
-    bot.send_invoice(
-        call.message.chat.id,
-        title="Pulse Profit",
-        description=f"Buy {stars} 🟡⭐ stars",
-        invoice_payload=f"buy_{stars}",
-        provider_token="",
-        currency="XTR",
-        prices=prices,
-        start_parameter="buy"
-    )
+    await api.edit_message_text(text, call.message.chat.id, call.message.message_id, reply_markup=markup)
+    invoice_links.ensure()
+
+@callback_router.route("buy_{stars}")
+async def buy_callback(call, stars):
+    """Fallback while a package has no invoice link yet."""
+    if stars not in STAR_PACKAGES:
+        return
+    metrics.inc("bot_invoice_fallback_total")
+    await api.send_invoice(call.message.chat.id, invoice_payload=f"buy_{stars}", start_parameter="buy",
+                           **package_invoice(stars, STAR_PACKAGES[stars]))
+
+def checkout_error(q):
+    """Why a checkout must be refused, decided from the payload and STAR_PACKAGES without touching the database."""
+    kind, _, value = q.invoice_payload.partition("_")
+    if q.currency != "XTR":
+        return "This currency is not accepted."
+    if kind == "buy":
+        if value not in STAR_PACKAGES:
+            return "This package is no longer available."
+        if q.total_amount != STAR_PACKAGES[value]:
+            return "This package's price has changed. Please open the buy menu again."
+        return None
+    if kind == "withdraw" and value.isdigit():
+        return None
+    return "This invoice is not valid."
 
 @bot.pre_checkout_query_handler(func=lambda q: True)
-def pre_checkout(q):
-    bot.answer_pre_checkout_query(q.id, ok=True)
+async def pre_checkout(q):
+    error = checkout_error(q)
+    if error:
+        metrics.inc("bot_checkouts_rejected_total")
+    await api.answer_pre_checkout_query(q.id, ok=not error, error_message=error)
+
+def payload_stars(payload):
+    """Stars a payment credits: the package size for buy_<stars>, nothing for withdrawal invoices."""
+    kind, _, value = (payload or "").partition("_")
+    if kind == "buy" and value.isdigit():
+        return int(value)
+    if kind == "withdraw":
+        return 0
+    return None
 
 @bot.message_handler(content_types=['successful_payment'])
-def payment_success(message):
-    payload = message.successful_payment.invoice_payload
-    stars = int(payload.split("_")[1])
-    add_stars(message.from_user.id, stars)
-    bot.send_message(message.chat.id, f"✅ Payment successful! +{stars} 🟡⭐", reply_markup=main_menu(message.from_user.id))
+async def payment_success(message):
+    payment = message.successful_payment
+    user_id = message.from_user.id
+    stars = payload_stars(payment.invoice_payload)
+    if stars is None:
+        log.error("payments", "unknown_payload", payload=payment.invoice_payload, charge_id=payment.telegram_payment_charge_id)
+        return
+    # Keyed by the charge id, so a redelivered update (webhook retry, polling replay) never credits twice
+    recorded, _ = await astore.record_payment(payment.telegram_payment_charge_id, user_id,
+                                              payment.invoice_payload, payment.total_amount, stars)
+    if not recorded:
+        metrics.inc("bot_payments_duplicate_total")
+        return
+    metrics.inc("bot_payments_total", (("kind", "buy" if stars else "withdraw"),))
+    if stars:
+        await api.send_message(message.chat.id, f"✅ Payment successful! +{stars} 🟡⭐", reply_markup=main_menu(user_id))
 
-# ================= REDEEM CODE =================
-@bot.callback_query_handler(func=lambda c: c.data == "redeem_menu")
-def redeem_menu_callback(call):
-    user_id = call.from_user.id
-    text = "🎫 REDEEM CODE\n\nEnter your code:"
-    cursor.execute("INSERT OR REPLACE INTO user_actions (user_id, action_type, action_time) VALUES (?,?,?)",
-                   (user_id, "awaiting_code", datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
-    conn.commit()
-    bot.edit_message_text(text, call.message.chat.id, call.message.message_id)
+# ================= PAYMENT RECONCILIATION =================
+RECONCILE_INTERVAL = int(os.getenv("RECONCILE_INTERVAL", "3600"))  # seconds, 0 disables the job
+RECONCILE_WINDOW = 7 * 86400  # how far back each run compares
+RECONCILE_PAGE = 100          # getStarTransactions maximum
+RECONCILE_SHOWN = 10          # mismatches listed per kind in a report
 
-# ================= WITHDRAWAL =================
-@bot.callback_query_handler(func=lambda c: c.data == "withdraw_menu")
-def withdraw_menu_callback(call):
-    user_id = call.from_user.id
-    wallet = get_wallet(user_id)
-    
-    text = f"""
-💳 WITHDRAWAL
+reconcile_lock = threading.Lock()
+reconcile_report = None
 
-Balance: {wallet[1]} 🟡⭐
-Daily: {wallet[6]}/{MAX_DAILY_WITHDRAW}
+def bot_star_transactions(offset, limit):
+    """One page of the bot's Star transactions from the Bot API, newest first."""
+    result = apihelper._make_request(TOKEN, "getStarTransactions", params={"offset": offset, "limit": limit})
+    return result.get("transactions") or []
 
-⭐ Stars Withdrawal (1:1) - Automatic
-Minimum: {MIN_WITHDRAW}
+def star_transaction_pages(since, fetch=bot_star_transactions):
+    """Yield pages from `fetch(offset, limit)` until one reaches past `since`."""
+    offset = 0
+    while True:
+        page = fetch(offset, RECONCILE_PAGE)
+        yield page
+        if len(page) < RECONCILE_PAGE or min(tx["date"] for tx in page) < since:
+            return
+        offset += len(page)
+
+def diff_transactions(page, since):
+    """Compare one page with the payments table in a single lookup. Returns (seen ids, [(kind, tx, record)])."""
+    incoming = {}
+    refunds = {}
+    for tx in page:
+        if tx["date"] < since:
+            continue
+        if (tx.get("source") or {}).get("type") == "user":
+            incoming[tx["id"]] = tx
+        elif (tx.get("receiver") or {}).get("type") == "user":
+            # A refund reuses the charge id of the payment it returns
+            refunds[tx["id"]] = tx
+    records = store.payments_by_charge(list(incoming.keys() | refunds.keys()))
+    found = []
+    for charge_id, tx in incoming.items():
+        record = records.get(charge_id)
+        if record is None:
+            found.append(("missing", tx, None))
+        elif record[1] != tx["amount"]:
+            found.append(("amount_mismatch", tx, record))
+    for charge_id, tx in refunds.items():
+        record = records.get(charge_id)
+        if record and record[2] == "credited":
+            found.append(("refunded", tx, record))
+    return incoming.keys(), found
+
+def repair_mismatch(kind, tx):
+    """Apply the fix for one mismatch kind. Returns True when something changed."""
+    if kind == "missing":
+        source = tx["source"]
+        payload = source.get("invoice_payload")
+        stars = payload_stars(payload)
+        if stars is None or "user" not in source:
+            return False
+        recorded, _ = store.record_payment(tx["id"], source["user"]["id"], payload, tx["amount"], stars)
+        return recorded
+    if kind == "refunded":
+        # Only the record changes: taking back stars that may already be spent is left to an admin
+        return store.mark_payment_refunded(tx["id"])
+    return False
+
+def reconcile_payments(repair=False, fetch=bot_star_transactions):
+    """Diff the last RECONCILE_WINDOW of Telegram Star transactions against the payments table.
+
+    Incoming payments Telegram has but the table lacks are credited when `repair` is set; amount
+    mismatches and payments Telegram does not list are only reported. `fetch(offset, limit)` supplies
+    the transactions (the Bot API by default, a list in bench.py --reconcile). Returns the report."""
+    global reconcile_report
+    with reconcile_lock:
+        started = now_epoch()
+        since = started - RECONCILE_WINDOW
+        seen = set()
+        found = defaultdict(list)
+        repaired = defaultdict(int)
+        scanned = 0
+        for page in star_transaction_pages(since, fetch):
+            scanned += sum(1 for tx in page if tx["date"] >= since)
+            ids, mismatches = diff_transactions(page, since)
+            seen.update(ids)
+            for kind, tx, record in mismatches:
+                user_id = record[0] if record else (tx.get("source") or tx.get("receiver") or {}).get("user", {}).get("id")
+                found[kind].append((tx["id"], user_id, tx["amount"]))
+                if repair and repair_mismatch(kind, tx):
+                    repaired[kind] += 1
+        # Recorded here but absent from Telegram's list for the same period
+        for charge_id in store.payments_since(since, started):
+            if charge_id not in seen:
+                found["orphan"].append((charge_id, None, None))
+        for kind, items in found.items():
+            metrics.inc("bot_payments_mismatches_total", (("kind", kind),), len(items))
+        for kind, count in repaired.items():
+            metrics.inc("bot_payments_repaired_total", (("kind", kind),), count)
+        reconcile_report = {
+            "scanned": scanned,
+            "found": dict(found),
+            "repaired": dict(repaired),
+            "finished_at": now_epoch(),
+        }
+        log.event("payments", "reconciled", scanned=scanned, repaired=dict(repaired),
+                  found={kind: len(items) for kind, items in found.items()})
+        return reconcile_report
+
+def format_reconcile_report(report):
+    lines = [f"💰 <b>Payment reconciliation</b> ({epoch_text(report['finished_at'], '%Y-%m-%d %H:%M')})\n",
+             f"Checked {report['scanned']:,} Star transactions from the last {RECONCILE_WINDOW // 86400} days."]
+    if not report["found"]:
+        lines.append("✅ Everything matches.")
+    for kind, items in report["found"].items():
+        repaired = report["repaired"].get(kind, 0)
+        lines.append(f"\n• <b>{kind}</b>: {len(items)}" + (f" ({repaired} repaired)" if repaired else ""))
+        for charge_id, user_id, amount in items[:RECONCILE_SHOWN]:
+            lines.append(f"  <code>{html.escape(charge_id)}</code>" + (f" user {user_id}" if user_id else "")
+                         + (f" {amount}⭐" if amount is not None else ""))
+        if len(items) > RECONCILE_SHOWN:
+            lines.append(f"  …and {len(items) - RECONCILE_SHOWN} more")
+    return "\n".join(lines)
+
+def reconcile_loop():
+    while True:
+        time.sleep(RECONCILE_INTERVAL)
+        # One instance reports per interval
+        if not store.claim_job("reconcile_payments", RECONCILE_INTERVAL - 60):
+            continue
+        try:
+            report = reconcile_payments()
+            if report["found"]:
+                notifier.notify("payments", format_reconcile_report(report), urgent=True)
+        except Exception as e:
+            log.error("payments", "reconcile_failed", e)
+
+if RECONCILE_INTERVAL > 0:
+    threading.Thread(target=reconcile_loop, daemon=True).start()
+
+# ================= REDEEM CODE =================
+@callback_router.route("redeem_menu")
+async def redeem_menu_callback(call):
+    user_id = call.from_user.id
+    text = "🎫 REDEEM CODE\n\nEnter your code:"
+    await flows.set(user_id, "awaiting_code")
+    await api.edit_message_text(text, call.message.chat.id, call.message.message_id)
+
+# ================= WITHDRAWAL =================
+@callback_router.route("withdraw_menu")
+async def withdraw_menu_callback(call):
+    user_id = call.from_user.id
+    wallet = await get_limits(user_id)
+    
+    text = f"""
+💳 WITHDRAWAL
+
+Balance: {wallet.stars} 🟡⭐
+Daily: {wallet.daily_withdrawn}/{MAX_DAILY_WITHDRAW}
+
+⭐ Stars Withdrawal (1:1) - Automatic
+Minimum: {MIN_WITHDRAW}
 
 💼 Admin Withdrawal - Manual approval
 """
     markup = InlineKeyboardMarkup()
     markup.row(InlineKeyboardButton("⭐ AUTO WITHDRAW", callback_data="withdraw_stars"))
-    if wallet[4] == 1 or is_admin(user_id):
+    if wallet.premium == 1 or is_admin(user_id):
         markup.row(InlineKeyboardButton("💼 ADMIN WITHDRAW", callback_data="withdraw_admin_menu"))
     markup.row(InlineKeyboardButton("🔙 BACK", callback_data="back"))
     
-    bot.edit_message_text(text, call.message.chat.id, call.message.message_id, reply_markup=markup)
+    await api.edit_message_text(text, call.message.chat.id, call.message.message_id, reply_markup=markup)
 
 # ===== AUTO WITHDRAW (Stars) =====
-@bot.callback_query_handler(func=lambda c: c.data == "withdraw_stars")
-def withdraw_stars_callback(call):
+@callback_router.route("withdraw_stars")
+async def withdraw_stars_callback(call):
     user_id = call.from_user.id
-    wallet = get_wallet(user_id)
+    balance = await get_balance(user_id)
     
-    if wallet[1] < MIN_WITHDRAW:
-        bot.answer_callback_query(call.id, f"❌ Need {MIN_WITHDRAW} 🟡⭐", show_alert=True)
+    if balance < MIN_WITHDRAW:
+        await api.answer_callback_query(call.id, f"❌ Need {MIN_WITHDRAW} 🟡⭐", show_alert=True)
         return
     
-    cooldown = check_cooldown(user_id, "withdraw", WITHDRAWAL_COOLDOWN)
+    cooldown = await check_cooldown(user_id, "withdraw", WITHDRAWAL_COOLDOWN)
     if cooldown > 0:
-        bot.answer_callback_query(call.id, f"⏳ Wait {cooldown}s", show_alert=True)
+        await api.answer_callback_query(call.id, f"⏳ Wait {cooldown}s", show_alert=True)
         return
     
     presets = [50, 100, 200, 500]
-    text = f"⭐ Choose amount (balance: {wallet[1]} 🟡⭐):"
+    text = f"⭐ Choose amount (balance: {balance} 🟡⭐):"
     markup = InlineKeyboardMarkup()
     row = []
     for amt in presets:
-        if amt <= wallet[1]:
+        if amt <= balance:
             row.append(InlineKeyboardButton(f"{amt}", callback_data=f"withdraw_auto_{amt}"))
             if len(row) == 2:
                 markup.row(*row)
@@ -869,58 +2750,59 @@ def withdraw_stars_callback(call):
     markup.row(InlineKeyboardButton("✏️ CUSTOM", callback_data="withdraw_auto_custom"))
     markup.row(InlineKeyboardButton("🔙 BACK", callback_data="withdraw_menu"))
     
-    bot.edit_message_text(text, call.message.chat.id, call.message.message_id, reply_markup=markup)
+    await api.edit_message_text(text, call.message.chat.id, call.message.message_id, reply_markup=markup)
 
-@bot.callback_query_handler(func=lambda c: c.data.startswith("withdraw_auto_"))
-def withdraw_auto_amount_callback(call):
-    if call.data == "withdraw_auto_custom":
-        user_id = call.from_user.id
-        cursor.execute("INSERT OR REPLACE INTO user_actions (user_id, action_type) VALUES (?,?)", (user_id, "awaiting_auto_withdraw"))
-        conn.commit()
-        bot.edit_message_text("💰 Enter amount:", call.message.chat.id, call.message.message_id)
-        return
-    
-    amount = int(call.data.replace("withdraw_auto_", ""))
+@callback_router.route("withdraw_auto_custom")
+async def withdraw_auto_custom_callback(call):
+    user_id = call.from_user.id
+    await flows.set(user_id, "awaiting_auto_withdraw")
+    await api.edit_message_text("💰 Enter amount:", call.message.chat.id, call.message.message_id)
+
+@callback_router.route("withdraw_auto_{amount}", int)
+@serialized_per_user
+async def withdraw_auto_amount_callback(call, amount):
     user_id = call.from_user.id
-    wallet = get_wallet(user_id)
+    wallet = await get_limits(user_id)
     
-    if amount > wallet[1]:
-        bot.answer_callback_query(call.id, "❌ Insufficient balance!", show_alert=True)
+    if amount > wallet.stars:
+        await api.answer_callback_query(call.id, "❌ Insufficient balance!", show_alert=True)
         return
     
-    if not is_admin(user_id) and wallet[6] + amount > MAX_DAILY_WITHDRAW:
-        bot.answer_callback_query(call.id, "❌ Daily limit exceeded!", show_alert=True)
+    if not is_admin(user_id) and wallet.daily_withdrawn + amount > MAX_DAILY_WITHDRAW:
+        await api.answer_callback_query(call.id, "❌ Daily limit exceeded!", show_alert=True)
         return
     
-    log_action(user_id, "withdraw")
-    cursor.execute("INSERT INTO withdraw_requests (user_id, amount, withdrawal_type) VALUES (?,?,'stars')", (user_id, amount))
-    cursor.execute("UPDATE users_wallet SET daily_withdrawn = daily_withdrawn + ? WHERE user_id=?", (amount, user_id))
-    conn.commit()
+    await astore.request_withdrawal(user_id, amount, "stars")
     
-    bot.answer_callback_query(call.id, f"✅ Requested {amount} ⭐️")
-    bot.edit_message_text(f"✅ Auto withdrawal requested! {amount} ⭐️ will be sent soon.",
+    await api.answer_callback_query(call.id, f"✅ Requested {amount} ⭐️")
+    await api.edit_message_text(f"✅ Auto withdrawal requested! {amount} ⭐️ will be sent soon.",
                          call.message.chat.id, call.message.message_id, reply_markup=main_menu(user_id))
 
 # ===== ADMIN WITHDRAW (Manual approval) =====
-@bot.callback_query_handler(func=lambda c: c.data == "withdraw_admin_menu")
-def withdraw_admin_menu_callback(call):
+def notify_admin_withdrawal(user, amount):
+    notifier.notify("withdrawal", admin_event(user, f"{amount} ⭐",
+                                              [f"/approve_withdraw {user.id} {amount}", f"/reject_withdraw {user.id} {amount}"]),
+                    urgent=amount >= NOTIFY_URGENT_WITHDRAWAL)
+
+@callback_router.route("withdraw_admin_menu")
+async def withdraw_admin_menu_callback(call):
     user_id = call.from_user.id
-    wallet = get_wallet(user_id)
+    wallet = await get_limits(user_id)
     
-    if not is_admin(user_id) and wallet[4] == 0:
-        bot.answer_callback_query(call.id, "❌ Premium required!", show_alert=True)
+    if not is_admin(user_id) and wallet.premium == 0:
+        await api.answer_callback_query(call.id, "❌ Premium required!", show_alert=True)
         return
     
-    if wallet[1] < MIN_WITHDRAW:
-        bot.answer_callback_query(call.id, f"❌ Need {MIN_WITHDRAW} 🟡⭐", show_alert=True)
+    if wallet.stars < MIN_WITHDRAW:
+        await api.answer_callback_query(call.id, f"❌ Need {MIN_WITHDRAW} 🟡⭐", show_alert=True)
         return
     
     presets = [50, 100, 200, 500]
-    text = f"💼 Choose amount for admin approval (balance: {wallet[1]} 🟡⭐):"
+    text = f"💼 Choose amount for admin approval (balance: {wallet.stars} 🟡⭐):"
     markup = InlineKeyboardMarkup()
     row = []
     for amt in presets:
-        if amt <= wallet[1]:
+        if amt <= wallet.stars:
             row.append(InlineKeyboardButton(f"{amt}", callback_data=f"withdraw_admin_{amt}"))
             if len(row) == 2:
                 markup.row(*row)
@@ -930,158 +2812,117 @@ def withdraw_admin_menu_callback(call):
     markup.row(InlineKeyboardButton("✏️ CUSTOM", callback_data="withdraw_admin_custom"))
     markup.row(InlineKeyboardButton("🔙 BACK", callback_data="withdraw_menu"))
     
-    bot.edit_message_text(text, call.message.chat.id, call.message.message_id, reply_markup=markup)
+    await api.edit_message_text(text, call.message.chat.id, call.message.message_id, reply_markup=markup)
 
-@bot.callback_query_handler(func=lambda c: c.data.startswith("withdraw_admin_"))
-def withdraw_admin_amount_callback(call):
-    if call.data == "withdraw_admin_custom":
-        user_id = call.from_user.id
-        cursor.execute("INSERT OR REPLACE INTO user_actions (user_id, action_type) VALUES (?,?)", (user_id, "awaiting_admin_withdraw"))
-        conn.commit()
-        bot.edit_message_text("💰 Enter amount for admin approval:", call.message.chat.id, call.message.message_id)
-        return
-    
-    amount = int(call.data.replace("withdraw_admin_", ""))
+@callback_router.route("withdraw_admin_custom")
+async def withdraw_admin_custom_callback(call):
     user_id = call.from_user.id
-    wallet = get_wallet(user_id)
+    await flows.set(user_id, "awaiting_admin_withdraw")
+    await api.edit_message_text("💰 Enter amount for admin approval:", call.message.chat.id, call.message.message_id)
+
+@callback_router.route("withdraw_admin_{amount}", int)
+@serialized_per_user
+async def withdraw_admin_amount_callback(call, amount):
+    user_id = call.from_user.id
+    wallet = await get_limits(user_id)
     
-    if amount > wallet[1]:
-        bot.answer_callback_query(call.id, "❌ Insufficient balance!", show_alert=True)
+    if amount > wallet.stars:
+        await api.answer_callback_query(call.id, "❌ Insufficient balance!", show_alert=True)
         return
     
-    if not is_admin(user_id) and wallet[6] + amount > MAX_DAILY_WITHDRAW:
-        bot.answer_callback_query(call.id, "❌ Daily limit exceeded!", show_alert=True)
+    if not is_admin(user_id) and wallet.daily_withdrawn + amount > MAX_DAILY_WITHDRAW:
+        await api.answer_callback_query(call.id, "❌ Daily limit exceeded!", show_alert=True)
         return
     
-    cursor.execute("INSERT INTO withdraw_requests (user_id, amount, withdrawal_type) VALUES (?,?,'admin')", (user_id, amount))
-    cursor.execute("UPDATE users_wallet SET daily_withdrawn = daily_withdrawn + ? WHERE user_id=?", (amount, user_id))
-    conn.commit()
+    await astore.request_withdrawal(user_id, amount, "admin")
     
-    user_name = get_user_name(user_id)
-    for admin_id in ADMIN_IDS:
-        try:
-            admin_text = f"""
-🔔 NEW ADMIN WITHDRAWAL REQUEST
-
-👤 User: {user_name}
-🆔 ID: `{user_id}`
-💰 Amount: {amount} 🟡⭐
-
-Use:
-/approve_withdraw {user_id} {amount}
-/reject_withdraw {user_id} {amount}
-"""
-            bot.send_message(admin_id, admin_text, parse_mode="Markdown")
-        except:
-            pass
+    notify_admin_withdrawal(call.from_user, amount)
     
-    bot.answer_callback_query(call.id, f"✅ Requested {amount} ⭐️ for admin approval")
-    bot.edit_message_text(f"✅ Admin withdrawal requested! {amount} ⭐️ is pending admin approval.",
+    await api.answer_callback_query(call.id, f"✅ Requested {amount} ⭐️ for admin approval")
+    await api.edit_message_text(f"✅ Admin withdrawal requested! {amount} ⭐️ is pending admin approval.",
                          call.message.chat.id, call.message.message_id, reply_markup=main_menu(user_id))
 
 # ================= APPROVE WITHDRAWAL COMMAND =================
 @bot.message_handler(commands=['approve_withdraw'])
-def approve_withdraw(message):
+async def approve_withdraw(message):
     admin_id = message.from_user.id
     if not is_admin(admin_id):
-        bot.reply_to(message, "❌ You are not authorized to use this command.")
+        await api.reply_to(message, "❌ You are not authorized to use this command.")
         return
     
     try:
         parts = message.text.split()
         if len(parts) < 3:
-            bot.reply_to(message, "❌ Usage: /approve_withdraw [user_id] [amount]")
+            await api.reply_to(message, "❌ Usage: /approve_withdraw [user_id] [amount]")
             return
         
         target_user = int(parts[1])
         amount = int(parts[2])
         
-        cursor.execute("""
-            SELECT id FROM withdraw_requests 
-            WHERE user_id=? AND amount=? AND status='pending' AND withdrawal_type='admin'
-            ORDER BY request_time DESC LIMIT 1
-        """, (target_user, amount))
-        req = cursor.fetchone()
-        
-        if not req:
-            bot.reply_to(message, "❌ No pending request found!")
+        if not await astore.approve_admin_withdrawal(target_user, amount):
+            await api.reply_to(message, "❌ No pending request found!")
             return
         
-        req_id = req[0]
-        
-        cursor.execute("UPDATE withdraw_requests SET status='approved' WHERE id=?", (req_id,))
-        cursor.execute("UPDATE users_wallet SET stars = stars - ? WHERE user_id=?", (amount, target_user))
-        conn.commit()
-        
-        bot.reply_to(message, f"✅ Withdrawal approved for user {target_user} (Amount: {amount}⭐)")
+        await api.reply_to(message, f"✅ Withdrawal approved for user {target_user} (Amount: {amount}⭐)")
         
         try:
-            bot.send_message(target_user, f"✅ Your admin withdrawal of {amount}⭐ has been approved!")
-        except:
-            pass
+            await api.send_message(target_user, f"✅ Your admin withdrawal of {amount}⭐ has been approved!")
+        except Exception as e:
+            log.error("notify", "user_message_failed", e, user_id=target_user)
     except ValueError:
-        bot.reply_to(message, "❌ Invalid user ID or amount format.")
+        await api.reply_to(message, "❌ Invalid user ID or amount format.")
     except Exception as e:
-        bot.reply_to(message, f"❌ Error: {str(e)}")
+        await api.reply_to(message, f"❌ Error: {str(e)}")
 
 # ================= REJECT WITHDRAWAL COMMAND =================
 @bot.message_handler(commands=['reject_withdraw'])
-def reject_withdraw(message):
+async def reject_withdraw(message):
     admin_id = message.from_user.id
     if not is_admin(admin_id):
-        bot.reply_to(message, "❌ You are not authorized to use this command.")
+        await api.reply_to(message, "❌ You are not authorized to use this command.")
         return
     
     try:
         parts = message.text.split()
         if len(parts) < 3:
-            bot.reply_to(message, "❌ Usage: /reject_withdraw [user_id] [amount]")
+            await api.reply_to(message, "❌ Usage: /reject_withdraw [user_id] [amount]")
             return
         
         target_user = int(parts[1])
         amount = int(parts[2])
         
-        cursor.execute("""
-            UPDATE withdraw_requests SET status='rejected' 
-            WHERE user_id=? AND amount=? AND status='pending' AND withdrawal_type='admin'
-        """, (target_user, amount))
-        
-        if cursor.rowcount == 0:
-            bot.reply_to(message, "❌ No pending request found!")
+        # Also refunds the daily withdrawal limit
+        if not await astore.reject_admin_withdrawal(target_user, amount):
+            await api.reply_to(message, "❌ No pending request found!")
             return
         
-        # Refund daily withdrawal limit
-        cursor.execute("UPDATE users_wallet SET daily_withdrawn = daily_withdrawn - ? WHERE user_id=?", (amount, target_user))
-        conn.commit()
-        
-        bot.reply_to(message, f"❌ Withdrawal rejected for user {target_user}")
+        await api.reply_to(message, f"❌ Withdrawal rejected for user {target_user}")
         
         try:
-            bot.send_message(target_user, f"❌ Your admin withdrawal of {amount}⭐ has been rejected.")
-        except:
-            pass
+            await api.send_message(target_user, f"❌ Your admin withdrawal of {amount}⭐ has been rejected.")
+        except Exception as e:
+            log.error("notify", "user_message_failed", e, user_id=target_user)
     except ValueError:
-        bot.reply_to(message, "❌ Invalid user ID or amount format.")
+        await api.reply_to(message, "❌ Invalid user ID or amount format.")
     except Exception as e:
-        bot.reply_to(message, f"❌ Error: {str(e)}")
+        await api.reply_to(message, f"❌ Error: {str(e)}")
 
 # ================= BACK BUTTON =================
-@bot.callback_query_handler(func=lambda c: c.data == "back")
-def back_callback(call):
-    bot.edit_message_text("⚡ Pulse Profit", call.message.chat.id, call.message.message_id, 
+@callback_router.route("back")
+async def back_callback(call):
+    await api.edit_message_text("⚡ Pulse Profit", call.message.chat.id, call.message.message_id, 
                          reply_markup=main_menu(call.from_user.id))
 
 # ================= TASKS DISPLAY =================
-@bot.callback_query_handler(func=lambda c: c.data == "show_tasks")
-def show_tasks_callback(call):
+@callback_router.route("show_tasks")
+async def show_tasks_callback(call):
     user_id = call.from_user.id
     
-    cursor.execute("SELECT id, task_name, reward FROM tasks WHERE active=1")
-    tasks = cursor.fetchall()
+    tasks = await astore.active_tasks()
     
     if not tasks:
         text = "📋 No tasks available at the moment."
-        bot.edit_message_text(text, call.message.chat.id, call.message.message_id, reply_markup=main_menu(user_id))
+        await api.edit_message_text(text, call.message.chat.id, call.message.message_id, reply_markup=main_menu(user_id))
         return
     
     text = "📋 **AVAILABLE TASKS**\n\nClick a task to complete it:\n\n"
@@ -1093,24 +2934,22 @@ def show_tasks_callback(call):
     
     markup.row(InlineKeyboardButton("🔙 BACK", callback_data="back"))
     
-    bot.edit_message_text(text, call.message.chat.id, call.message.message_id, reply_markup=markup, parse_mode="Markdown")
+    await api.edit_message_text(text, call.message.chat.id, call.message.message_id, reply_markup=markup, parse_mode="Markdown")
 
-@bot.callback_query_handler(func=lambda c: c.data.startswith("do_task_"))
-def do_task_callback(call):
+@callback_router.route("do_task_{task_id}", int)
+@serialized_per_user
+async def do_task_callback(call, task_id):
     user_id = call.from_user.id
-    task_id = int(call.data.replace("do_task_", ""))
     
     # Check if user already completed this task
-    cursor.execute("SELECT * FROM user_tasks WHERE user_id=? AND task_id=?", (user_id, task_id))
-    if cursor.fetchone():
-        bot.answer_callback_query(call.id, "You already did this task!", show_alert=True)
+    if await astore.has_task(user_id, task_id):
+        await api.answer_callback_query(call.id, "You already did this task!", show_alert=True)
         return
     
     # Get task details
-    cursor.execute("SELECT task_type, task_data, reward, task_name FROM tasks WHERE id=?", (task_id,))
-    task = cursor.fetchone()
+    task = await astore.get_task(task_id)
     if not task:
-        bot.answer_callback_query(call.id, "Task not found!", show_alert=True)
+        await api.answer_callback_query(call.id, "Task not found!", show_alert=True)
         return
     
     task_type, task_data, reward, task_name = task
@@ -1124,17 +2963,14 @@ def do_task_callback(call):
                 chat_id = "@" + chat_id
             
             # Check membership
-            member = bot.get_chat_member(chat_id, user_id)
+            member = await api.get_chat_member(chat_id, user_id)
             if member.status in ['member', 'administrator', 'creator']:
                 # Complete task
-                cursor.execute("INSERT INTO user_tasks (user_id, task_id, verified) VALUES (?,?,1)", (user_id, task_id))
-                add_stars(user_id, reward)
-                conn.commit()
+                balance = await astore.complete_task(user_id, task_id, reward)
                 
-                bot.answer_callback_query(call.id, f"✅ +{reward}⭐ Task completed!", show_alert=True)
+                await api.answer_callback_query(call.id, f"✅ +{reward}⭐ Task completed!", show_alert=True)
                 
                 # Update message
-                wallet = get_wallet(user_id)
                 text = f"""
 ✅ **TASK COMPLETED!**
 
@@ -1143,48 +2979,27 @@ def do_task_callback(call):
 💰 **Reward:** +{reward}⭐
 
 ━━━━━━━━━━━━━━━━━━━━━
-📊 **New Balance:** {wallet[1]}⭐
+📊 **New Balance:** {balance}⭐
 ━━━━━━━━━━━━━━━━━━━━━
 """
-                bot.edit_message_text(text, call.message.chat.id, call.message.message_id, 
+                await api.edit_message_text(text, call.message.chat.id, call.message.message_id, 
                                      reply_markup=main_menu(user_id), parse_mode="Markdown")
                 
                 # Backup on task completion
                 if GITHUB_TOKEN and GITHUB_REPO:
                     threading.Thread(target=backup_to_github, args=("task_complete", f"User {user_id} completed task {task_id}"), daemon=True).start()
             else:
-                bot.answer_callback_query(call.id, "❌ You haven't joined yet! Please join first.", show_alert=True)
+                await api.answer_callback_query(call.id, "❌ You haven't joined yet! Please join first.", show_alert=True)
         except Exception as e:
-            print(f"Error verifying join: {e}")
-            bot.answer_callback_query(call.id, "❌ Error verifying. Please make sure you've joined and try again.", show_alert=True)
+            log.error("tasks", "verify_join_failed", e, user_id=user_id, task_id=task_id)
+            await api.answer_callback_query(call.id, "❌ Error verifying. Please make sure you've joined and try again.", show_alert=True)
     else:
         # Manual verification needed (visit_link, watch_video)
-        cursor.execute("INSERT INTO user_tasks (user_id, task_id, verified) VALUES (?,?,0)", (user_id, task_id))
-        conn.commit()
+        await astore.submit_task(user_id, task_id)
         
-        # Notify admins
-        user_name = get_user_name(user_id)
-        for admin_id in ADMIN_IDS:
-            try:
-                admin_text = f"""
-🔔 **TASK VERIFICATION NEEDED** 🔔
-
-━━━━━━━━━━━━━━━━━━━━━
-👤 **User:** {user_name}
-🆔 **ID:** `{user_id}`
-📋 **Task:** {task_name}
-💰 **Reward:** {reward}⭐
-━━━━━━━━━━━━━━━━━━━━━
-
-✅ To verify, use:
-`/verify_task {user_id} {task_name}`
-━━━━━━━━━━━━━━━━━━━━━
-"""
-                bot.send_message(admin_id, admin_text, parse_mode="Markdown")
-            except:
-                pass
+        notifier.notify("task", admin_event(call.from_user, f"{task_name} (+{reward}⭐)", [f"/verify_task {user_id} {task_name}"]))
         
-        bot.answer_callback_query(call.id, "✅ Task submitted for verification!", show_alert=True)
+        await api.answer_callback_query(call.id, "✅ Task submitted for verification!", show_alert=True)
         
         text = f"""
 ✅ **TASK SUBMITTED FOR VERIFICATION**
@@ -1198,30 +3013,18 @@ def do_task_callback(call):
 You'll be notified when it's approved.
 ━━━━━━━━━━━━━━━━━━━━━
 """
-        bot.edit_message_text(text, call.message.chat.id, call.message.message_id, 
+        await api.edit_message_text(text, call.message.chat.id, call.message.message_id, 
                              reply_markup=main_menu(user_id), parse_mode="Markdown")
 
 # ================= ADMIN PANEL =================
-@bot.callback_query_handler(func=lambda c: c.data == "admin_panel")
-def admin_panel_callback(call):
+@callback_router.route("admin_panel")
+async def admin_panel_callback(call):
     user_id = call.from_user.id
     if not is_admin(user_id):
-        bot.answer_callback_query(call.id, "❌ Access denied", show_alert=True)
-        return
-    
-    placeholders = ','.join('?' * len(ADMIN_IDS))
-    cursor.execute(f"SELECT COUNT(*) FROM users_wallet WHERE user_id NOT IN ({placeholders})", ADMIN_IDS)
-    users = cursor.fetchone()[0]
-    cursor.execute("SELECT COUNT(*) FROM tasks WHERE active=1")
-    tasks = cursor.fetchone()[0]
-    cursor.execute("SELECT COUNT(*) FROM withdraw_requests WHERE status='pending'")
-    pending_withdrawals = cursor.fetchone()[0]
-    cursor.execute("SELECT COUNT(*) FROM premium_requests WHERE status='pending'")
-    pending_premium = cursor.fetchone()[0]
-    cursor.execute("SELECT COUNT(*) FROM user_tasks WHERE verified=0")
-    verify = cursor.fetchone()[0]
-    cursor.execute("SELECT COUNT(*) FROM redeem_codes WHERE active=1")
-    codes = cursor.fetchone()[0]
+        await api.answer_callback_query(call.id, "❌ Access denied", show_alert=True)
+        return
+    
+    counts = await astore.panel_counts()
     
     text = f"""
 👑 **ADMIN PANEL**
@@ -1229,12 +3032,12 @@ def admin_panel_callback(call):
 ━━━━━━━━━━━━━━━━━━━━━
 📊 **STATISTICS**
 ━━━━━━━━━━━━━━━━━━━━━
-👥 Users: {users}
-📋 Active Tasks: {tasks}
-⏳ Pending Withdrawals: {pending_withdrawals}
-👑 Pending Premium: {pending_premium}
-🔍 Pending Verifications: {verify}
-🎫 Active Codes: {codes}
+👥 Users: {counts['users']}
+📋 Active Tasks: {counts['tasks']}
+⏳ Pending Withdrawals: {counts['withdrawals']}
+👑 Pending Premium: {counts['premium']}
+🔍 Pending Verifications: {counts['verify']}
+🎫 Active Codes: {counts['codes']}
 ━━━━━━━━━━━━━━━━━━━━━
 
 🛠️ **Choose an option:**
@@ -1252,21 +3055,69 @@ def admin_panel_callback(call):
         InlineKeyboardButton("🔍 VERIFY TASKS", callback_data="admin_verify"),
         InlineKeyboardButton("📊 STATS", callback_data="admin_stats")
     )
+    markup.row(
+        InlineKeyboardButton("📣 BROADCAST", callback_data="admin_broadcast"),
+        InlineKeyboardButton("📤 EXPORT", callback_data="admin_export")
+    )
+    markup.row(
+        InlineKeyboardButton("📈 GROWTH", callback_data="admin_growth"),
+        InlineKeyboardButton("🔔 ALERTS", callback_data="admin_notify")
+    )
     markup.row(
         InlineKeyboardButton("💾 BACKUP", callback_data="admin_backup"),
         InlineKeyboardButton("🔙 BACK", callback_data="back")
     )
-    bot.edit_message_text(text, call.message.chat.id, call.message.message_id, reply_markup=markup, parse_mode="Markdown")
+    await api.edit_message_text(text, call.message.chat.id, call.message.message_id, reply_markup=markup, parse_mode="Markdown")
+
+# ================= ADMIN ALERT SETTINGS =================
+NOTIFY_MODE_LABELS = {"digest": "🗂 Digest", "instant": "⚡ Instant", "off": "🔕 Off"}
+
+def notify_settings_markup(admin_id):
+    markup = InlineKeyboardMarkup()
+    for category, title in NOTIFY_CATEGORIES.items():
+        mode = notifier.mode(admin_id, category)
+        markup.row(InlineKeyboardButton(f"{title}: {NOTIFY_MODE_LABELS[mode]}", callback_data=f"notify_{category}"))
+    markup.row(InlineKeyboardButton("🔙 BACK", callback_data="admin_panel"))
+    return markup
+
+NOTIFY_SETTINGS_TEXT = f"""
+🔔 **ALERT SETTINGS**
+
+🗂 Digest: one message per {NOTIFY_DIGEST_INTERVAL // 60} min or {NOTIFY_DIGEST_MAX} events
+⚡ Instant: every event right away
+🔕 Off: nothing (pending items stay in the panel)
+
+Withdrawals of {NOTIFY_URGENT_WITHDRAWAL}⭐ or more are always sent right away.
+Tap a category to change it:
+"""
+
+@callback_router.route("admin_notify")
+async def admin_notify_callback(call):
+    user_id = call.from_user.id
+    if not is_admin(user_id):
+        return
+    await api.edit_message_text(NOTIFY_SETTINGS_TEXT, call.message.chat.id, call.message.message_id,
+                                reply_markup=notify_settings_markup(user_id), parse_mode="Markdown")
+
+@callback_router.route("notify_{category}")
+async def notify_category_callback(call, category):
+    user_id = call.from_user.id
+    if not is_admin(user_id) or category not in NOTIFY_CATEGORIES:
+        return
+    current = notifier.mode(user_id, category)
+    mode = NOTIFY_MODES[(NOTIFY_MODES.index(current) + 1) % len(NOTIFY_MODES)]
+    await offload(notifier.set_mode, user_id, category, mode)
+    await api.answer_callback_query(call.id, f"{NOTIFY_CATEGORIES[category]}: {NOTIFY_MODE_LABELS[mode]}")
+    await api.edit_message_reply_markup(call.message.chat.id, call.message.message_id, reply_markup=notify_settings_markup(user_id))
 
 # ================= ADMIN TASKS =================
-@bot.callback_query_handler(func=lambda c: c.data == "admin_tasks")
-def admin_tasks_callback(call):
+@callback_router.route("admin_tasks")
+async def admin_tasks_callback(call):
     user_id = call.from_user.id
     if not is_admin(user_id):
         return
     
-    cursor.execute("SELECT id, task_name, task_type, reward, active FROM tasks ORDER BY id DESC LIMIT 10")
-    tasks = cursor.fetchall()
+    tasks = await astore.recent_tasks(10)
     
     text = "📋 **TASK MANAGEMENT**\n\n"
     if tasks:
@@ -1283,28 +3134,23 @@ def admin_tasks_callback(call):
         InlineKeyboardButton("❌ DELETE TASK", callback_data="admin_del_task")
     )
     markup.row(InlineKeyboardButton("🔙 BACK", callback_data="admin_panel"))
-    bot.edit_message_text(text, call.message.chat.id, call.message.message_id, reply_markup=markup, parse_mode="Markdown")
+    await api.edit_message_text(text, call.message.chat.id, call.message.message_id, reply_markup=markup, parse_mode="Markdown")
 
 # ================= ADD TASK =================
-@bot.callback_query_handler(func=lambda c: c.data == "admin_add_task")
-def admin_add_task_callback(call):
+@callback_router.route("admin_add_task")
+async def admin_add_task_callback(call):
     user_id = call.from_user.id
     if not is_admin(user_id):
         return
     
-    # Clear any existing sessions
-    cursor.execute("DELETE FROM admin_sessions WHERE admin_id=?", (user_id,))
-    cursor.execute("DELETE FROM user_actions WHERE user_id=?", (user_id,))
-    conn.commit()
-    
+    # Starting over drops whatever an earlier wizard left behind
     text = "➕ **CREATE NEW TASK**\n\nStep 1/4: Enter task name:"
-    cursor.execute("INSERT INTO user_actions (user_id, action_type) VALUES (?,?)", (user_id, "add_task_name"))
-    conn.commit()
-    bot.edit_message_text(text, call.message.chat.id, call.message.message_id, parse_mode="Markdown")
+    await flows.set(user_id, "add_task_name")
+    await api.edit_message_text(text, call.message.chat.id, call.message.message_id, parse_mode="Markdown")
 
 # ================= TASK TYPE CALLBACKS =================
-@bot.callback_query_handler(func=lambda c: c.data.startswith("task_type_"))
-def task_type_callback(call):
+@callback_router.route("task_type_{kind}")
+async def task_type_callback(call, kind):
     user_id = call.from_user.id
     if not is_admin(user_id):
         return
@@ -1315,59 +3161,44 @@ def task_type_callback(call):
         "link": "visit_link",
         "video": "watch_video"
     }
-    task_type = type_map[call.data.replace("task_type_", "")]
+    task_type = type_map[kind]
     
-    # Get existing session data
-    data = cursor.execute("SELECT session_data FROM admin_sessions WHERE admin_id=?", (user_id,)).fetchone()
-    if not data:
-        bot.answer_callback_query(call.id, "Session expired. Please start over.", show_alert=True)
+    flow = await flows.get(user_id)
+    if not flow or flow[0] != "add_task_type":
+        await api.answer_callback_query(call.id, "Session expired. Please start over.", show_alert=True)
         return
     
-    # Update session with task type
-    task = json.loads(data[0])
-    task["type"] = task_type
-    cursor.execute("UPDATE admin_sessions SET session_data=?, updated_at=? WHERE admin_id=?", 
-                  (json.dumps(task), datetime.now(), user_id))
-    
-    # Update user action to next step
-    cursor.execute("UPDATE user_actions SET action_type=?, action_time=? WHERE user_id=?", 
-                  ("add_task_data", datetime.now(), user_id))
-    conn.commit()
+    await flows.set(user_id, "add_task_data", {**flow[1], "type": task_type})
     
-    bot.edit_message_text("🔗 **Step 3/4:** Enter the link or channel username:\n\nExample: @channel or https://t.me/channel", 
+    await api.edit_message_text("🔗 **Step 3/4:** Enter the link or channel username:\n\nExample: @channel or https://t.me/channel", 
                          call.message.chat.id, call.message.message_id, parse_mode="Markdown")
 
 # ================= DELETE TASK =================
-@bot.callback_query_handler(func=lambda c: c.data == "admin_del_task")
-def admin_del_task_callback(call):
+@callback_router.route("admin_del_task")
+async def admin_del_task_callback(call):
     user_id = call.from_user.id
     if not is_admin(user_id):
         return
     
-    # Clear any existing actions
-    cursor.execute("DELETE FROM user_actions WHERE user_id=?", (user_id,))
-    conn.commit()
-    
+    # Replaces any existing action
     text = "❌ **DELETE TASK**\n\nEnter the Task ID to delete:"
-    cursor.execute("INSERT INTO user_actions (user_id, action_type) VALUES (?,?)", (user_id, "del_task"))
-    conn.commit()
-    bot.edit_message_text(text, call.message.chat.id, call.message.message_id, parse_mode="Markdown")
+    await flows.set(user_id, "del_task")
+    await api.edit_message_text(text, call.message.chat.id, call.message.message_id, parse_mode="Markdown")
 
 # ================= ADMIN CODES =================
-@bot.callback_query_handler(func=lambda c: c.data == "admin_codes")
-def admin_codes_callback(call):
+@callback_router.route("admin_codes")
+async def admin_codes_callback(call):
     user_id = call.from_user.id
     if not is_admin(user_id):
         return
     
-    cursor.execute("SELECT id, code, amount, max_uses, used_count, expires_at, active FROM redeem_codes ORDER BY id DESC LIMIT 10")
-    codes = cursor.fetchall()
+    codes = await astore.recent_codes(10)
     
     text = "🎫 **REDEEM CODE MANAGEMENT**\n\n"
     if codes:
         for c in codes:
             status = "✅" if c[6] else "❌"
-            expires = c[5][:10] if c[5] else "Never"
+            expires = epoch_text(c[5], '%Y-%m-%d') if c[5] else "Never"
             text += f"{status} `{c[1]}`\n"
             text += f"   Amount: {c[2]}⭐ | Used: {c[4]}/{c[3]} | Exp: {expires}\n\n"
     else:
@@ -1376,46 +3207,35 @@ def admin_codes_callback(call):
     markup = InlineKeyboardMarkup()
     markup.row(InlineKeyboardButton("➕ CREATE CODE", callback_data="admin_create_code"))
     markup.row(InlineKeyboardButton("🔙 BACK", callback_data="admin_panel"))
-    bot.edit_message_text(text, call.message.chat.id, call.message.message_id, reply_markup=markup, parse_mode="Markdown")
+    await api.edit_message_text(text, call.message.chat.id, call.message.message_id, reply_markup=markup, parse_mode="Markdown")
 
 # ================= CREATE CODE =================
-@bot.callback_query_handler(func=lambda c: c.data == "admin_create_code")
-def admin_create_code_callback(call):
+@callback_router.route("admin_create_code")
+async def admin_create_code_callback(call):
     user_id = call.from_user.id
     if not is_admin(user_id):
         return
     
-    # Clear any existing sessions
-    cursor.execute("DELETE FROM admin_sessions WHERE admin_id=?", (user_id,))
-    cursor.execute("DELETE FROM user_actions WHERE user_id=?", (user_id,))
-    conn.commit()
-    
+    # Starting over drops whatever an earlier wizard left behind
     text = "➕ **CREATE REDEEM CODE**\n\nStep 1/3: Enter the star amount:"
-    cursor.execute("INSERT INTO user_actions (user_id, action_type) VALUES (?,?)", (user_id, "create_code_amount"))
-    conn.commit()
-    bot.edit_message_text(text, call.message.chat.id, call.message.message_id, parse_mode="Markdown")
+    await flows.set(user_id, "create_code_amount")
+    await api.edit_message_text(text, call.message.chat.id, call.message.message_id, parse_mode="Markdown")
 
 # ================= ADMIN WITHDRAWALS =================
-@bot.callback_query_handler(func=lambda c: c.data == "admin_withdrawals")
-def admin_withdrawals_callback(call):
+@callback_router.route("admin_withdrawals")
+async def admin_withdrawals_callback(call):
     user_id = call.from_user.id
     if not is_admin(user_id):
         return
     
-    cursor.execute("""
-        SELECT id, user_id, amount, request_time 
-        FROM withdraw_requests 
-        WHERE status='pending' AND withdrawal_type='admin'
-        ORDER BY request_time ASC
-    """)
-    pending = cursor.fetchall()
+    pending = await astore.pending_admin_withdrawals()
     
     text = "💳 **PENDING ADMIN WITHDRAWALS**\n\n"
     if pending:
         for p in pending:
-            name = get_user_name(p[1])
+            name = await get_user_name(p[1])
             text += f"• **{name}** (ID: `{p[1]}`)\n"
-            text += f"  Amount: {p[2]}⭐ | Time: {p[3][:16]}\n"
+            text += f"  Amount: {p[2]}⭐ | Time: {epoch_text(p[3], '%Y-%m-%d %H:%M')}\n"
             text += f"  Approve: `/approve_withdraw {p[1]} {p[2]}`\n"
             text += f"  Reject: `/reject_withdraw {p[1]} {p[2]}`\n\n"
     else:
@@ -1423,30 +3243,23 @@ def admin_withdrawals_callback(call):
     
     markup = InlineKeyboardMarkup()
     markup.row(InlineKeyboardButton("🔙 BACK", callback_data="admin_panel"))
-    bot.edit_message_text(text, call.message.chat.id, call.message.message_id, reply_markup=markup, parse_mode="Markdown")
+    await api.edit_message_text(text, call.message.chat.id, call.message.message_id, reply_markup=markup, parse_mode="Markdown")
 
 # ================= ADMIN PREMIUM REQUESTS =================
-@bot.callback_query_handler(func=lambda c: c.data == "admin_premium")
-def admin_premium_callback(call):
+@callback_router.route("admin_premium")
+async def admin_premium_callback(call):
     user_id = call.from_user.id
     if not is_admin(user_id):
         return
     
-    cursor.execute("""
-        SELECT pr.id, pr.user_id, u.first_name, pr.request_time 
-        FROM premium_requests pr
-        LEFT JOIN users u ON pr.user_id = u.user_id
-        WHERE pr.status='pending'
-        ORDER BY pr.request_time ASC
-    """)
-    pending = cursor.fetchall()
+    pending = await astore.pending_premium_requests()
     
     text = "👑 **PENDING PREMIUM REQUESTS**\n\n"
     if pending:
         for req in pending:
             name = req[2] or f"User {req[1]}"
             text += f"• **{name}** (ID: `{req[1]}`)\n"
-            text += f"  Time: {req[3][:16]}\n"
+            text += f"  Time: {epoch_text(req[3], '%Y-%m-%d %H:%M')}\n"
             text += f"  Approve: `/approve_premium {req[1]}`\n"
             text += f"  Reject: `/reject_premium {req[1]}`\n\n"
     else:
@@ -1454,28 +3267,21 @@ def admin_premium_callback(call):
     
     markup = InlineKeyboardMarkup()
     markup.row(InlineKeyboardButton("🔙 BACK", callback_data="admin_panel"))
-    bot.edit_message_text(text, call.message.chat.id, call.message.message_id, reply_markup=markup, parse_mode="Markdown")
+    await api.edit_message_text(text, call.message.chat.id, call.message.message_id, reply_markup=markup, parse_mode="Markdown")
 
 # ================= ADMIN VERIFY =================
-@bot.callback_query_handler(func=lambda c: c.data == "admin_verify")
-def admin_verify_callback(call):
+@callback_router.route("admin_verify")
+async def admin_verify_callback(call):
     user_id = call.from_user.id
     if not is_admin(user_id):
         return
     
-    cursor.execute("""
-        SELECT ut.id, ut.user_id, t.task_name, t.reward 
-        FROM user_tasks ut 
-        JOIN tasks t ON ut.task_id=t.id 
-        WHERE ut.verified=0
-        ORDER BY ut.completed_at ASC
-    """)
-    pending = cursor.fetchall()
+    pending = await astore.pending_verifications()
     
     text = "🔍 **PENDING TASK VERIFICATIONS**\n\n"
     if pending:
         for p in pending:
-            name = get_user_name(p[1])
+            name = await get_user_name(p[1])
             text += f"• **{name}** (ID: `{p[1]}`)\n"
             text += f"  Task: {p[2][:30]} | Reward: {p[3]}⭐\n"
             text += f"  Verify: `/verify_task {p[1]} {p[2]}`\n\n"
@@ -1484,549 +3290,855 @@ def admin_verify_callback(call):
     
     markup = InlineKeyboardMarkup()
     markup.row(InlineKeyboardButton("🔙 BACK", callback_data="admin_panel"))
-    bot.edit_message_text(text, call.message.chat.id, call.message.message_id, reply_markup=markup, parse_mode="Markdown")
+    await api.edit_message_text(text, call.message.chat.id, call.message.message_id, reply_markup=markup, parse_mode="Markdown")
 
 # ================= ADMIN STATS =================
-@bot.callback_query_handler(func=lambda c: c.data == "admin_stats")
-def admin_stats_callback(call):
+@callback_router.route("admin_stats")
+async def admin_stats_callback(call):
     user_id = call.from_user.id
     if not is_admin(user_id):
         return
     
-    placeholders = ','.join('?' * len(ADMIN_IDS))
-    
-    cursor.execute(f"SELECT COUNT(*) FROM users_wallet WHERE user_id NOT IN ({placeholders})", ADMIN_IDS)
-    users = cursor.fetchone()[0]
+    totals = await offload(replica.totals) or await astore.totals()
+    updated = replica.refreshed_at.strftime('%H:%M') if replica.refreshed_at else "live"
     
-    cursor.execute(f"SELECT SUM(stars) FROM users_wallet WHERE user_id NOT IN ({placeholders})", ADMIN_IDS)
-    stars = cursor.fetchone()[0] or 0
+    text = f"""
+📊 **BOT STATISTICS** ({updated})
+
+━━━━━━━━━━━━━━━━━━━━━
+👥 **Users:** {totals['users']}
+💰 **Total Stars:** {totals['stars']} 🟡
+📊 **Average Stars:** {totals['avg']} 🟡
+━━━━━━━━━━━━━━━━━━━━━
+📋 **Active Tasks:** {totals['tasks']}
+✅ **Completed Tasks:** {totals['completed']}
+━━━━━━━━━━━━━━━━━━━━━
+💳 **Approved Withdrawals:** {totals['approved']}
+👑 **Pending Premium:** {totals['premium_pending']}
+━━━━━━━━━━━━━━━━━━━━━
+🎫 **Total Codes:** {totals['codes']}
+🔄 **Redeemed Codes:** {totals['redeemed']}
+━━━━━━━━━━━━━━━━━━━━━
+"""
+    markup = InlineKeyboardMarkup()
+    markup.row(InlineKeyboardButton("🔙 BACK", callback_data="admin_panel"))
+    await api.edit_message_text(text, call.message.chat.id, call.message.message_id, reply_markup=markup, parse_mode="Markdown")
+
+# ================= ADMIN BROADCAST =================
+@callback_router.route("admin_broadcast")
+async def admin_broadcast_callback(call):
+    user_id = call.from_user.id
+    if not is_admin(user_id):
+        return
     
-    cursor.execute(f"SELECT AVG(stars) FROM users_wallet WHERE user_id NOT IN ({placeholders})", ADMIN_IDS)
-    avg = int(cursor.fetchone()[0] or 0)
+    running = await astore.running_broadcast()
+    if running:
+        markup = InlineKeyboardMarkup()
+        markup.row(InlineKeyboardButton("⏹ CANCEL", callback_data="admin_broadcast_cancel"))
+        markup.row(InlineKeyboardButton("🔙 BACK", callback_data="admin_panel"))
+        await api.edit_message_text(f"📣 Broadcast #{running} is still running.",
+                             call.message.chat.id, call.message.message_id, reply_markup=markup)
+        return
     
-    cursor.execute("SELECT COUNT(*) FROM tasks WHERE active=1")
-    tasks = cursor.fetchone()[0]
+    recipients = await astore.reachable_users()
+    await flows.set(user_id, "broadcast_message")
     
-    cursor.execute("SELECT COUNT(*) FROM user_tasks WHERE verified=1")
-    completed = cursor.fetchone()[0]
+    text = f"📣 **BROADCAST**\n\nRecipients: {recipients}\n\nSend the message to broadcast:"
+    await api.edit_message_text(text, call.message.chat.id, call.message.message_id, parse_mode="Markdown")
+
+@callback_router.route("admin_broadcast_cancel")
+async def admin_broadcast_cancel_callback(call):
+    user_id = call.from_user.id
+    if not is_admin(user_id):
+        return
     
-    cursor.execute("SELECT COUNT(*) FROM withdraw_requests WHERE status='approved'")
-    approved = cursor.fetchone()[0]
+    # The sending instance, whichever it is, sees the status when it renews its lease
+    await astore.cancel_broadcast()
+    broadcaster.cancel()
+    await api.answer_callback_query(call.id, "⏹ Cancelling broadcast...")
+
+# ================= ADMIN GROWTH =================
+GROWTH_METRICS = [
+    ("signups", "👥 Signups"),
+    ("earns", "💰 Earns"),
+    ("stars_minted", "🟡 Minted"),
+    ("stars_burned", "🔥 Burned"),
+    ("redemptions", "🎫 Redeemed"),
+    ("withdrawals_stars", "⭐ Auto W/D"),
+    ("withdrawals_admin", "💼 Admin W/D"),
+    ("payments", "💳 Payments"),
+]
+
+@callback_router.route("admin_growth")
+async def admin_growth_callback(call):
+    user_id = call.from_user.id
+    if not is_admin(user_id):
+        return
     
-    cursor.execute("SELECT COUNT(*) FROM redeem_codes")
-    codes = cursor.fetchone()[0]
+    if not SQLITE:
+        await api.answer_callback_query(call.id, "Growth rollups are only kept for the SQLite database.", show_alert=True)
+        return
     
-    cursor.execute("SELECT COUNT(*) FROM redeemed_codes")
-    redeemed = cursor.fetchone()[0]
+    names = [metric for metric, _ in GROWTH_METRICS]
+    _, hourly = await offload(rollup_series, "hour", 24, names)
+    _, daily = await offload(rollup_series, "day", 14, names)
     
-    cursor.execute("SELECT COUNT(*) FROM premium_requests WHERE status='pending'")
-    premium_pending = cursor.fetchone()[0]
+    text = "📈 GROWTH\n\nLast 24 hours (hourly):\n"
+    for metric, label in GROWTH_METRICS:
+        text += f"{label}: {sparkline(hourly[metric])} {sum(hourly[metric])}\n"
+    text += "\nLast 14 days (daily):\n"
+    for metric, label in GROWTH_METRICS:
+        text += f"{label}: {sparkline(daily[metric])} {sum(daily[metric])}\n"
     
-    text = f"""
-📊 **BOT STATISTICS**
+    markup = InlineKeyboardMarkup()
+    markup.row(InlineKeyboardButton("🔙 BACK", callback_data="admin_panel"))
+    await api.edit_message_text(text, call.message.chat.id, call.message.message_id, reply_markup=markup)
 
-━━━━━━━━━━━━━━━━━━━━━
-👥 **Users:** {users}
-💰 **Total Stars:** {stars} 🟡
-📊 **Average Stars:** {avg} 🟡
-━━━━━━━━━━━━━━━━━━━━━
-📋 **Active Tasks:** {tasks}
-✅ **Completed Tasks:** {completed}
-━━━━━━━━━━━━━━━━━━━━━
-💳 **Approved Withdrawals:** {approved}
-👑 **Pending Premium:** {premium_pending}
-━━━━━━━━━━━━━━━━━━━━━
-🎫 **Total Codes:** {codes}
-🔄 **Redeemed Codes:** {redeemed}
-━━━━━━━━━━━━━━━━━━━━━
-"""
+# ================= ADMIN EXPORT =================
+@callback_router.route("admin_export")
+async def admin_export_callback(call):
+    user_id = call.from_user.id
+    if not is_admin(user_id):
+        return
+    
+    text = "📤 **DATA EXPORT**\n\nChoose a table and format (gzip-compressed):"
     markup = InlineKeyboardMarkup()
+    for table in EXPORTS:
+        markup.row(*[InlineKeyboardButton(f"{table} .{fmt}", callback_data=f"export_{table}_{fmt}")
+                     for fmt in EXPORT_FORMATS])
     markup.row(InlineKeyboardButton("🔙 BACK", callback_data="admin_panel"))
-    bot.edit_message_text(text, call.message.chat.id, call.message.message_id, reply_markup=markup, parse_mode="Markdown")
+    await api.edit_message_text(text, call.message.chat.id, call.message.message_id, reply_markup=markup, parse_mode="Markdown")
+
+@callback_router.route("export_{spec}")
+async def export_callback(call, spec):
+    user_id = call.from_user.id
+    if not is_admin(user_id):
+        return
+    
+    table, fmt = spec.rsplit("_", 1)
+    if table not in EXPORTS or fmt not in EXPORT_FORMATS:
+        await api.answer_callback_query(call.id, "❌ Unknown export", show_alert=True)
+        return
+    
+    await api.answer_callback_query(call.id, f"📤 Exporting {table}...")
+    threading.Thread(target=send_export, args=(call.message.chat.id, table, fmt), daemon=True).start()
 
 # ================= ADMIN BACKUP =================
-@bot.callback_query_handler(func=lambda c: c.data == "admin_backup")
-def admin_backup_callback(call):
+@callback_router.route("admin_backup")
+async def admin_backup_callback(call):
     user_id = call.from_user.id
     if not is_admin(user_id):
         return
     
-    if not GITHUB_TOKEN or not GITHUB_REPO:
+    if not SQLITE:
+        text = "💾 The database is PostgreSQL; back it up with the server's own tooling (pg_dump, PITR)."
+    elif not GITHUB_TOKEN or not GITHUB_REPO:
         text = "❌ GitHub backup is not configured.\n\nSet GITHUB_TOKEN and GITHUB_REPO environment variables to enable backups."
     else:
-        cursor.execute("SELECT backup_time, backup_type, status FROM backup_log ORDER BY backup_time DESC LIMIT 5")
-        backups = cursor.fetchall()
+        backups = await astore.recent_backups(5)
         text = "💾 **BACKUP SYSTEM**\n\n"
         if backups:
             text += "**Recent Backups:**\n"
             for b in backups:
                 status_icon = "✅" if b[2] == "success" else "❌"
-                text += f"{status_icon} {b[0][:16]} - {b[1]}\n"
+                text += f"{status_icon} {epoch_text(b[0], '%Y-%m-%d %H:%M')} - {b[1]}\n"
         else:
             text += "No backups yet.\n"
     
     markup = InlineKeyboardMarkup()
-    if GITHUB_TOKEN and GITHUB_REPO:
+    if GITHUB_TOKEN and GITHUB_REPO and SQLITE:
         markup.row(InlineKeyboardButton("💾 BACKUP NOW", callback_data="admin_backup_now"))
     markup.row(InlineKeyboardButton("🔙 BACK", callback_data="admin_panel"))
-    bot.edit_message_text(text, call.message.chat.id, call.message.message_id, reply_markup=markup, parse_mode="Markdown")
+    await api.edit_message_text(text, call.message.chat.id, call.message.message_id, reply_markup=markup, parse_mode="Markdown")
 
-@bot.callback_query_handler(func=lambda c: c.data == "admin_backup_now")
-def admin_backup_now_callback(call):
+@callback_router.route("admin_backup_now")
+async def admin_backup_now_callback(call):
     user_id = call.from_user.id
     if not is_admin(user_id):
         return
     
-    bot.answer_callback_query(call.id, "🔄 Creating backup...")
-    success = backup_to_github("manual", f"Manual backup by admin {user_id}")
+    await api.answer_callback_query(call.id, "🔄 Creating backup...")
+    success = await offload(backup_to_github, "manual", f"Manual backup by admin {user_id}")
     if success:
-        bot.send_message(call.message.chat.id, "✅ Backup completed successfully!")
+        await api.send_message(call.message.chat.id, "✅ Backup completed successfully!")
     else:
-        bot.send_message(call.message.chat.id, "❌ Backup failed! Check GitHub configuration.")
+        await api.send_message(call.message.chat.id, "❌ Backup failed! Check GitHub configuration.")
 
 # ================= VERIFY TASK COMMAND =================
 @bot.message_handler(commands=['verify_task'])
-def verify_task_command(message):
+async def verify_task_command(message):
     admin_id = message.from_user.id
     if not is_admin(admin_id):
-        bot.reply_to(message, "❌ You are not authorized to use this command.")
+        await api.reply_to(message, "❌ You are not authorized to use this command.")
         return
     
     try:
         parts = message.text.split(maxsplit=2)
         if len(parts) < 3:
-            bot.reply_to(message, "❌ Usage: /verify_task [user_id] [task_name]")
+            await api.reply_to(message, "❌ Usage: /verify_task [user_id] [task_name]")
             return
         
         target_user = int(parts[1])
         task_name = parts[2]
         
-        # Find the pending task
-        cursor.execute("""
-            SELECT ut.id, t.reward, t.id FROM user_tasks ut
-            JOIN tasks t ON ut.task_id = t.id
-            WHERE ut.user_id=? AND t.task_name LIKE ? AND ut.verified=0
-            ORDER BY ut.completed_at DESC LIMIT 1
-        """, (target_user, f"%{task_name}%"))
-        task = cursor.fetchone()
-        
-        if not task:
-            bot.reply_to(message, f"❌ No pending task found for user {target_user} with name '{task_name}'")
+        # Verifies the latest matching pending task and credits its reward
+        reward = await astore.verify_task(target_user, task_name)
+        if reward is None:
+            await api.reply_to(message, f"❌ No pending task found for user {target_user} with name '{task_name}'")
             return
         
-        task_id, reward, t_id = task
-        
-        cursor.execute("UPDATE user_tasks SET verified=1 WHERE id=?", (task_id,))
-        add_stars(target_user, reward)
-        conn.commit()
-        
-        bot.reply_to(message, f"✅ Task verified! User {target_user} got {reward}⭐")
+        await api.reply_to(message, f"✅ Task verified! User {target_user} got {reward}⭐")
         
         try:
-            bot.send_message(target_user, f"✅ Your task '{task_name}' has been verified! +{reward}⭐")
-        except:
-            pass
+            await api.send_message(target_user, f"✅ Your task '{task_name}' has been verified! +{reward}⭐")
+        except Exception as e:
+            log.error("notify", "user_message_failed", e, user_id=target_user)
     except ValueError:
-        bot.reply_to(message, "❌ Invalid user ID format.")
+        await api.reply_to(message, "❌ Invalid user ID format.")
     except Exception as e:
-        bot.reply_to(message, f"❌ Error: {str(e)}")
+        await api.reply_to(message, f"❌ Error: {str(e)}")
 
-# ================= HANDLE ALL TEXT MESSAGES =================
-@bot.message_handler(func=lambda message: True)
-def handle_all_messages(message):
-    user_id = message.from_user.id
-    text = message.text.strip()
+# ================= PROFILER COMMAND =================
+@bot.message_handler(commands=['profiler'])
+async def profiler_command(message):
+    admin_id = message.from_user.id
+    if not is_admin(admin_id):
+        await api.reply_to(message, "❌ You are not authorized to use this command.")
+        return
+    
+    parts = message.text.split()
+    if len(parts) < 2 or parts[1] not in ("start", "stop"):
+        await api.reply_to(message, "❌ Usage: /profiler [start|stop]")
+        return
     
-    cursor.execute("SELECT action_type FROM user_actions WHERE user_id=?", (user_id,))
-    action = cursor.fetchone()
+    if parts[1] == "start":
+        profiler.start()
+        await api.reply_to(message, "🔬 Sampling profiler started. Send /profiler stop to collect stacks.")
+        return
     
-    if not action:
+    profiler.stop()
+    document = io.BytesIO(profiler.dump().encode())
+    document.name = f"profile_{datetime.now().strftime('%Y%m%d_%H%M%S')}.folded"
+    await api.send_document(message.chat.id, document, caption=f"🔬 {profiler.samples} samples (folded stacks)")
+
+# ================= RETENTION COMMAND =================
+def format_retention_report(report):
+    lines = [f"🗄 <b>Retention</b> ({report['finished_at'].strftime('%Y-%m-%d %H:%M')}, {report['seconds']:.1f}s)\n"]
+    for table, rows in report["moved"].items():
+        lines.append(f"• {table}: {rows:,} rows archived")
+    lines.append(f"\n💾 Reclaimed: {report['reclaimed'] / 1048576:.1f} MB")
+    if report.get("vacuum_pending"):
+        lines.append("⚠️ Free pages stay in the file until /retention vacuum switches it to incremental vacuum.")
+    for label, path in (("Database", DB_PATH), ("Archive", ARCHIVE_PATH)):
+        if os.path.exists(path):
+            lines.append(f"📁 {label}: {os.path.getsize(path) / 1048576:.1f} MB")
+    return "\n".join(lines)
+
+@bot.message_handler(commands=['retention'])
+async def retention_command(message):
+    admin_id = message.from_user.id
+    if not is_admin(admin_id):
+        await api.reply_to(message, "❌ You are not authorized to use this command.")
         return
     
-    action_type = action[0]
-    print(f"Processing action: {action_type} for user {user_id} with text: {text}")
+    if not SQLITE:
+        await api.reply_to(message, "🗄 Retention archives the SQLite file; on PostgreSQL use partitioning or the server's own jobs.")
+        return
     
-    # Don't delete yet - we'll delete after processing
-    # cursor.execute("DELETE FROM user_actions WHERE user_id=?", (user_id,))
-    # conn.commit()
+    parts = message.text.split()
+    if len(parts) > 1 and parts[1] == "vacuum":
+        await vacuum_mode_command(message)
+        return
     
-    # Handle redeem code
-    if action_type == "awaiting_code":
-        cursor.execute("DELETE FROM user_actions WHERE user_id=?", (user_id,))
-        conn.commit()
-        
-        code = text.upper()
-        cursor.execute("SELECT id, amount, max_uses, used_count, expires_at, active FROM redeem_codes WHERE code=?", (code,))
-        code_data = cursor.fetchone()
-        
-        if not code_data:
-            bot.send_message(message.chat.id, "❌ Invalid code!", reply_markup=main_menu(user_id))
-            return
-        
-        code_id, amount, max_uses, used_count, expires_at, active = code_data
-        
-        if not active:
-            bot.send_message(message.chat.id, "❌ Code is deactivated!", reply_markup=main_menu(user_id))
-            return
-        
-        if expires_at:
-            expires = datetime.fromisoformat(expires_at)
-            if datetime.now() > expires:
-                bot.send_message(message.chat.id, "❌ Code has expired!", reply_markup=main_menu(user_id))
-                return
-        
-        if used_count >= max_uses:
-            bot.send_message(message.chat.id, "❌ Code has reached maximum uses!", reply_markup=main_menu(user_id))
-            return
-        
-        cursor.execute("SELECT id FROM redeemed_codes WHERE code_id=? AND user_id=?", (code_id, user_id))
-        if cursor.fetchone():
-            bot.send_message(message.chat.id, "❌ You already used this code!", reply_markup=main_menu(user_id))
-            return
-        
-        add_stars(user_id, amount)
-        cursor.execute("UPDATE redeem_codes SET used_count = used_count + 1 WHERE id=?", (code_id,))
-        cursor.execute("INSERT INTO redeemed_codes (code_id, user_id) VALUES (?,?)", (code_id, user_id))
-        conn.commit()
-        
-        wallet = get_wallet(user_id)
-        bot.send_message(message.chat.id, f"✅ Code redeemed! +{amount} 🟡⭐\n\nNew balance: {wallet[1]} 🟡⭐", 
-                        reply_markup=main_menu(user_id))
-    
-    # Handle auto withdrawal amount
-    elif action_type == "awaiting_auto_withdraw":
-        cursor.execute("DELETE FROM user_actions WHERE user_id=?", (user_id,))
-        conn.commit()
-        
-        try:
-            amount = int(text)
-            if amount < MIN_WITHDRAW:
-                bot.send_message(message.chat.id, f"❌ Minimum withdrawal is {MIN_WITHDRAW} 🟡⭐", 
-                                reply_markup=main_menu(user_id))
-                return
-            
-            wallet = get_wallet(user_id)
-            if amount > wallet[1]:
-                bot.send_message(message.chat.id, "❌ Insufficient balance!", reply_markup=main_menu(user_id))
-                return
-            
-            cooldown = check_cooldown(user_id, "withdraw", WITHDRAWAL_COOLDOWN)
-            if cooldown > 0:
-                bot.send_message(message.chat.id, f"⏳ Wait {cooldown}s", reply_markup=main_menu(user_id))
-                return
-            
-            if not is_admin(user_id) and wallet[6] + amount > MAX_DAILY_WITHDRAW:
-                bot.send_message(message.chat.id, "❌ Daily limit exceeded!", reply_markup=main_menu(user_id))
-                return
-            
-            log_action(user_id, "withdraw")
-            cursor.execute("INSERT INTO withdraw_requests (user_id, amount, withdrawal_type) VALUES (?,?,'stars')", (user_id, amount))
-            cursor.execute("UPDATE users_wallet SET daily_withdrawn = daily_withdrawn + ? WHERE user_id=?", (amount, user_id))
-            conn.commit()
-            
-            bot.send_message(message.chat.id, f"✅ Auto withdrawal requested! {amount} ⭐️ will be sent soon.", 
-                            reply_markup=main_menu(user_id))
-        except:
-            bot.send_message(message.chat.id, "❌ Invalid amount!", reply_markup=main_menu(user_id))
+    if len(parts) < 2 or parts[1] != "run":
+        if retention_report:
+            await api.reply_to(message, format_retention_report(retention_report), parse_mode="HTML")
+        else:
+            await api.reply_to(message, "🗄 Retention has not run yet. Send /retention run to archive old rows now.")
+        return
     
-    # Handle admin withdrawal amount
-    elif action_type == "awaiting_admin_withdraw":
-        cursor.execute("DELETE FROM user_actions WHERE user_id=?", (user_id,))
-        conn.commit()
-        
+    if retention_lock.locked():
+        await api.reply_to(message, "⏳ Retention is already running.")
+        return
+    
+    await api.reply_to(message, "🗄 Archiving old rows...")
+    
+    def run():
         try:
-            amount = int(text)
-            if amount < MIN_WITHDRAW:
-                bot.send_message(message.chat.id, f"❌ Minimum withdrawal is {MIN_WITHDRAW} 🟡⭐", 
-                                reply_markup=main_menu(user_id))
-                return
-            
-            wallet = get_wallet(user_id)
-            if amount > wallet[1]:
-                bot.send_message(message.chat.id, "❌ Insufficient balance!", reply_markup=main_menu(user_id))
-                return
-            
-            if not is_admin(user_id) and wallet[6] + amount > MAX_DAILY_WITHDRAW:
-                bot.send_message(message.chat.id, "❌ Daily limit exceeded!", reply_markup=main_menu(user_id))
-                return
-            
-            cursor.execute("INSERT INTO withdraw_requests (user_id, amount, withdrawal_type) VALUES (?,?,'admin')", (user_id, amount))
-            cursor.execute("UPDATE users_wallet SET daily_withdrawn = daily_withdrawn + ? WHERE user_id=?", (amount, user_id))
-            conn.commit()
-            
-            user_name = get_user_name(user_id)
-            for admin_id in ADMIN_IDS:
-                try:
-                    admin_text = f"""
-🔔 NEW ADMIN WITHDRAWAL REQUEST
-
-👤 User: {user_name}
-🆔 ID: `{user_id}`
-💰 Amount: {amount} 🟡⭐
+            report = run_retention()
+            bot.send_message(message.chat.id, format_retention_report(report), parse_mode="HTML")
+        except Exception as e:
+            bot.send_message(message.chat.id, f"❌ Retention failed: {str(e)}")
+    threading.Thread(target=run, daemon=True).start()
 
-Use:
-/approve_withdraw {user_id} {amount}
-/reject_withdraw {user_id} {amount}
-"""
-                    bot.send_message(admin_id, admin_text, parse_mode="Markdown")
-                except:
-                    pass
-            
-            bot.send_message(message.chat.id, f"✅ Admin withdrawal requested! {amount} ⭐️ is pending approval.", 
-                            reply_markup=main_menu(user_id))
-        except:
-            bot.send_message(message.chat.id, "❌ Invalid amount!", reply_markup=main_menu(user_id))
+async def vacuum_mode_command(message):
+    if store.incremental_vacuum_enabled():
+        await api.reply_to(message, "🗄 Incremental vacuum is already on; retention reclaims space on every run.")
+        return
     
-    # Handle code creation - amount
-    elif action_type == "create_code_amount":
-        try:
-            amount = int(text)
-            if amount <= 0:
-                bot.send_message(message.chat.id, "❌ Amount must be positive!", reply_markup=main_menu(user_id))
-                cursor.execute("DELETE FROM user_actions WHERE user_id=?", (user_id,))
-                conn.commit()
-                return
-            
-            # Save amount to session
-            cursor.execute("INSERT OR REPLACE INTO admin_sessions (admin_id, session_data) VALUES (?,?)", 
-                          (user_id, json.dumps({"amount": amount})))
-            
-            # Update action to next step
-            cursor.execute("UPDATE user_actions SET action_type=? WHERE user_id=?", ("create_code_expiry", user_id))
-            conn.commit()
-            
-            bot.send_message(message.chat.id, "📅 **Step 2/3:** Enter expiry days (e.g., 30 for 30 days, 0 for no expiry):")
-        except:
-            bot.send_message(message.chat.id, "❌ Invalid amount! Please enter a number.", reply_markup=main_menu(user_id))
-            cursor.execute("DELETE FROM user_actions WHERE user_id=?", (user_id,))
-            conn.commit()
+    if retention_lock.locked():
+        await api.reply_to(message, "⏳ Retention is running. Try again when it has finished.")
+        return
     
-    # Handle code creation - expiry
-    elif action_type == "create_code_expiry":
-        try:
-            days = int(text)
-            if days < 0:
-                bot.send_message(message.chat.id, "❌ Days cannot be negative!", reply_markup=main_menu(user_id))
-                cursor.execute("DELETE FROM user_actions WHERE user_id=?", (user_id,))
-                conn.commit()
-                return
-            
-            # Get existing session
-            data = cursor.execute("SELECT session_data FROM admin_sessions WHERE admin_id=?", (user_id,)).fetchone()
-            if not data:
-                bot.send_message(message.chat.id, "Session expired. Please start over.", reply_markup=main_menu(user_id))
-                cursor.execute("DELETE FROM user_actions WHERE user_id=?", (user_id,))
-                conn.commit()
-                return
-            
-            session = json.loads(data[0])
-            session["expiry_days"] = days
-            
-            # Update session
-            cursor.execute("UPDATE admin_sessions SET session_data=? WHERE admin_id=?", (json.dumps(session), user_id))
-            
-            # Update action to next step
-            cursor.execute("UPDATE user_actions SET action_type=? WHERE user_id=?", ("create_code_uses", user_id))
-            conn.commit()
-            
-            bot.send_message(message.chat.id, "🔄 **Step 3/3:** Enter maximum uses (e.g., 10 for 10 users, 0 for unlimited):")
-        except:
-            bot.send_message(message.chat.id, "❌ Invalid number! Please enter a number.", reply_markup=main_menu(user_id))
-            cursor.execute("DELETE FROM user_actions WHERE user_id=?", (user_id,))
-            conn.commit()
+    size = os.path.getsize(DB_PATH) / 1048576
+    await api.reply_to(message, f"🗄 Rebuilding the {size:.1f} MB database with VACUUM. Handlers wait until it finishes...")
     
-    # Handle code creation - max uses
-    elif action_type == "create_code_uses":
+    def run():
         try:
-            max_uses = int(text)
-            if max_uses < 0:
-                bot.send_message(message.chat.id, "❌ Max uses cannot be negative!", reply_markup=main_menu(user_id))
-                cursor.execute("DELETE FROM user_actions WHERE user_id=?", (user_id,))
-                conn.commit()
-                return
-            
-            # Set unlimited if 0
-            if max_uses == 0:
-                max_uses = 999999
-            
-            # Get session data
-            data = cursor.execute("SELECT session_data FROM admin_sessions WHERE admin_id=?", (user_id,)).fetchone()
-            if not data:
-                bot.send_message(message.chat.id, "Session expired. Please start over.", reply_markup=main_menu(user_id))
-                cursor.execute("DELETE FROM user_actions WHERE user_id=?", (user_id,))
-                conn.commit()
-                return
-            
-            session = json.loads(data[0])
-            amount = session["amount"]
-            expiry_days = session["expiry_days"]
-            
-            # Generate unique code
-            code = generate_code()
-            
-            # Set expiry date
-            expires_at = None
-            if expiry_days > 0:
-                expires_at = datetime.now() + timedelta(days=expiry_days)
-            
-            # Insert into database
-            cursor.execute("""
-                INSERT INTO redeem_codes (code, amount, max_uses, expires_at, created_by) 
-                VALUES (?,?,?,?,?)
-            """, (code, amount, max_uses, expires_at, user_id))
-            
-            # Clean up
-            cursor.execute("DELETE FROM admin_sessions WHERE admin_id=?", (user_id,))
-            cursor.execute("DELETE FROM user_actions WHERE user_id=?", (user_id,))
-            conn.commit()
-            
-            expiry_text = f"{expiry_days} days" if expiry_days > 0 else "No expiry"
-            uses_text = "Unlimited" if max_uses > 1000 else str(max_uses)
-            
-            bot.send_message(message.chat.id, 
-                           f"✅ **CODE CREATED SUCCESSFULLY!**\n\n"
-                           f"🎫 **Code:** `{code}`\n"
-                           f"💰 **Amount:** {amount}⭐\n"
-                           f"📅 **Expires:** {expiry_text}\n"
-                           f"🔄 **Max Uses:** {uses_text}", 
-                           parse_mode="Markdown", reply_markup=main_menu(user_id))
-            
-            if GITHUB_TOKEN and GITHUB_REPO:
-                threading.Thread(target=backup_to_github, args=("new_code", f"Code created for {amount}⭐"), daemon=True).start()
-        except:
-            bot.send_message(message.chat.id, "❌ Invalid number! Please enter a number.", reply_markup=main_menu(user_id))
-            cursor.execute("DELETE FROM user_actions WHERE user_id=?", (user_id,))
-            conn.commit()
-    
-    # Handle task creation - name
-    elif action_type == "add_task_name":
-        # Save task name to session
-        cursor.execute("INSERT OR REPLACE INTO admin_sessions (admin_id, session_data) VALUES (?,?)", 
-                      (user_id, json.dumps({"name": text})))
-        
-        # Update action to next step
-        cursor.execute("UPDATE user_actions SET action_type=? WHERE user_id=?", ("add_task_type", user_id))
-        conn.commit()
-        
-        markup = InlineKeyboardMarkup()
-        markup.row(
-            InlineKeyboardButton("📢 CHANNEL", callback_data="task_type_channel"),
-            InlineKeyboardButton("👥 GROUP", callback_data="task_type_group")
-        )
-        markup.row(
-            InlineKeyboardButton("🔗 LINK", callback_data="task_type_link"),
-            InlineKeyboardButton("🎥 VIDEO", callback_data="task_type_video")
-        )
-        bot.send_message(message.chat.id, "📌 **Step 2/4:** Choose task type:", reply_markup=markup, parse_mode="Markdown")
+            released, seconds = switch_vacuum_mode()
+            bot.send_message(message.chat.id, f"✅ Incremental vacuum is on. Released {released / 1048576:.1f} MB in {seconds:.1f}s.")
+        except Exception as e:
+            log.error("retention", "vacuum_mode_switch_failed", e)
+            bot.send_message(message.chat.id, f"❌ VACUUM failed: {str(e)}")
+    threading.Thread(target=run, daemon=True).start()
+
+# ================= RECONCILE COMMAND =================
+@bot.message_handler(commands=['reconcile'])
+async def reconcile_command(message):
+    admin_id = message.from_user.id
+    if not is_admin(admin_id):
+        await api.reply_to(message, "❌ You are not authorized to use this command.")
+        return
+    
+    if reconcile_lock.locked():
+        await api.reply_to(message, "⏳ Reconciliation is already running.")
+        return
     
-    # Handle task creation - data (this is triggered by the callback, not a message)
-    # This is handled by the task_type_callback function
+    parts = message.text.split()
+    repair = len(parts) > 1 and parts[1] == "repair"
+    await api.reply_to(message, "💰 Comparing payments with Telegram..." + (" Missing payments will be credited." if repair else ""))
     
-    # Handle task creation - reward
-    elif action_type == "add_task_reward":
+    def run():
         try:
-            reward = int(text)
-            if reward <= 0:
-                bot.send_message(message.chat.id, "❌ Reward must be positive!", reply_markup=main_menu(user_id))
-                cursor.execute("DELETE FROM user_actions WHERE user_id=?", (user_id,))
-                conn.commit()
-                return
-            
-            # Get session data
-            data = cursor.execute("SELECT session_data FROM admin_sessions WHERE admin_id=?", (user_id,)).fetchone()
-            if not data:
-                bot.send_message(message.chat.id, "Session expired. Please start over.", reply_markup=main_menu(user_id))
-                cursor.execute("DELETE FROM user_actions WHERE user_id=?", (user_id,))
-                conn.commit()
-                return
-            
-            task = json.loads(data[0])
-            
-            # Insert task into database
-            cursor.execute("""
-                INSERT INTO tasks (task_name, task_type, task_data, reward, created_by) 
-                VALUES (?,?,?,?,?)
-            """, (task["name"], task["type"], task["data"], reward, user_id))
-            
-            # Clean up
-            cursor.execute("DELETE FROM admin_sessions WHERE admin_id=?", (user_id,))
-            cursor.execute("DELETE FROM user_actions WHERE user_id=?", (user_id,))
-            conn.commit()
-            
-            bot.send_message(message.chat.id, 
-                           f"✅ **TASK CREATED SUCCESSFULLY!**\n\n"
-                           f"📋 **Name:** {task['name']}\n"
-                           f"💰 **Reward:** {reward}⭐\n"
-                           f"📌 **Type:** {task['type']}\n"
-                           f"🔗 **Data:** {task['data']}", 
-                           parse_mode="Markdown", reply_markup=main_menu(user_id))
-            
-            if GITHUB_TOKEN and GITHUB_REPO:
-                threading.Thread(target=backup_to_github, args=("new_task", f"Task created: {task['name']}"), daemon=True).start()
-        except:
-            bot.send_message(message.chat.id, "❌ Invalid number! Please enter a number.", reply_markup=main_menu(user_id))
-            cursor.execute("DELETE FROM user_actions WHERE user_id=?", (user_id,))
-            conn.commit()
-    
-    # Handle task deletion
-    elif action_type == "del_task":
-        cursor.execute("DELETE FROM user_actions WHERE user_id=?", (user_id,))
-        conn.commit()
+            report = reconcile_payments(repair)
+            bot.send_message(message.chat.id, format_reconcile_report(report), parse_mode="HTML")
+        except Exception as e:
+            bot.send_message(message.chat.id, f"❌ Reconciliation failed: {str(e)}")
+    threading.Thread(target=run, daemon=True).start()
+
+# ================= ADMIN ROLE COMMANDS =================
+@bot.message_handler(commands=['add_admin', 'remove_admin'])
+async def admin_role_command(message):
+    admin_id = message.from_user.id
+    if admin_id not in ADMIN_IDS:
+        await api.reply_to(message, "❌ Only owners can change admin roles.")
+        return
+    
+    try:
+        parts = message.text.split()
+        command = parts[0].lstrip('/').split('@')[0]
+        if len(parts) < 2:
+            await api.reply_to(message, f"❌ Usage: /{command} [user_id]")
+            return
         
-        try:
-            task_id = int(text)
-            
-            # Check if task exists
-            cursor.execute("SELECT task_name FROM tasks WHERE id=?", (task_id,))
-            task = cursor.fetchone()
-            if not task:
-                bot.send_message(message.chat.id, f"❌ Task ID {task_id} not found!", reply_markup=main_menu(user_id))
-                return
-            
-            task_name = task[0]
-            
-            cursor.execute("DELETE FROM tasks WHERE id=?", (task_id,))
-            cursor.execute("DELETE FROM user_tasks WHERE task_id=?", (task_id,))
-            conn.commit()
-            
-            bot.send_message(message.chat.id, f"✅ Task '{task_name}' (ID: {task_id}) deleted successfully!", 
-                            reply_markup=main_menu(user_id))
-            
-            if GITHUB_TOKEN and GITHUB_REPO:
-                threading.Thread(target=backup_to_github, args=("delete_task", f"Task deleted: {task_name}"), daemon=True).start()
-        except:
-            bot.send_message(message.chat.id, "❌ Invalid ID! Please enter a number.", reply_markup=main_menu(user_id))
+        target_user = int(parts[1])
+        if command == "add_admin":
+            await set_role(target_user, 'admin')
+            await api.reply_to(message, f"✅ User {target_user} is now an admin.")
+        elif target_user in ADMIN_IDS:
+            await api.reply_to(message, "❌ Owners listed in ADMIN_IDS cannot be removed.")
+        else:
+            await set_role(target_user, 'user')
+            await api.reply_to(message, f"✅ User {target_user} is no longer an admin.")
+    except ValueError:
+        await api.reply_to(message, "❌ Invalid user ID format. Please provide a valid numeric ID.")
+    except Exception as e:
+        await api.reply_to(message, f"❌ Error: {str(e)}")
+
+# ================= HANDLE ALL TEXT MESSAGES =================
+# Text sent while a flow waits for input; each state declares how its text is parsed and where it leads
+@flow_step("awaiting_code", parse=str.upper)
+async def redeem_code_step(message, code, data):
+    user_id = message.from_user.id
+    code_data = await astore.get_code(code)
+    
+    if not code_data:
+        await api.send_message(message.chat.id, "❌ Invalid code!", reply_markup=main_menu(user_id))
+        return
+    
+    code_id, amount, max_uses, used_count, expires_at, active = code_data
+    
+    if not active:
+        await api.send_message(message.chat.id, "❌ Code is deactivated!", reply_markup=main_menu(user_id))
+        return
+    
+    if expires_at and now_epoch() > expires_at:
+        await api.send_message(message.chat.id, "❌ Code has expired!", reply_markup=main_menu(user_id))
+        return
+    
+    if used_count >= max_uses:
+        await api.send_message(message.chat.id, "❌ Code has reached maximum uses!", reply_markup=main_menu(user_id))
+        return
+    
+    if await astore.has_redeemed(code_id, user_id):
+        await api.send_message(message.chat.id, "❌ You already used this code!", reply_markup=main_menu(user_id))
+        return
+    
+    # Re-checks the use limit and the user's redemption under the code's row lock
+    balance = await astore.redeem_code(code_id, user_id, amount)
+    if balance is None:
+        await api.send_message(message.chat.id, "❌ Code is no longer available!", reply_markup=main_menu(user_id))
+        return
+    
+    await api.send_message(message.chat.id, f"✅ Code redeemed! +{amount} 🟡⭐\n\nNew balance: {balance} 🟡⭐", 
+                    reply_markup=main_menu(user_id))
+
+@flow_step("awaiting_auto_withdraw", parse=whole_number(MIN_WITHDRAW, f"❌ Minimum withdrawal is {MIN_WITHDRAW} 🟡⭐"),
+           invalid="❌ Invalid amount!")
+async def auto_withdraw_step(message, amount, data):
+    user_id = message.from_user.id
+    wallet = await get_limits(user_id)
+    if amount > wallet.stars:
+        await api.send_message(message.chat.id, "❌ Insufficient balance!", reply_markup=main_menu(user_id))
+        return
+    
+    cooldown = await check_cooldown(user_id, "withdraw", WITHDRAWAL_COOLDOWN)
+    if cooldown > 0:
+        await api.send_message(message.chat.id, f"⏳ Wait {cooldown}s", reply_markup=main_menu(user_id))
+        return
+    
+    if not is_admin(user_id) and wallet.daily_withdrawn + amount > MAX_DAILY_WITHDRAW:
+        await api.send_message(message.chat.id, "❌ Daily limit exceeded!", reply_markup=main_menu(user_id))
+        return
+    
+    await astore.request_withdrawal(user_id, amount, "stars")
+    
+    await api.send_message(message.chat.id, f"✅ Auto withdrawal requested! {amount} ⭐️ will be sent soon.", 
+                    reply_markup=main_menu(user_id))
+
+@flow_step("awaiting_admin_withdraw", parse=whole_number(MIN_WITHDRAW, f"❌ Minimum withdrawal is {MIN_WITHDRAW} 🟡⭐"),
+           invalid="❌ Invalid amount!")
+async def admin_withdraw_step(message, amount, data):
+    user_id = message.from_user.id
+    wallet = await get_limits(user_id)
+    if amount > wallet.stars:
+        await api.send_message(message.chat.id, "❌ Insufficient balance!", reply_markup=main_menu(user_id))
+        return
+    
+    if not is_admin(user_id) and wallet.daily_withdrawn + amount > MAX_DAILY_WITHDRAW:
+        await api.send_message(message.chat.id, "❌ Daily limit exceeded!", reply_markup=main_menu(user_id))
+        return
+    
+    await astore.request_withdrawal(user_id, amount, "admin")
+    
+    notify_admin_withdrawal(message.from_user, amount)
+    
+    await api.send_message(message.chat.id, f"✅ Admin withdrawal requested! {amount} ⭐️ is pending approval.", 
+                    reply_markup=main_menu(user_id))
+
+# ----- create code: amount -> expiry -> uses -----
+@flow_step("create_code_amount", parse=whole_number(1, "❌ Amount must be positive!"),
+           invalid="❌ Invalid amount! Please enter a number.")
+async def create_code_amount_step(message, amount, data):
+    await api.send_message(message.chat.id, "📅 **Step 2/3:** Enter expiry days (e.g., 30 for 30 days, 0 for no expiry):")
+    return "create_code_expiry", {"amount": amount}
+
+@flow_step("create_code_expiry", parse=whole_number(0, "❌ Days cannot be negative!"),
+           invalid="❌ Invalid number! Please enter a number.", needs=("amount",))
+async def create_code_expiry_step(message, days, data):
+    await api.send_message(message.chat.id, "🔄 **Step 3/3:** Enter maximum uses (e.g., 10 for 10 users, 0 for unlimited):")
+    return "create_code_uses", {**data, "expiry_days": days}
+
+@flow_step("create_code_uses", parse=whole_number(0, "❌ Max uses cannot be negative!"),
+           invalid="❌ Invalid number! Please enter a number.", needs=("amount", "expiry_days"))
+async def create_code_uses_step(message, max_uses, data):
+    user_id = message.from_user.id
+    amount = data["amount"]
+    expiry_days = data["expiry_days"]
+    
+    # Set unlimited if 0
+    if max_uses == 0:
+        max_uses = 999999
+    
+    code = generate_code()
+    expires_at = None
+    if expiry_days > 0:
+        expires_at = now_epoch() + expiry_days * 86400
+    
+    await astore.create_code(code, amount, max_uses, expires_at, user_id)
+    
+    expiry_text = f"{expiry_days} days" if expiry_days > 0 else "No expiry"
+    uses_text = "Unlimited" if max_uses > 1000 else str(max_uses)
+    
+    await api.send_message(message.chat.id, 
+                   f"✅ **CODE CREATED SUCCESSFULLY!**\n\n"
+                   f"🎫 **Code:** `{code}`\n"
+                   f"💰 **Amount:** {amount}⭐\n"
+                   f"📅 **Expires:** {expiry_text}\n"
+                   f"🔄 **Max Uses:** {uses_text}", 
+                   parse_mode="Markdown", reply_markup=main_menu(user_id))
+    
+    if GITHUB_TOKEN and GITHUB_REPO:
+        threading.Thread(target=backup_to_github, args=("new_code", f"Code created for {amount}⭐"), daemon=True).start()
+
+# ----- add task: name -> type (buttons, task_type_callback) -> data -> reward -----
+@flow_step("add_task_name")
+async def add_task_name_step(message, name, data):
+    markup = InlineKeyboardMarkup()
+    markup.row(
+        InlineKeyboardButton("📢 CHANNEL", callback_data="task_type_channel"),
+        InlineKeyboardButton("👥 GROUP", callback_data="task_type_group")
+    )
+    markup.row(
+        InlineKeyboardButton("🔗 LINK", callback_data="task_type_link"),
+        InlineKeyboardButton("🎥 VIDEO", callback_data="task_type_video")
+    )
+    await api.send_message(message.chat.id, "📌 **Step 2/4:** Choose task type:", reply_markup=markup, parse_mode="Markdown")
+    return "add_task_type", {"name": name}
+
+@flow_step("add_task_data", needs=("name", "type"))
+async def add_task_data_step(message, task_data, data):
+    await api.send_message(message.chat.id, "💰 **Step 4/4:** Enter the reward in stars:", parse_mode="Markdown")
+    return "add_task_reward", {**data, "data": task_data}
+
+@flow_step("add_task_reward", parse=whole_number(1, "❌ Reward must be positive!"),
+           invalid="❌ Invalid number! Please enter a number.", needs=("name", "type", "data"))
+async def add_task_reward_step(message, reward, task):
+    user_id = message.from_user.id
+    await astore.create_task(task["name"], task["type"], task["data"], reward, user_id)
+    
+    await api.send_message(message.chat.id, 
+                   f"✅ **TASK CREATED SUCCESSFULLY!**\n\n"
+                   f"📋 **Name:** {task['name']}\n"
+                   f"💰 **Reward:** {reward}⭐\n"
+                   f"📌 **Type:** {task['type']}\n"
+                   f"🔗 **Data:** {task['data']}", 
+                   parse_mode="Markdown", reply_markup=main_menu(user_id))
+    
+    if GITHUB_TOKEN and GITHUB_REPO:
+        threading.Thread(target=backup_to_github, args=("new_task", f"Task created: {task['name']}"), daemon=True).start()
+
+@flow_step("del_task", parse=int, invalid="❌ Invalid ID! Please enter a number.")
+async def del_task_step(message, task_id, data):
+    user_id = message.from_user.id
+    # Deletes the task with its completions; None if it does not exist
+    task_name = await astore.delete_task(task_id)
+    if task_name is None:
+        await api.send_message(message.chat.id, f"❌ Task ID {task_id} not found!", reply_markup=main_menu(user_id))
+        return
+    
+    await api.send_message(message.chat.id, f"✅ Task '{task_name}' (ID: {task_id}) deleted successfully!", 
+                    reply_markup=main_menu(user_id))
+    
+    if GITHUB_TOKEN and GITHUB_REPO:
+        threading.Thread(target=backup_to_github, args=("delete_task", f"Task deleted: {task_name}"), daemon=True).start()
+
+@flow_step("broadcast_message")
+async def broadcast_message_step(message, text, data):
+    user_id = message.from_user.id
+    if not is_admin(user_id):
+        return
+    
+    progress = await api.send_message(message.chat.id, "📣 Starting broadcast...")
+    broadcast_id = await astore.create_broadcast(user_id, message.text, progress.chat.id, progress.message_id,
+                                                 broadcaster.owner, BROADCAST_LEASE)
+    if not broadcaster.start(broadcast_id):
+        await astore.finish_broadcast(broadcast_id, "cancelled")
+        await api.edit_message_text("❌ Another broadcast is already running.", progress.chat.id, progress.message_id)
+
+@bot.message_handler(func=lambda message: True)
+async def handle_all_messages(message):
+    user_id = message.from_user.id
+    if not await flows.get(user_id):
+        return
+    
+    # Steps check balances and limits before writing; a user's concurrent messages must not interleave
+    async with user_locks(user_id):
+        await run_flow_step(message, user_id)
+
+async def run_flow_step(message, user_id):
+    flow = await flows.get(user_id)
+    if not flow:
+        return
+    
+    state, data = flow
+    step = FLOW_STEPS.get(state)
+    if step is None:
+        return  # waiting for a button, not text
+    
+    log.event("message", "flow_step", user_id=user_id, state=state)
+    try:
+        value = step.parse(message.text.strip())
+        if any(key not in data for key in step.needs):
+            raise FlowError("Session expired. Please start over.")
+    except (FlowError, ValueError) as e:
+        await flows.clear(user_id)
+        error = str(e) if isinstance(e, FlowError) else step.invalid
+        await api.send_message(message.chat.id, error, reply_markup=main_menu(user_id))
+        return
+    
+    try:
+        transition = await step.handler(message, value, data)
+    except Exception:
+        # Leave the step, so a handler that failed halfway never gets the user's next text as input again
+        await flows.clear(user_id)
+        raise
+    if transition:
+        await flows.set(user_id, *transition)
+    else:
+        await flows.clear(user_id)
 
 # ================= ADMIN DAILY BONUS =================
 def daily_admin_bonus():
     while True:
         time.sleep(86400)
+        # With several instances sharing one database only the first to wake up pays the bonus
+        if not store.claim_job("daily_admin_bonus", 86400 - 3600):
+            continue
         reset_daily_withdrawals()
-        for admin in ADMIN_IDS:
-            cursor.execute("UPDATE users_wallet SET stars = stars + 100 WHERE user_id=?", (admin,))
-        conn.commit()
-        print("✅ Admin daily bonus added")
+        store.grant_stars(list(admins), 100)
+        log.event("jobs", "admin_bonus_added")
 
 threading.Thread(target=daily_admin_bonus, daemon=True).start()
 
+# ================= HANDLER INSTRUMENTATION =================
+for handler in bot.message_handlers:
+    known_commands.update(handler['filters'].get('commands') or ())
+
+for handlers in ("message_handlers", "callback_query_handlers", "pre_checkout_query_handlers"):
+    for handler in getattr(bot, handlers):
+        if handler['function'] != callback_router.dispatch:  # routes are instrumented one by one
+            handler['function'] = instrument_handler(handler['function'])
+        if RUNTIME != "async":
+            handler['function'] = inline_handler(handler['function'])
+    if RUNTIME == "async":
+        # Same filters and coroutines, dispatched by AsyncTeleBot instead
+        getattr(api, handlers).extend(getattr(bot, handlers))
+
+# ================= LONG POLLING =================
+POLL_LIMIT = 100         # updates per getUpdates call (the Bot API maximum)
+POLL_TIMEOUT = 50        # seconds Telegram holds getUpdates open while there is nothing new
+POLL_WORKERS = 16        # chats handled in parallel within a batch (sync runtime)
+POLL_MAX_ATTEMPTS = 3    # an update failing this often is skipped so it cannot stall everything behind it
+POLL_RETRY_DELAY = 5
+WEBHOOK_STALL_SECONDS = 300  # pending updates but no webhook delivery for this long: switch to polling
+WEBHOOK_CHECK_INTERVAL = 60
+
+def update_chat_id(update):
+    """Key that orders updates: the chat for messages, the user for callbacks and payments."""
+    if update.message:
+        return update.message.chat.id
+    for event in (update.callback_query, update.pre_checkout_query, update.edited_message):
+        if event:
+            return event.from_user.id
+    return update.update_id
+
+class LongPoller:
+    """getUpdates loop for runs without a public webhook URL, or when webhook delivery stalls.
+
+    Each batch is split by chat: chats run in parallel, a chat's updates run in order and stop at the
+    first failure. The offset only moves past an update once it was handled (or ran out of attempts),
+    so anything unfinished is delivered again after a failure or a crash.
+    """
+
+    def __init__(self, limit=POLL_LIMIT, timeout=POLL_TIMEOUT, workers=POLL_WORKERS):
+        self.limit = limit
+        self.timeout = timeout
+        self.workers = workers
+        self.offset = None
+        self.done = set()  # handled ids at or above the offset, skipped when delivered again
+        self.attempts = defaultdict(int)
+        self.enabled = False
+        self.executor = None
+        self.loop = None  # the ASGI server's event loop under the asyncio runtime
+        self.last_webhook = time.time()
+
+    def start(self):
+        """Switch to polling. Under the asyncio runtime the loop starts from the ASGI lifespan if not yet running."""
+        if self.enabled:
+            return
+        self.enabled = True
+        bot.remove_webhook()  # getUpdates is refused while a webhook is set
+        if RUNTIME != "async":
+            threading.Thread(target=self.run, daemon=True).start()
+        elif self.loop:
+            asyncio.run_coroutine_threadsafe(self.run_async(), self.loop)
+        log.event("polling", "started", batch=self.limit)
+
+    def watch_webhook(self):
+        """Fall back to polling when Telegram holds pending updates the webhook is not receiving."""
+        while not self.enabled:
+            time.sleep(WEBHOOK_CHECK_INTERVAL)
+            try:
+                info = bot.get_webhook_info()
+            except Exception as e:
+                log.error("polling", "webhook_check_failed", e)
+                continue
+            stalled = time.time() - self.last_webhook
+            if info.pending_update_count and stalled > WEBHOOK_STALL_SECONDS:
+                log.event("polling", "webhook_stalled", pending=info.pending_update_count, last_error=info.last_error_message)
+                metrics.inc("bot_webhook_fallbacks_total")
+                self.start()
+
+    def split(self, updates):
+        """Returns (payment updates, other updates grouped by chat), skipping updates already handled."""
+        payments = []
+        chats = defaultdict(list)
+        for update in updates:
+            if update.update_id in self.done:
+                continue
+            if update_lane(update) == "payment":
+                # Handled on their own lane, outside their chat's order
+                payments.append(update)
+            else:
+                chats[update_chat_id(update)].append(update)
+        return payments, list(chats.values())
+
+    def commit(self, updates, handled, failed):
+        """Record one batch's outcome and advance the offset past every finished update."""
+        self.done.update(handled)
+        for update_id in failed:
+            self.attempts[update_id] += 1
+            if self.attempts[update_id] >= POLL_MAX_ATTEMPTS:
+                log.error("polling", "update_dropped", update_id=update_id, attempts=POLL_MAX_ATTEMPTS)
+                metrics.inc("bot_poll_updates_dropped_total")
+                self.done.add(update_id)
+        unfinished = [u.update_id for u in updates if u.update_id not in self.done]
+        if unfinished:
+            self.offset = min(unfinished)
+        elif updates:
+            self.offset = updates[-1].update_id + 1
+        if self.offset is not None:
+            self.done = {update_id for update_id in self.done if update_id >= self.offset}
+            for update_id in [u for u in self.attempts if u < self.offset]:
+                del self.attempts[update_id]
+        metrics.inc("bot_poll_batches_total")
+        metrics.inc("bot_poll_updates_total", (), len(handled))
+        metrics.inc("bot_poll_failures_total", (), len(failed))
+
+    # ---------- sync runtime ----------
+    def handle(self, update):
+        failures = []
+        token = handler_failures.set(failures)
+        try:
+            bot.process_new_updates([update])
+        except Exception as e:
+            failures.append(e)
+        finally:
+            handler_failures.reset(token)
+        return not failures
+
+    def run_chat(self, updates):
+        """Handle one chat's updates in order. Returns (handled ids, failed id or None)."""
+        handled = []
+        for update in updates:
+            if not self.handle(update):
+                return handled, update.update_id
+            handled.append(update.update_id)
+        return handled, None
+
+    def run_payment(self, update):
+        return ([update.update_id], None) if self.handle(update) else ([], update.update_id)
+
+    def poll_once(self):
+        """Fetch one batch, handle it and commit. Returns the number of updates received."""
+        updates = bot.get_updates(offset=self.offset, limit=self.limit, timeout=self.timeout,
+                                  long_polling_timeout=self.timeout + 10)
+        received = time.perf_counter()
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(self.workers, thread_name_prefix="poll")
+        payments, chats = self.split(updates)
+        # Payments start on the reserved lane before any chat of the batch is scheduled
+        paid = [lanes.submit(update, received, self.run_payment) for update in payments]
+        results = list(self.executor.map(self.run_chat, chats)) + [future.result() for future in paid]
+        self.commit(updates, [i for handled, _ in results for i in handled],
+                    [failed for _, failed in results if failed is not None])
+        return len(updates)
+
+    def run(self):
+        while True:
+            try:
+                self.poll_once()
+            except Exception as e:
+                log.error("polling", "failed", e)
+                time.sleep(POLL_RETRY_DELAY)
+
+    # ---------- asyncio runtime ----------
+    async def handle_async(self, update):
+        failures = []
+        token = handler_failures.set(failures)
+        try:
+            # AsyncTeleBot logs handler exceptions itself; instrument_handler reports them here
+            await api.process_new_updates([update])
+        except Exception as e:
+            failures.append(e)
+        finally:
+            handler_failures.reset(token)
+        return not failures
+
+    async def run_chat_async(self, updates):
+        handled = []
+        for update in updates:
+            if not await self.handle_async(update):
+                return handled, update.update_id
+            handled.append(update.update_id)
+        return handled, None
+
+    async def run_payment_async(self, update, received):
+        token = current_lane.set("payment")
+        try:
+            return ([update.update_id], None) if await self.handle_async(update) else ([], update.update_id)
+        finally:
+            current_lane.reset(token)
+            observe_lane("payment", received)
+
+    async def poll_once_async(self):
+        updates = await api.get_updates(offset=self.offset, limit=self.limit, timeout=self.timeout,
+                                        request_timeout=self.timeout + 10)
+        received = time.perf_counter()
+        payments, chats = self.split(updates)
+        results = await asyncio.gather(*(self.run_payment_async(update, received) for update in payments),
+                                       *(self.run_chat_async(chat) for chat in chats))
+        self.commit(updates, [i for handled, _ in results for i in handled],
+                    [failed for _, failed in results if failed is not None])
+        return len(updates)
+
+    async def run_async(self):
+        while True:
+            try:
+                await self.poll_once_async()
+            except Exception as e:
+                log.error("polling", "failed", e)
+                await asyncio.sleep(POLL_RETRY_DELAY)
+
+poller = LongPoller()
+
 # ================= WEBHOOK SETUP =================
+webhook_registered = False  # set once Telegram was told to send WEBHOOK_SECRET with every update
+
 def setup_webhook():
+    global webhook_registered
     render_url = os.getenv("RENDER_EXTERNAL_URL")
     if render_url:
         webhook_url = f"{render_url}/{TOKEN}"
-        bot.remove_webhook()
-        time.sleep(1)
-        bot.set_webhook(url=webhook_url)
-        print(f"✅ Webhook set to: {webhook_url}")
+        # set_webhook replaces whatever was registered before, secret included
+        bot.set_webhook(url=webhook_url, secret_token=WEBHOOK_SECRET)
+        webhook_registered = True
+        log.event("webhook", "set", url=webhook_url)
         return True
     return False
 
+def start_webhook_services():
+    """Register the webhook. Runs at import, since gunicorn serves bot:app without __main__."""
+    try:
+        if setup_webhook() and UPDATE_MODE == "auto":
+            threading.Thread(target=poller.watch_webhook, daemon=True).start()
+    except Exception as e:
+        log.error("webhook", "set_failed", e)
+
+if RENDER_EXTERNAL_URL:
+    if UPDATE_MODE != "polling":
+        start_webhook_services()
+    # Render sleeps an idle service whatever the update mode, so it pings itself in both
+    keep_alive.health_url = f"{RENDER_EXTERNAL_URL}/health"
+    keep_alive.start()
+
 # ================= MAIN =================
 if __name__ == "__main__":
     print("=" * 50)
     print("⚡ PULSE PROFIT BOT ⚡")
     print("=" * 50)
-    print(f"👑 Admins: {len(ADMIN_IDS)}")
+    print(f"👑 Admins: {len(admins)}")
     print(f"📢 Channel: {REQUIRED_CHANNEL}")
     print(f"💰 Earning System: Active")
     print(f"👥 Referral System: Active")
@@ -2038,11 +4150,13 @@ if __name__ == "__main__":
     print(f"💾 GitHub Backup: {'Active' if GITHUB_TOKEN and GITHUB_REPO else 'Disabled'}")
     print("=" * 50)
     
-    setup_webhook()
-    
-    if RENDER_EXTERNAL_URL:
-        keep_alive.health_url = f"{RENDER_EXTERNAL_URL}/health"
-        keep_alive.start()
+    # With a public URL the webhook was registered at import
+    if UPDATE_MODE == "polling" or (UPDATE_MODE == "auto" and not RENDER_EXTERNAL_URL):
+        poller.start()
     
     port = int(os.environ.get('PORT', 10000))
-    app.run(host='0.0.0.0', port=port)
+    if RUNTIME == "async":
+        import uvicorn
+        uvicorn.run(asgi_app, host='0.0.0.0', port=port)
+    else:
+        app.run(host='0.0.0.0', port=port)
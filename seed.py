@@ -0,0 +1,256 @@
+"""Deterministic synthetic data generator for load testing bot.py.
+
+Bulk-loads every table with consistent data: users and wallets with power-law
+balances, referral trees, user actions, tasks, redeem codes and withdrawals.
+The same seed and scale always produce the same database.
+
+    python seed.py --db load_test.db --scale 16 --seed 42
+"""
+import os
+import time
+import random
+import sqlite3
+import argparse
+from datetime import datetime, timezone
+
+from storage import ROLLUP_BACKFILL, SQLiteStorage
+
+ADMIN_IDS = [7475473197, 7713987088]
+
+# Rows generated per 1.0 of scale; scale 16 is roughly 10M rows
+USERS_PER_SCALE = 10000
+REFERRAL_RATE = 0.6
+ACTIONS_PER_USER = 50
+TASKS = 50
+TASKS_PER_USER = 5
+CODES = 200
+REDEMPTIONS_PER_USER = 2
+WITHDRAWALS_PER_USER = 0.5
+PREMIUM_REQUEST_RATE = 0.05
+BATCH_SIZE = 100000
+HISTORY_DAYS = 90
+NEVER_EXPIRES = 4070908800  # 2099-01-01 UTC
+
+ACTION_TYPES = ["earn", "earn", "earn", "earn", "refer", "withdraw"]
+TASK_TYPES = ["join_channel", "join_group", "visit_link", "watch_video"]
+WITHDRAW_STATUSES = ["pending", "approved", "approved", "approved", "rejected"]
+PREMIUM_STATUSES = ["pending", "approved", "rejected"]
+
+# ================= PRAGMAS =================
+BULK_PRAGMAS = {
+    "journal_mode": "OFF",
+    "synchronous": "OFF",
+    "cache_size": "-262144",
+    "temp_store": "MEMORY",
+    "locking_mode": "EXCLUSIVE",
+}
+
+def apply_bulk_pragmas(conn):
+    previous = {name: conn.execute(f"PRAGMA {name}").fetchone()[0] for name in BULK_PRAGMAS}
+    for name, value in BULK_PRAGMAS.items():
+        conn.execute(f"PRAGMA {name}={value}")
+    return previous
+
+def restore_pragmas(conn, previous):
+    for name, value in previous.items():
+        conn.execute(f"PRAGMA {name}={value}")
+    # Leaving exclusive locking mode only releases the file lock on the next access
+    conn.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+
+# ================= HELPERS =================
+class TimestampPool:
+    """Pre-drawn epoch timestamps so row generation stays a list lookup."""
+
+    def __init__(self, rng, days=HISTORY_DAYS, size=200000):
+        start = int(datetime(2025, 1, 1, tzinfo=timezone.utc).timestamp())
+        span = days * 86400
+        self.values = sorted(start + rng.randrange(span) for _ in range(size))
+        self.size = size
+
+    def pick(self, r):
+        return self.values[int(r * self.size)]
+
+def drop_secondary_indexes(conn):
+    """Drop explicit indexes for the load; returns their DDL so they can be rebuilt once at the end."""
+    indexes = conn.execute("SELECT name, sql FROM sqlite_master WHERE type='index' AND sql IS NOT NULL").fetchall()
+    for name, _ in indexes:
+        conn.execute(f"DROP INDEX {name}")
+    return [sql for _, sql in indexes]
+
+def drop_triggers(conn):
+    """Drop the rollup triggers for the load; returns their DDL. The events are queued in bulk instead."""
+    triggers = conn.execute("SELECT name, sql FROM sqlite_master WHERE type='trigger'").fetchall()
+    for name, _ in triggers:
+        conn.execute(f"DROP TRIGGER {name}")
+    return [sql for _, sql in triggers]
+
+# Hash streams for rows generated inside SQLite: (i * multiplier + seed) squared modulo a prime below 2^31,
+# so every product stays within a 64-bit integer
+HASH_PRIME = 2147483647
+HASH_MULTIPLIERS = (48271, 69621, 40692)
+
+def sql_hash(column, stream, seed):
+    return f"((({column} * {HASH_MULTIPLIERS[stream]} + {seed % HASH_PRIME}) % {HASH_PRIME}) * (({column} * {HASH_MULTIPLIERS[stream]} + {seed % HASH_PRIME}) % {HASH_PRIME}) % {HASH_PRIME})"
+
+def insert_actions(conn, users, actions, seed):
+    """Generate user_actions inside SQLite; binding ~10M Python tuples was most of the load time."""
+    start = int(datetime(2025, 1, 1, tzinfo=timezone.utc).timestamp())
+    kind = f"{sql_hash('i', 1, seed)} % {len(ACTION_TYPES)}"
+    when = f"{start} + {sql_hash('i', 2, seed)} % {HISTORY_DAYS * 86400}"
+    cases = " ".join(f"WHEN {i} THEN '{action}'" for i, action in enumerate(ACTION_TYPES))
+    conn.execute(f"""
+        WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n WHERE i < ?),
+        h(user_id, kind, action_time, amount) AS (
+            SELECT 1 + {sql_hash('i', 0, seed)} % ?, {kind}, {when}, 1 + {sql_hash('i', 2, seed + 1)} % 3 FROM n)
+        INSERT INTO user_actions (user_id, action_type, action_time, amount)
+        SELECT user_id, CASE kind {cases} END, action_time,
+               CASE CASE kind {cases} END WHEN 'earn' THEN amount WHEN 'refer' THEN 5 END FROM h
+    """, (actions, users))
+    return actions
+
+def insert_batched(conn, sql, rows):
+    batch = []
+    total = 0
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= BATCH_SIZE:
+            conn.executemany(sql, batch)
+            total += len(batch)
+            batch = []
+    if batch:
+        conn.executemany(sql, batch)
+        total += len(batch)
+    return total
+
+# ================= GENERATOR =================
+def populate(conn, scale=1.0, seed=42, users=None, actions_per_user=ACTIONS_PER_USER):
+    """Populate every table in one transaction. Returns a {table: rows} summary."""
+    rng = random.Random(seed)
+    users = users or max(1, int(USERS_PER_SCALE * scale))
+    user_ids = range(1, users + 1)
+    stamps = TimestampPool(rng)
+    counts = {}
+    previous = apply_bulk_pragmas(conn)
+    try:
+        conn.execute("BEGIN")
+        indexes = drop_secondary_indexes(conn)
+        triggers = drop_triggers(conn)
+
+        counts["users"] = insert_batched(conn,
+            "INSERT INTO users (user_id, username, first_name, joined_channel) VALUES (?,?,?,?)",
+            ((uid, f"user{uid}", f"User{uid}", 1 if rng.random() < 0.95 else 0) for uid in user_ids))
+        conn.executemany("INSERT OR IGNORE INTO users (user_id, username, first_name, joined_channel) VALUES (?,?,?,1)",
+                         [(admin_id, f"admin{admin_id}", "Admin") for admin_id in ADMIN_IDS])
+
+        # Referral tree: each referred user points at an earlier user, biased towards early adopters
+        referral_counts = [0] * (users + 1)
+        def referrals():
+            for uid in range(2, users + 1):
+                if rng.random() < REFERRAL_RATE:
+                    referrer = 1 + int((uid - 1) * rng.random() ** 2)
+                    referral_counts[referrer] += 1
+                    yield referrer, uid
+        counts["referrals"] = insert_batched(conn, "INSERT INTO referrals VALUES (?,?)", referrals())
+
+        counts["tasks"] = insert_batched(conn,
+            "INSERT INTO tasks (task_name, task_type, task_data, reward, active, created_by, created_at) VALUES (?,?,?,?,?,?,?)",
+            ((f"Task {i}", TASK_TYPES[i % len(TASK_TYPES)], f"@channel{i}", 1 + i % 10,
+              1 if i % 5 else 0, ADMIN_IDS[0], stamps.pick(rng.random())) for i in range(1, TASKS + 1)))
+
+        tasks_done = [0] * (users + 1)
+        def user_tasks():
+            for uid in user_ids:
+                for task_id in rng.sample(range(1, TASKS + 1), min(TASKS, int(rng.random() * TASKS_PER_USER * 2))):
+                    verified = 1 if rng.random() < 0.9 else 0
+                    tasks_done[uid] += verified
+                    yield uid, task_id, stamps.pick(rng.random()), verified
+        counts["user_tasks"] = insert_batched(conn,
+            "INSERT INTO user_tasks (user_id, task_id, completed_at, verified) VALUES (?,?,?,?)", user_tasks())
+
+        counts["users_wallet"] = insert_batched(conn,
+            "INSERT INTO users_wallet (user_id, stars, total_earned, referrals, premium, tasks_done, daily_withdrawn) VALUES (?,?,?,?,?,?,?)",
+            ((uid, stars, stars + int(stars * rng.random()), referral_counts[uid], 1 if rng.random() < 0.02 else 0,
+              tasks_done[uid], 0)
+             for uid, stars in ((uid, int(rng.paretovariate(1.16) * 5) - 5) for uid in user_ids)))
+        conn.executemany("INSERT OR REPLACE INTO users_wallet (user_id, stars, premium, role) VALUES (?,?,1,'admin')",
+                         [(admin_id, 100000) for admin_id in ADMIN_IDS])
+
+        counts["user_actions"] = insert_actions(conn, users, int(users * actions_per_user), seed)
+
+        counts["redeem_codes"] = insert_batched(conn,
+            "INSERT INTO redeem_codes (code, amount, max_uses, used_count, expires_at, created_by, created_at, active) VALUES (?,?,?,?,?,?,?,?)",
+            ((f"SEED-{i:04d}", 5 * (1 + i % 20), 999999, 0, None if i % 3 else NEVER_EXPIRES,
+              ADMIN_IDS[0], stamps.pick(rng.random()), 1 if i % 10 else 0) for i in range(1, CODES + 1)))
+
+        used = [0] * (CODES + 1)
+        def redemptions():
+            for uid in user_ids:
+                for code_id in rng.sample(range(1, CODES + 1), int(rng.random() * REDEMPTIONS_PER_USER * 2)):
+                    used[code_id] += 1
+                    yield code_id, uid, stamps.pick(rng.random())
+        counts["redeemed_codes"] = insert_batched(conn,
+            "INSERT INTO redeemed_codes (code_id, user_id, redeemed_at) VALUES (?,?,?)", redemptions())
+        conn.executemany("UPDATE redeem_codes SET used_count=? WHERE id=?",
+                         [(used[code_id], code_id) for code_id in range(1, CODES + 1)])
+
+        counts["withdraw_requests"] = insert_batched(conn,
+            "INSERT INTO withdraw_requests (user_id, amount, withdrawal_type, status, request_time) VALUES (?,?,?,?,?)",
+            ((1 + int(users * rng.random()), 50 * (1 + int(rng.random() * 10)),
+              "stars" if rng.random() < 0.7 else "admin", WITHDRAW_STATUSES[int(rng.random() * 5)],
+              stamps.pick(rng.random())) for _ in range(int(users * WITHDRAWALS_PER_USER))))
+
+        counts["premium_requests"] = insert_batched(conn,
+            "INSERT INTO premium_requests (user_id, status, request_time) VALUES (?,?,?)",
+            ((1 + int(users * rng.random()), PREMIUM_STATUSES[int(rng.random() * 3)], stamps.pick(rng.random()))
+             for _ in range(int(users * PREMIUM_REQUEST_RATE))))
+
+        # One set-based pass per source instead of a trigger firing for every row
+        for sql in ROLLUP_BACKFILL.values():
+            conn.execute(sql, (0,))
+        for sql in indexes + triggers:
+            conn.execute(sql)
+        conn.execute("COMMIT")
+    except Exception:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+    finally:
+        restore_pragmas(conn, previous)
+    # Sampled statistics are enough for the planner and take milliseconds instead of a full scan
+    conn.execute("PRAGMA analysis_limit=1000")
+    conn.execute("ANALYZE")
+    return counts
+
+# ================= SCHEMA =================
+def create_schema(path):
+    """Create bot.py's schema at path straight from storage.py, without importing (and starting) the bot."""
+    store = SQLiteStorage.open(path)
+    try:
+        store.create_schema()
+    finally:
+        store.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Bulk-load synthetic data into a bot database")
+    parser.add_argument("--db", required=True, help="Database file to create (must not exist)")
+    parser.add_argument("--scale", type=float, default=1.0, help=f"1.0 = {USERS_PER_SCALE} users")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    if os.path.exists(args.db):
+        parser.error(f"{args.db} already exists")
+    create_schema(args.db)
+
+    conn = sqlite3.connect(args.db, isolation_level=None)
+    started = time.perf_counter()
+    counts = populate(conn, args.scale, args.seed)
+    elapsed = time.perf_counter() - started
+    conn.close()
+
+    total = sum(counts.values())
+    for table, rows in counts.items():
+        print(f"   {table:<18} {rows:>12,}")
+    print(f"✅ {total:,} rows in {elapsed:.1f}s ({total / elapsed:,.0f} rows/s)")
+
+if __name__ == "__main__":
+    main()
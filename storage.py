@@ -0,0 +1,1190 @@
+"""Storage backends for bot.py.
+
+SQLiteStorage keeps everything in one local file and is the default.
+PostgresStorage is used when DATABASE_URL points at a PostgreSQL server, so
+several bot instances can share one database.
+
+Both expose the same methods. Queries are written once, with ? placeholders,
+in SQL both engines accept (ON CONFLICT, RETURNING); PostgresStorage rewrites
+the placeholders and swaps in the few clauses that differ.
+"""
+import json
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from typing import NamedTuple
+
+# user_actions rows that record history; every other action_type is a conversation state
+LOG_ACTIONS = ("signup", "earn", "refer", "withdraw")
+STATE_FILTER = "action_type NOT IN ({})".format(", ".join(f"'{action}'" for action in LOG_ACTIONS))
+
+WITHDRAWAL_CLAIM_TIMEOUT = 600  # seconds; a 'processing' claim older than this is retried
+POSTGRES_POOL_SIZE = 10
+
+# Timestamps are unix epoch seconds in INTEGER columns, so SQL compares and buckets them without parsing.
+# Inserts always pass the time: SQLite files converted from TEXT keep their old CURRENT_TIMESTAMP defaults.
+def now_epoch():
+    return int(time.time())
+
+def epoch_text(epoch, fmt='%Y-%m-%d %H:%M:%S'):
+    """Format an epoch column for display, in UTC; empty for NULL."""
+    return time.strftime(fmt, time.gmtime(epoch)) if epoch is not None else ""
+
+# Columns that used to hold TEXT datetimes: (table, column, written in local time).
+# CURRENT_TIMESTAMP defaults were UTC; the values the bot wrote itself came from datetime.now().
+EPOCH_COLUMNS = [
+    ("withdraw_requests", "request_time", False),
+    ("withdraw_requests", "claimed_at", True),
+    ("premium_requests", "request_time", False),
+    ("user_actions", "action_time", True),
+    ("tasks", "created_at", False),
+    ("user_tasks", "completed_at", False),
+    ("redeem_codes", "expires_at", True),
+    ("redeem_codes", "created_at", False),
+    ("redeemed_codes", "redeemed_at", False),
+    ("admin_sessions", "updated_at", True),
+    ("backup_log", "backup_time", False),
+    ("broadcasts", "created_at", False),
+    ("broadcasts", "finished_at", True),
+    ("job_runs", "last_run", True),
+    ("user_locks", "expires_at", True),
+]
+
+def legacy_shift(local):
+    """Seconds to subtract from a legacy datetime read as UTC to get its epoch."""
+    return int(datetime.now().astimezone().utcoffset().total_seconds()) if local else 0
+
+class Wallet(NamedTuple):
+    user_id: int
+    stars: int
+    total_earned: int
+    referrals: int
+    premium: int
+    tasks_done: int
+    daily_withdrawn: int
+    role: str
+
+class Limits(NamedTuple):
+    """The wallet fields withdrawal checks need."""
+    stars: int
+    premium: int
+    daily_withdrawn: int
+
+WALLET_COLUMNS = ", ".join(Wallet._fields)
+LIMITS_COLUMNS = ", ".join(Limits._fields)
+BROADCAST_COLUMNS = "id, message_text, status, last_user_id, sent, failed, blocked, progress_chat_id, progress_message_id"
+
+class Storage:
+    """Domain queries shared by every backend. Subclasses provide transaction() and create_schema()."""
+
+    kind = None
+    LIKE = "LIKE"
+    SKIP_LOCKED = ""
+
+    @contextmanager
+    def transaction(self):
+        """Yield a cursor; commit when the block exits cleanly, roll back otherwise."""
+        raise NotImplementedError
+
+    def _cursor(self):
+        """Cursor for a single statement; backends may run it without an explicit transaction."""
+        return self.transaction()
+
+    def create_schema(self):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def _one(self, sql, params=()):
+        with self._cursor() as db:
+            db.execute(sql, params)
+            return db.fetchone()
+
+    def _all(self, sql, params=()):
+        with self._cursor() as db:
+            db.execute(sql, params)
+            return db.fetchall()
+
+    def _value(self, sql, params=()):
+        row = self._one(sql, params)
+        return row[0] if row else None
+
+    def _run(self, sql, params=()):
+        with self._cursor() as db:
+            db.execute(sql, params)
+            return db.rowcount
+
+    # ---------- wallets ----------
+    def get_wallet(self, user_id):
+        row = self._one(f"SELECT {WALLET_COLUMNS} FROM users_wallet WHERE user_id=?", (user_id,))
+        return Wallet(*row) if row else None
+
+    def _create_wallet(self, db, user_id):
+        db.execute(f"INSERT INTO users_wallet (user_id) VALUES (?) ON CONFLICT (user_id) DO NOTHING RETURNING {WALLET_COLUMNS}",
+                   (user_id,))
+        created = db.fetchone()
+        if created:
+            self._log(db, user_id, "signup")
+        return Wallet(*created) if created else None
+
+    def create_wallet(self, user_id):
+        """Create the wallet if missing. Returns the new Wallet, or None if it already existed."""
+        with self.transaction() as db:
+            return self._create_wallet(db, user_id)
+
+    def provision_user(self, user_id, username=None, first_name=None, with_wallet=True):
+        """Mark a user as having joined the channel and, with_wallet, create their wallet if missing."""
+        with self.transaction() as db:
+            db.execute("""
+                INSERT INTO users (user_id, username, first_name, joined_channel) VALUES (?,?,?,1)
+                ON CONFLICT (user_id) DO UPDATE SET joined_channel=1, blocked=0,
+                    username=COALESCE(excluded.username, users.username),
+                    first_name=COALESCE(excluded.first_name, users.first_name)
+            """, (user_id, username, first_name))
+            return self._create_wallet(db, user_id) if with_wallet else None
+
+    def start_state(self, user_id):
+        """(joined_channel, stars) for /start, or None for an unknown user; stars is None without a wallet."""
+        return self._one("""SELECT u.joined_channel, w.stars FROM users u LEFT JOIN users_wallet w ON w.user_id = u.user_id
+                            WHERE u.user_id=?""", (user_id,))
+
+    def has_joined(self, user_id):
+        return self._value("SELECT joined_channel FROM users WHERE user_id=?", (user_id,)) == 1
+
+    def get_balance(self, user_id):
+        return self._value("SELECT stars FROM users_wallet WHERE user_id=?", (user_id,))
+
+    def get_limits(self, user_id):
+        row = self._one(f"SELECT {LIMITS_COLUMNS} FROM users_wallet WHERE user_id=?", (user_id,))
+        return Limits(*row) if row else None
+
+    def add_stars(self, user_id, amount):
+        """Credit stars and return the new balance (None if the user has no wallet)."""
+        with self.transaction() as db:
+            return self._add_stars(db, user_id, amount)
+
+    def _add_stars(self, db, user_id, amount):
+        db.execute("UPDATE users_wallet SET stars = stars + ?, total_earned = total_earned + ? WHERE user_id=? RETURNING stars",
+                   (amount, amount, user_id))
+        row = db.fetchone()
+        return row[0] if row else None
+
+    def earn(self, user_id, reward):
+        """Credit an earn reward and log it. Returns the new balance."""
+        with self.transaction() as db:
+            db.execute("""UPDATE users_wallet SET stars = stars + ?, total_earned = total_earned + ?, tasks_done = tasks_done + 1
+                          WHERE user_id=? RETURNING stars""", (reward, reward, user_id))
+            row = db.fetchone()
+            self._log(db, user_id, "earn", reward)
+            return row[0] if row else None
+
+    def grant_stars(self, user_ids, amount):
+        """Add stars without counting them as earned (admin bonus)."""
+        with self.transaction() as db:
+            db.executemany("UPDATE users_wallet SET stars = stars + ? WHERE user_id=?", [(amount, uid) for uid in user_ids])
+
+    def reset_daily_withdrawals(self):
+        self._run("UPDATE users_wallet SET daily_withdrawn = 0")
+
+    def sync_admins(self, owner_ids):
+        """Make sure every owner has the admin role; returns all admin user ids."""
+        with self.transaction() as db:
+            db.executemany("""INSERT INTO users_wallet (user_id, role) VALUES (?, 'admin')
+                              ON CONFLICT (user_id) DO UPDATE SET role='admin'""", [(uid,) for uid in owner_ids])
+            db.execute("SELECT user_id FROM users_wallet WHERE role='admin'")
+            return {row[0] for row in db.fetchall()}
+
+    def admin_ids(self):
+        return {row[0] for row in self._all("SELECT user_id FROM users_wallet WHERE role='admin'")}
+
+    def set_role(self, user_id, role):
+        self._run("INSERT INTO users_wallet (user_id, role) VALUES (?,?) ON CONFLICT (user_id) DO UPDATE SET role=excluded.role",
+                  (user_id, role))
+
+    def leaderboard(self, limit=10):
+        return self._all("SELECT user_id, stars FROM users_wallet WHERE role='user' ORDER BY stars DESC LIMIT ?", (limit,))
+
+    def user_totals(self):
+        """(users, stars) over regular users."""
+        users, stars = self._one("SELECT COUNT(*), SUM(stars) FROM users_wallet WHERE role='user'")
+        return users, int(stars or 0)
+
+    # ---------- referrals ----------
+    def has_referrer(self, user_id):
+        return self._one("SELECT referrer_id FROM referrals WHERE referred_id=?", (user_id,)) is not None
+
+    def add_referral(self, referrer_id, referred_id, reward):
+        """Record a referral and credit the referrer. Returns False if the user was already referred."""
+        with self.transaction() as db:
+            db.execute("""INSERT INTO referrals (referrer_id, referred_id) VALUES (?,?)
+                          ON CONFLICT (referred_id) DO NOTHING RETURNING referred_id""", (referrer_id, referred_id))
+            if not db.fetchone():
+                return False
+            db.execute("""UPDATE users_wallet SET referrals = referrals + 1, stars = stars + ?, total_earned = total_earned + ?
+                          WHERE user_id=?""", (reward, reward, referrer_id))
+            self._log(db, referrer_id, "refer", reward)
+            return True
+
+    # ---------- actions and conversation states ----------
+    def _log(self, db, user_id, action, amount=None):
+        db.execute("INSERT INTO user_actions (user_id, action_type, action_time, amount) VALUES (?, ?, ?, ?)",
+                   (user_id, action, now_epoch(), amount))
+
+    def log_action(self, user_id, action, amount=None):
+        with self.transaction() as db:
+            self._log(db, user_id, action, amount)
+
+    def last_action_time(self, user_id, action):
+        return self._value("SELECT action_time FROM user_actions WHERE user_id=? AND action_type=? ORDER BY action_time DESC LIMIT 1",
+                           (user_id, action))
+
+    # ---------- conversation flows ----------
+    # A flow's state is the user's latest non-log row in user_actions; its data lives in admin_sessions
+    def load_flow(self, user_id):
+        """(state, data, updated_at) of the user's conversation flow, or None."""
+        row = self._one(f"""SELECT a.action_type, s.session_data, a.action_time FROM user_actions a
+                            LEFT JOIN admin_sessions s ON s.admin_id = a.user_id
+                            WHERE a.user_id=? AND {STATE_FILTER} ORDER BY a.action_time DESC LIMIT 1""", (user_id,))
+        if not row:
+            return None
+        return row[0], json.loads(row[1]) if row[1] else {}, row[2]
+
+    def save_flow(self, user_id, state, data, drop_data=True):
+        """Move the user's flow to `state` with `data` in one transaction, leaving their action log alone.
+        drop_data=False skips deleting stored data the caller knows is not there."""
+        now = now_epoch()
+        with self.transaction() as db:
+            db.execute(f"DELETE FROM user_actions WHERE user_id=? AND {STATE_FILTER}", (user_id,))
+            db.execute("INSERT INTO user_actions (user_id, action_type, action_time) VALUES (?,?,?)", (user_id, state, now))
+            if data:
+                db.execute("""INSERT INTO admin_sessions (admin_id, session_data, updated_at) VALUES (?,?,?)
+                              ON CONFLICT (admin_id) DO UPDATE SET session_data=excluded.session_data, updated_at=excluded.updated_at""",
+                           (user_id, json.dumps(data), now))
+            elif drop_data:
+                db.execute("DELETE FROM admin_sessions WHERE admin_id=?", (user_id,))
+
+    def clear_flow(self, user_id, drop_data=True):
+        with self.transaction() as db:
+            db.execute(f"DELETE FROM user_actions WHERE user_id=? AND {STATE_FILTER}", (user_id,))
+            if drop_data:
+                db.execute("DELETE FROM admin_sessions WHERE admin_id=?", (user_id,))
+
+    # ---------- tasks ----------
+    def active_tasks(self):
+        return self._all("SELECT id, task_name, reward FROM tasks WHERE active=1")
+
+    def recent_tasks(self, limit=10):
+        return self._all("SELECT id, task_name, task_type, reward, active FROM tasks ORDER BY id DESC LIMIT ?", (limit,))
+
+    def get_task(self, task_id):
+        """(task_type, task_data, reward, task_name) or None."""
+        return self._one("SELECT task_type, task_data, reward, task_name FROM tasks WHERE id=?", (task_id,))
+
+    def has_task(self, user_id, task_id):
+        return self._one("SELECT id FROM user_tasks WHERE user_id=? AND task_id=?", (user_id, task_id)) is not None
+
+    def complete_task(self, user_id, task_id, reward):
+        """Record an auto-verified task and credit it. Returns the new balance."""
+        with self.transaction() as db:
+            db.execute("INSERT INTO user_tasks (user_id, task_id, completed_at, verified) VALUES (?,?,?,1)",
+                       (user_id, task_id, now_epoch()))
+            return self._add_stars(db, user_id, reward)
+
+    def submit_task(self, user_id, task_id):
+        self._run("INSERT INTO user_tasks (user_id, task_id, completed_at, verified) VALUES (?,?,?,0)", (user_id, task_id, now_epoch()))
+
+    def create_task(self, name, task_type, data, reward, created_by):
+        return self._value("""INSERT INTO tasks (task_name, task_type, task_data, reward, created_by, created_at)
+                              VALUES (?,?,?,?,?,?) RETURNING id""", (name, task_type, data, reward, created_by, now_epoch()))
+
+    def delete_task(self, task_id):
+        """Delete a task and its completions. Returns its name, or None if it did not exist."""
+        with self.transaction() as db:
+            db.execute("DELETE FROM tasks WHERE id=? RETURNING task_name", (task_id,))
+            row = db.fetchone()
+            if row:
+                db.execute("DELETE FROM user_tasks WHERE task_id=?", (task_id,))
+            return row[0] if row else None
+
+    def pending_verifications(self):
+        return self._all("""
+            SELECT ut.id, ut.user_id, t.task_name, t.reward
+            FROM user_tasks ut
+            JOIN tasks t ON ut.task_id=t.id
+            WHERE ut.verified=0
+            ORDER BY ut.completed_at ASC
+        """)
+
+    def verify_task(self, user_id, task_name):
+        """Verify the user's latest pending task matching task_name and credit it. Returns the reward or None."""
+        with self.transaction() as db:
+            db.execute(f"""
+                SELECT ut.id, t.reward FROM user_tasks ut
+                JOIN tasks t ON ut.task_id = t.id
+                WHERE ut.user_id=? AND t.task_name {self.LIKE} ? AND ut.verified=0
+                ORDER BY ut.completed_at DESC LIMIT 1
+            """, (user_id, f"%{task_name}%"))
+            task = db.fetchone()
+            if not task:
+                return None
+            db.execute("UPDATE user_tasks SET verified=1 WHERE id=? AND verified=0", (task[0],))
+            if db.rowcount == 0:
+                return None
+            self._add_stars(db, user_id, task[1])
+            return task[1]
+
+    # ---------- redeem codes ----------
+    def get_code(self, code):
+        """(id, amount, max_uses, used_count, expires_at, active) or None."""
+        return self._one("SELECT id, amount, max_uses, used_count, expires_at, active FROM redeem_codes WHERE code=?", (code,))
+
+    def has_redeemed(self, code_id, user_id):
+        return self._one("SELECT id FROM redeemed_codes WHERE code_id=? AND user_id=?", (code_id, user_id)) is not None
+
+    def redeem_code(self, code_id, user_id, amount):
+        """Use up one redemption and credit the user. Returns the new balance, or None if the code ran out or was already used."""
+        try:
+            with self.transaction() as db:
+                # Taking the code's row lock first serialises concurrent redemptions of the same code
+                db.execute("UPDATE redeem_codes SET used_count = used_count + 1 WHERE id=? AND used_count < max_uses RETURNING id",
+                           (code_id,))
+                if not db.fetchone():
+                    return None
+                db.execute("SELECT id FROM redeemed_codes WHERE code_id=? AND user_id=?", (code_id, user_id))
+                if db.fetchone():
+                    raise _AlreadyRedeemed()
+                db.execute("INSERT INTO redeemed_codes (code_id, user_id, redeemed_at) VALUES (?,?,?)", (code_id, user_id, now_epoch()))
+                return self._add_stars(db, user_id, amount)
+        except _AlreadyRedeemed:
+            return None
+
+    def recent_codes(self, limit=10):
+        return self._all("SELECT id, code, amount, max_uses, used_count, expires_at, active FROM redeem_codes ORDER BY id DESC LIMIT ?",
+                         (limit,))
+
+    def create_code(self, code, amount, max_uses, expires_at, created_by):
+        return self._value("""INSERT INTO redeem_codes (code, amount, max_uses, expires_at, created_by, created_at)
+                              VALUES (?,?,?,?,?,?) RETURNING id""", (code, amount, max_uses, expires_at, created_by, now_epoch()))
+
+    # ---------- premium requests ----------
+    def has_pending_premium(self, user_id):
+        return self._one("SELECT id FROM premium_requests WHERE user_id=? AND status='pending'", (user_id,)) is not None
+
+    def request_premium(self, user_id):
+        self._run("INSERT INTO premium_requests (user_id, request_time) VALUES (?,?)", (user_id, now_epoch()))
+
+    def approve_premium(self, user_id):
+        """Approve the user's pending request and grant premium. Returns False if there was none."""
+        with self.transaction() as db:
+            db.execute("UPDATE premium_requests SET status='approved' WHERE user_id=? AND status='pending'", (user_id,))
+            if db.rowcount == 0:
+                return False
+            db.execute("UPDATE users_wallet SET premium=1 WHERE user_id=?", (user_id,))
+            return True
+
+    def reject_premium(self, user_id):
+        return self._run("UPDATE premium_requests SET status='rejected' WHERE user_id=? AND status='pending'", (user_id,)) > 0
+
+    def pending_premium_requests(self):
+        return self._all("""
+            SELECT pr.id, pr.user_id, u.first_name, pr.request_time
+            FROM premium_requests pr
+            LEFT JOIN users u ON pr.user_id = u.user_id
+            WHERE pr.status='pending'
+            ORDER BY pr.request_time ASC
+        """)
+
+    # ---------- withdrawals ----------
+    def request_withdrawal(self, user_id, amount, withdrawal_type):
+        """Queue a withdrawal and count it against the daily limit; stars withdrawals also start the cooldown."""
+        with self.transaction() as db:
+            if withdrawal_type == "stars":
+                self._log(db, user_id, "withdraw")
+            db.execute("INSERT INTO withdraw_requests (user_id, amount, withdrawal_type, request_time) VALUES (?,?,?,?)",
+                       (user_id, amount, withdrawal_type, now_epoch()))
+            db.execute("UPDATE users_wallet SET daily_withdrawn = daily_withdrawn + ? WHERE user_id=?", (amount, user_id))
+
+    def approve_admin_withdrawal(self, user_id, amount):
+        """Approve the latest matching pending admin withdrawal and debit it. Returns False if there was none."""
+        with self.transaction() as db:
+            db.execute("""
+                UPDATE withdraw_requests SET status='approved'
+                WHERE id = (SELECT id FROM withdraw_requests
+                            WHERE user_id=? AND amount=? AND status='pending' AND withdrawal_type='admin'
+                            ORDER BY request_time DESC LIMIT 1)
+                AND status='pending' RETURNING id
+            """, (user_id, amount))
+            if not db.fetchone():
+                return False
+            db.execute("UPDATE users_wallet SET stars = stars - ? WHERE user_id=?", (amount, user_id))
+            return True
+
+    def reject_admin_withdrawal(self, user_id, amount):
+        """Reject matching pending admin withdrawals and refund the daily limit. Returns False if there were none."""
+        with self.transaction() as db:
+            db.execute("""
+                UPDATE withdraw_requests SET status='rejected'
+                WHERE user_id=? AND amount=? AND status='pending' AND withdrawal_type='admin'
+            """, (user_id, amount))
+            if db.rowcount == 0:
+                return False
+            db.execute("UPDATE users_wallet SET daily_withdrawn = daily_withdrawn - ? WHERE user_id=?", (amount, user_id))
+            return True
+
+    def pending_admin_withdrawals(self):
+        return self._all("""
+            SELECT id, user_id, amount, request_time
+            FROM withdraw_requests
+            WHERE status='pending' AND withdrawal_type='admin'
+            ORDER BY request_time ASC
+        """)
+
+    def claim_withdrawals(self, limit):
+        """Mark up to `limit` stars withdrawals as processing and return them as (id, user_id, amount).
+
+        Claims never completed (failed send, crashed instance) become claimable again after WITHDRAWAL_CLAIM_TIMEOUT.
+        """
+        now = now_epoch()
+        with self.transaction() as db:
+            db.execute(f"""
+                UPDATE withdraw_requests SET status='processing', claimed_at=?
+                WHERE id IN (SELECT id FROM withdraw_requests
+                             WHERE status IN ('pending', 'processing') AND withdrawal_type='stars'
+                               AND (status='pending' OR claimed_at < ?)
+                             ORDER BY id LIMIT ?{self.SKIP_LOCKED})
+                RETURNING id, user_id, amount
+            """, (now, now - WITHDRAWAL_CLAIM_TIMEOUT, limit))
+            return db.fetchall()
+
+    def complete_withdrawal(self, request_id):
+        self._run("UPDATE withdraw_requests SET status='approved', claimed_at=NULL WHERE id=? AND status='processing'", (request_id,))
+
+    # ---------- broadcasts ----------
+    def reachable_users(self):
+        return self._value("SELECT COUNT(*) FROM users WHERE blocked=0")
+
+    def create_broadcast(self, admin_id, text, chat_id, message_id, owner, lease):
+        now = now_epoch()
+        return self._value("""
+            INSERT INTO broadcasts (admin_id, message_text, progress_chat_id, progress_message_id, created_at, owner, lease_until)
+            VALUES (?,?,?,?,?,?,?) RETURNING id
+        """, (admin_id, text, chat_id, message_id, now, owner, now + lease))
+
+    def get_broadcast(self, broadcast_id):
+        return self._one(f"SELECT {BROADCAST_COLUMNS} FROM broadcasts WHERE id=?", (broadcast_id,))
+
+    def running_broadcast(self):
+        return self._value("SELECT id FROM broadcasts WHERE status='running' ORDER BY id LIMIT 1")
+
+    def claim_broadcast(self, broadcast_id, owner, lease):
+        """Take or renew the sender lease on a running broadcast. False once it is cancelled or another owner holds it."""
+        now = now_epoch()
+        return self._one("""
+            UPDATE broadcasts SET owner=?, lease_until=?
+            WHERE id=? AND status='running' AND (owner IS NULL OR owner=? OR lease_until < ?)
+            RETURNING id
+        """, (owner, now + lease, broadcast_id, owner, now)) is not None
+
+    def cancel_broadcast(self):
+        """Cancel the running broadcast, whichever instance sends it. Returns True if one was running."""
+        return self._run("UPDATE broadcasts SET status='cancelled', finished_at=? WHERE status='running'", (now_epoch(),)) > 0
+
+    def broadcast_recipients(self, after_user_id, limit):
+        # Keyset pagination: never holds more than one chunk of recipients in memory
+        return [row[0] for row in self._all("SELECT user_id FROM users WHERE user_id > ? AND blocked=0 ORDER BY user_id LIMIT ?",
+                                            (after_user_id, limit))]
+
+    def checkpoint_broadcast(self, broadcast_id, last_user_id, sent, failed, blocked_ids):
+        with self.transaction() as db:
+            db.executemany("UPDATE users SET blocked=1 WHERE user_id=?", [(uid,) for uid in blocked_ids])
+            db.execute("""
+                UPDATE broadcasts SET last_user_id=?, sent=sent+?, failed=failed+?, blocked=blocked+?
+                WHERE id=?
+            """, (last_user_id, sent, failed, len(blocked_ids), broadcast_id))
+
+    def finish_broadcast(self, broadcast_id, status):
+        self._run("UPDATE broadcasts SET status=?, finished_at=? WHERE id=? AND status='running'", (status, now_epoch(), broadcast_id))
+
+    # ---------- admin views ----------
+    def panel_counts(self):
+        users, tasks, withdrawals, premium, verify, codes = self._one("""
+            SELECT (SELECT COUNT(*) FROM users_wallet WHERE role='user'),
+                   (SELECT COUNT(*) FROM tasks WHERE active=1),
+                   (SELECT COUNT(*) FROM withdraw_requests WHERE status='pending'),
+                   (SELECT COUNT(*) FROM premium_requests WHERE status='pending'),
+                   (SELECT COUNT(*) FROM user_tasks WHERE verified=0),
+                   (SELECT COUNT(*) FROM redeem_codes WHERE active=1)
+        """)
+        return {"users": users, "tasks": tasks, "withdrawals": withdrawals, "premium": premium, "verify": verify, "codes": codes}
+
+    def totals(self):
+        """Aggregate numbers shown on the stats screen, computed in one statement."""
+        row = self._one("""
+            SELECT COUNT(*), SUM(stars), AVG(stars),
+                   (SELECT COUNT(*) FROM tasks WHERE active=1),
+                   (SELECT COUNT(*) FROM user_tasks WHERE verified=1),
+                   (SELECT COUNT(*) FROM withdraw_requests WHERE status='approved'),
+                   (SELECT COUNT(*) FROM redeem_codes),
+                   (SELECT COUNT(*) FROM redeemed_codes),
+                   (SELECT COUNT(*) FROM premium_requests WHERE status='pending')
+            FROM users_wallet WHERE role='user'
+        """)
+        users, stars, avg = row[:3]
+        totals = {"users": users, "stars": int(stars or 0), "avg": int(avg or 0)}
+        totals.update(zip(("tasks", "completed", "approved", "codes", "redeemed", "premium_pending"), row[3:]))
+        return totals
+
+    # ---------- payments ----------
+    def record_payment(self, charge_id, user_id, payload, amount, stars):
+        """Record a successful payment and credit `stars` in one transaction, once per Telegram charge id.
+
+        Returns (True, balance), or (False, None) when the charge was already recorded (a redelivered update)."""
+        with self.transaction() as db:
+            db.execute("""INSERT INTO payments (charge_id, user_id, payload, amount, stars, created_at) VALUES (?,?,?,?,?,?)
+                          ON CONFLICT (charge_id) DO NOTHING RETURNING charge_id""",
+                       (charge_id, user_id, payload, amount, stars, now_epoch()))
+            if not db.fetchone():
+                return False, None
+            return True, self._add_stars(db, user_id, stars) if stars else None
+
+    def payments_by_charge(self, charge_ids):
+        """{charge_id: (user_id, amount, status)} for the given ids that are recorded."""
+        if not charge_ids:
+            return {}
+        placeholders = ",".join("?" * len(charge_ids))
+        return {row[0]: row[1:] for row in self._all(
+            f"SELECT charge_id, user_id, amount, status FROM payments WHERE charge_id IN ({placeholders})", list(charge_ids))}
+
+    def payments_since(self, since, until):
+        """Charge ids recorded in [since, until)."""
+        return [row[0] for row in self._all("SELECT charge_id FROM payments WHERE created_at >= ? AND created_at < ?", (since, until))]
+
+    def mark_payment_refunded(self, charge_id):
+        return self._run("UPDATE payments SET status='refunded' WHERE charge_id=? AND status='credited'", (charge_id,)) > 0
+
+    # ---------- admin notifications ----------
+    def notify_prefs(self):
+        """{(admin_id, category): mode} for every preference an admin has changed from the default."""
+        return {(admin_id, category): mode
+                for admin_id, category, mode in self._all("SELECT admin_id, category, mode FROM notify_prefs")}
+
+    def set_notify_pref(self, admin_id, category, mode):
+        self._run("""INSERT INTO notify_prefs (admin_id, category, mode) VALUES (?,?,?)
+                     ON CONFLICT (admin_id, category) DO UPDATE SET mode=excluded.mode""", (admin_id, category, mode))
+
+    # ---------- backups and jobs ----------
+    def log_backup(self, backup_type, status, details):
+        self._run("INSERT INTO backup_log (backup_time, backup_type, status, details) VALUES (?,?,?,?)",
+                  (now_epoch(), backup_type, status, details))
+
+    def recent_backups(self, limit=5):
+        return self._all("SELECT backup_time, backup_type, status FROM backup_log ORDER BY backup_time DESC LIMIT ?", (limit,))
+
+    def claim_job(self, name, interval):
+        """True if no instance has run job `name` in the last `interval` seconds; records this run."""
+        now = now_epoch()
+        return self._one("""
+            INSERT INTO job_runs (name, last_run) VALUES (?,?)
+            ON CONFLICT (name) DO UPDATE SET last_run=excluded.last_run WHERE job_runs.last_run < ?
+            RETURNING name
+        """, (name, now, now - interval)) is not None
+
+    # ---------- user locks ----------
+    def lock_user(self, user_id, owner, ttl):
+        """Take the user's lock row for `owner` unless another owner holds an unexpired one. Returns True if taken."""
+        now = now_epoch()
+        return self._one("""
+            INSERT INTO user_locks (user_id, owner, expires_at) VALUES (?,?,?)
+            ON CONFLICT (user_id) DO UPDATE SET owner=excluded.owner, expires_at=excluded.expires_at
+            WHERE user_locks.expires_at < ?
+            RETURNING user_id
+        """, (user_id, owner, now + ttl, now)) is not None
+
+    def unlock_user(self, user_id, owner):
+        self._run("DELETE FROM user_locks WHERE user_id=? AND owner=?", (user_id, owner))
+
+class _AlreadyRedeemed(Exception):
+    """Raised inside redeem_code so the used_count bump is rolled back."""
+
+# ================= SQLITE =================
+SQLITE_SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS users (
+        user_id INTEGER PRIMARY KEY,
+        username TEXT,
+        first_name TEXT,
+        joined_channel INTEGER DEFAULT 0,
+        blocked INTEGER DEFAULT 0
+    )""",
+    """CREATE TABLE IF NOT EXISTS users_wallet (
+        user_id INTEGER PRIMARY KEY,
+        stars INTEGER DEFAULT 0,
+        total_earned INTEGER DEFAULT 0,
+        referrals INTEGER DEFAULT 0,
+        premium INTEGER DEFAULT 0,
+        tasks_done INTEGER DEFAULT 0,
+        daily_withdrawn INTEGER DEFAULT 0,
+        role TEXT DEFAULT 'user'
+    )""",
+    """CREATE TABLE IF NOT EXISTS referrals (
+        referrer_id INTEGER,
+        referred_id INTEGER UNIQUE
+    )""",
+    """CREATE TABLE IF NOT EXISTS withdraw_requests (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        amount INTEGER,
+        withdrawal_type TEXT DEFAULT 'admin',
+        status TEXT DEFAULT 'pending',
+        request_time INTEGER DEFAULT (CAST(strftime('%s', 'now') AS INTEGER)),
+        claimed_at INTEGER
+    )""",
+    """CREATE TABLE IF NOT EXISTS premium_requests (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        status TEXT DEFAULT 'pending',
+        request_time INTEGER DEFAULT (CAST(strftime('%s', 'now') AS INTEGER))
+    )""",
+    """CREATE TABLE IF NOT EXISTS user_actions (
+        user_id INTEGER,
+        action_type TEXT,
+        action_time INTEGER DEFAULT (CAST(strftime('%s', 'now') AS INTEGER))
+    )""",
+    """CREATE TABLE IF NOT EXISTS tasks (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        task_name TEXT,
+        task_type TEXT,
+        task_data TEXT,
+        reward INTEGER,
+        active INTEGER DEFAULT 1,
+        created_by INTEGER,
+        created_at INTEGER DEFAULT (CAST(strftime('%s', 'now') AS INTEGER))
+    )""",
+    """CREATE TABLE IF NOT EXISTS user_tasks (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        task_id INTEGER,
+        completed_at INTEGER DEFAULT (CAST(strftime('%s', 'now') AS INTEGER)),
+        verified INTEGER DEFAULT 0
+    )""",
+    """CREATE TABLE IF NOT EXISTS redeem_codes (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        code TEXT UNIQUE,
+        amount INTEGER,
+        max_uses INTEGER DEFAULT 1,
+        used_count INTEGER DEFAULT 0,
+        expires_at INTEGER,
+        created_by INTEGER,
+        created_at INTEGER DEFAULT (CAST(strftime('%s', 'now') AS INTEGER)),
+        active INTEGER DEFAULT 1
+    )""",
+    """CREATE TABLE IF NOT EXISTS redeemed_codes (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        code_id INTEGER,
+        user_id INTEGER,
+        redeemed_at INTEGER DEFAULT (CAST(strftime('%s', 'now') AS INTEGER))
+    )""",
+    """CREATE TABLE IF NOT EXISTS admin_sessions (
+        admin_id INTEGER PRIMARY KEY,
+        session_data TEXT,
+        updated_at INTEGER DEFAULT (CAST(strftime('%s', 'now') AS INTEGER))
+    )""",
+    """CREATE TABLE IF NOT EXISTS backup_log (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        backup_time INTEGER DEFAULT (CAST(strftime('%s', 'now') AS INTEGER)),
+        backup_type TEXT,
+        status TEXT,
+        details TEXT
+    )""",
+    """CREATE TABLE IF NOT EXISTS broadcasts (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        admin_id INTEGER,
+        message_text TEXT,
+        status TEXT DEFAULT 'running',
+        last_user_id INTEGER DEFAULT 0,
+        sent INTEGER DEFAULT 0,
+        failed INTEGER DEFAULT 0,
+        blocked INTEGER DEFAULT 0,
+        progress_chat_id INTEGER,
+        progress_message_id INTEGER,
+        created_at INTEGER DEFAULT (CAST(strftime('%s', 'now') AS INTEGER)),
+        finished_at INTEGER,
+        owner TEXT,
+        lease_until INTEGER
+    )""",
+    """CREATE TABLE IF NOT EXISTS job_runs (
+        name TEXT PRIMARY KEY,
+        last_run INTEGER
+    )""",
+    """CREATE TABLE IF NOT EXISTS user_locks (
+        user_id INTEGER PRIMARY KEY,
+        owner TEXT,
+        expires_at INTEGER
+    )""",
+    """CREATE TABLE IF NOT EXISTS notify_prefs (
+        admin_id INTEGER,
+        category TEXT,
+        mode TEXT,
+        PRIMARY KEY (admin_id, category)
+    )""",
+    """CREATE TABLE IF NOT EXISTS payments (
+        charge_id TEXT PRIMARY KEY,
+        user_id INTEGER,
+        payload TEXT,
+        amount INTEGER,
+        stars INTEGER,
+        status TEXT DEFAULT 'credited',
+        created_at INTEGER
+    )""",
+]
+
+# Columns added after the first release: (table, column, definition)
+SQLITE_MIGRATIONS = [
+    ("users_wallet", "role", "TEXT DEFAULT 'user'"),
+    ("users", "blocked", "INTEGER DEFAULT 0"),
+    ("user_actions", "amount", "INTEGER"),
+    ("withdraw_requests", "claimed_at", "INTEGER"),
+    ("broadcasts", "owner", "TEXT"),
+    ("broadcasts", "lease_until", "INTEGER"),
+]
+
+SQLITE_EPOCH_VERSION = 1  # PRAGMA user_version from which timestamp columns hold epoch integers
+
+def migrate_sqlite_epochs(db, schema="main"):
+    """Rewrite legacy TEXT datetimes in `schema` as epoch integers, once per file.
+
+    SQLite columns take any type, so values are converted in place; the declared TIMESTAMP type
+    of an old file has numeric affinity and keeps them integers."""
+    if db.execute(f"PRAGMA {schema}.user_version").fetchone()[0] >= SQLITE_EPOCH_VERSION:
+        return
+    for table, column, local in EPOCH_COLUMNS:
+        columns = [row[1] for row in db.execute(f"PRAGMA {schema}.table_info({table})").fetchall()]
+        if column in columns:
+            db.execute(f"""UPDATE {schema}.{table} SET {column} = CAST(strftime('%s', {column}) AS INTEGER) - ?
+                           WHERE typeof({column}) = 'text'""", (legacy_shift(local),))
+    db.execute(f"PRAGMA {schema}.user_version={SQLITE_EPOCH_VERSION}")
+
+SQLITE_ROLLUP_SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS rollups (
+        bucket_size TEXT,
+        bucket_start TEXT,
+        metric TEXT,
+        value INTEGER DEFAULT 0,
+        PRIMARY KEY (bucket_size, bucket_start, metric)
+    )""",
+    """CREATE TABLE IF NOT EXISTS rollup_events (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        event_time INTEGER,
+        kind TEXT,
+        amount INTEGER
+    )""",
+    # Each fact queues an event when it happens, so rows that change later (a task verified,
+    # a withdrawal approved) are counted at that moment rather than as they were first written
+    """CREATE TRIGGER IF NOT EXISTS rollup_user_actions AFTER INSERT ON user_actions
+        WHEN NEW.action_type IN ('signup', 'earn', 'refer')
+        BEGIN INSERT INTO rollup_events (event_time, kind, amount) VALUES (NEW.action_time, NEW.action_type, NEW.amount); END""",
+    """CREATE TRIGGER IF NOT EXISTS rollup_task_added AFTER INSERT ON user_tasks
+        BEGIN INSERT INTO rollup_events (event_time, kind, amount)
+              VALUES (NEW.completed_at, CASE WHEN NEW.verified THEN 'task_verified' ELSE 'task_submitted' END,
+                      CASE WHEN NEW.verified THEN (SELECT reward FROM tasks WHERE id = NEW.task_id) END); END""",
+    """CREATE TRIGGER IF NOT EXISTS rollup_task_verified AFTER UPDATE OF verified ON user_tasks
+        WHEN NEW.verified AND NOT OLD.verified
+        BEGIN INSERT INTO rollup_events (event_time, kind, amount)
+              VALUES (CAST(strftime('%s', 'now') AS INTEGER), 'task_verified', (SELECT reward FROM tasks WHERE id = NEW.task_id)); END""",
+    """CREATE TRIGGER IF NOT EXISTS rollup_redeemed AFTER INSERT ON redeemed_codes
+        BEGIN INSERT INTO rollup_events (event_time, kind, amount)
+              VALUES (NEW.redeemed_at, 'redeem', (SELECT amount FROM redeem_codes WHERE id = NEW.code_id)); END""",
+    # Stars only leave the economy once a withdrawal is approved; rejected ones never count
+    """CREATE TRIGGER IF NOT EXISTS rollup_withdrawal_approved AFTER UPDATE OF status ON withdraw_requests
+        WHEN NEW.status = 'approved' AND OLD.status != 'approved'
+        BEGIN INSERT INTO rollup_events (event_time, kind, amount)
+              VALUES (CAST(strftime('%s', 'now') AS INTEGER), 'withdraw_' || NEW.withdrawal_type, NEW.amount); END""",
+    """CREATE TRIGGER IF NOT EXISTS rollup_withdrawal_added AFTER INSERT ON withdraw_requests
+        WHEN NEW.status = 'approved'
+        BEGIN INSERT INTO rollup_events (event_time, kind, amount)
+              VALUES (NEW.request_time, 'withdraw_' || NEW.withdrawal_type, NEW.amount); END""",
+    """CREATE TRIGGER IF NOT EXISTS rollup_payment AFTER INSERT ON payments WHEN NEW.stars > 0
+        BEGIN INSERT INTO rollup_events (event_time, kind, amount) VALUES (NEW.created_at, 'payment', NEW.stars); END""",
+]
+
+# Events for rows written before the triggers existed, above the rowid each source was folded to
+ROLLUP_BACKFILL = {
+    "user_actions": """INSERT INTO rollup_events (event_time, kind, amount)
+        SELECT action_time, action_type, amount FROM user_actions
+        WHERE rowid > ? AND action_type IN ('signup', 'earn', 'refer')""",
+    "user_tasks": """INSERT INTO rollup_events (event_time, kind, amount)
+        SELECT ut.completed_at, CASE WHEN ut.verified THEN 'task_verified' ELSE 'task_submitted' END,
+               CASE WHEN ut.verified THEN t.reward END
+        FROM user_tasks ut LEFT JOIN tasks t ON t.id = ut.task_id WHERE ut.rowid > ?""",
+    "redeemed_codes": """INSERT INTO rollup_events (event_time, kind, amount)
+        SELECT rc.redeemed_at, 'redeem', c.amount
+        FROM redeemed_codes rc LEFT JOIN redeem_codes c ON c.id = rc.code_id WHERE rc.rowid > ?""",
+    "withdraw_requests": """INSERT INTO rollup_events (event_time, kind, amount)
+        SELECT request_time, 'withdraw_' || withdrawal_type, amount FROM withdraw_requests
+        WHERE rowid > ? AND status = 'approved'""",
+    "payments": """INSERT INTO rollup_events (event_time, kind, amount)
+        SELECT created_at, 'payment', stars FROM payments WHERE rowid > ? AND stars > 0""",
+}
+
+def backfill_rollup_events(db):
+    """Queue events for existing rows once, when rollup_events is created.
+
+    Rollups used to fold each source by rowid up to a mark kept in rollup_state; rows at or
+    below it are already in the buckets."""
+    marks = {}
+    if db.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='rollup_state'").fetchone():
+        marks = dict(db.execute("SELECT source, last_rowid FROM rollup_state").fetchall())
+        db.execute("DROP TABLE rollup_state")
+    for source, sql in ROLLUP_BACKFILL.items():
+        db.execute(sql, (marks.get(source, 0),))
+
+INDEXES = [
+    "CREATE INDEX IF NOT EXISTS idx_user_actions_user ON user_actions (user_id, action_type, action_time)",
+    "CREATE INDEX IF NOT EXISTS idx_user_tasks_user ON user_tasks (user_id, task_id)",
+    "CREATE INDEX IF NOT EXISTS idx_redeemed_codes_code_user ON redeemed_codes (code_id, user_id)",
+    "CREATE INDEX IF NOT EXISTS idx_withdraw_requests_status ON withdraw_requests (status, withdrawal_type)",
+    # The auto-withdrawal queue in claim order; stays tiny because settled requests drop out of it
+    "CREATE INDEX IF NOT EXISTS idx_withdraw_requests_queue ON withdraw_requests (id) WHERE status IN ('pending', 'processing') AND withdrawal_type='stars'",
+    "CREATE INDEX IF NOT EXISTS idx_premium_requests_user ON premium_requests (user_id, status)",
+    # Covers leaderboard ordering and COUNT/SUM/AVG over regular users without touching the table
+    "CREATE INDEX IF NOT EXISTS idx_wallet_user_stars ON users_wallet (stars DESC, role) WHERE role='user'",
+    # Periodic admin-role refresh on every instance
+    "CREATE INDEX IF NOT EXISTS idx_wallet_admins ON users_wallet (user_id) WHERE role='admin'",
+    # The reconciler's window scan for payments Telegram no longer lists
+    "CREATE INDEX IF NOT EXISTS idx_payments_time ON payments (created_at)",
+]
+
+class SQLiteStorage(Storage):
+    """One shared connection; an RLock keeps each transaction's statements together across threads."""
+
+    kind = "sqlite"
+
+    def __init__(self, conn, cursor_factory=sqlite3.Cursor):
+        self.conn = conn
+        self.cursor_factory = cursor_factory
+        self.lock = threading.RLock()
+
+    @classmethod
+    def open(cls, path, cursor_factory=sqlite3.Cursor):
+        return cls(sqlite3.connect(path, check_same_thread=False), cursor_factory)
+
+    @contextmanager
+    def transaction(self):
+        with self.lock:
+            db = self.conn.cursor(self.cursor_factory)
+            try:
+                yield db
+            except BaseException:
+                self.conn.rollback()
+                raise
+            else:
+                self.conn.commit()
+            finally:
+                db.close()
+
+    def add_column(self, db, table, column, definition):
+        columns = [row[1] for row in db.execute(f"PRAGMA table_info({table})").fetchall()]
+        if column not in columns:
+            db.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+    def create_schema(self):
+        with self.transaction() as db:
+            # Only takes effect on a new file; existing databases are converted by enable_incremental_vacuum
+            db.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            for sql in SQLITE_SCHEMA:
+                db.execute(sql)
+            for table, column, definition in SQLITE_MIGRATIONS:
+                self.add_column(db, table, column, definition)
+            migrate_sqlite_epochs(db)
+            backfill = not db.execute("SELECT 1 FROM sqlite_master WHERE name='rollup_events'").fetchone()
+            for sql in SQLITE_ROLLUP_SCHEMA + INDEXES:
+                db.execute(sql)
+            if backfill:
+                backfill_rollup_events(db)
+
+    def incremental_vacuum_enabled(self):
+        return self._value("PRAGMA auto_vacuum") == 2
+
+    def enable_incremental_vacuum(self):
+        """Switch an existing file to auto_vacuum=INCREMENTAL with one full VACUUM. Returns bytes released.
+
+        The rebuild locks the whole file. Holding the connection lock meanwhile makes the bot's own
+        statements wait for it instead of failing with "database is locked"."""
+        with self.lock:
+            page_size = self._value("PRAGMA page_size")
+            before = self._value("PRAGMA page_count")
+            self.conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            self.conn.execute("VACUUM")
+            # Incremental mode adds pointer-map pages, so a nearly empty freelist can grow the file slightly
+            return max(0, before - self._value("PRAGMA page_count")) * page_size
+
+    def close(self):
+        self.conn.close()
+
+# ================= POSTGRESQL =================
+POSTGRES_SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS users (
+        user_id BIGINT PRIMARY KEY,
+        username TEXT,
+        first_name TEXT,
+        joined_channel INTEGER DEFAULT 0,
+        blocked INTEGER DEFAULT 0
+    )""",
+    """CREATE TABLE IF NOT EXISTS users_wallet (
+        user_id BIGINT PRIMARY KEY,
+        stars BIGINT DEFAULT 0,
+        total_earned BIGINT DEFAULT 0,
+        referrals INTEGER DEFAULT 0,
+        premium INTEGER DEFAULT 0,
+        tasks_done INTEGER DEFAULT 0,
+        daily_withdrawn INTEGER DEFAULT 0,
+        role TEXT DEFAULT 'user'
+    )""",
+    """CREATE TABLE IF NOT EXISTS referrals (
+        referrer_id BIGINT,
+        referred_id BIGINT UNIQUE
+    )""",
+    """CREATE TABLE IF NOT EXISTS withdraw_requests (
+        id BIGSERIAL PRIMARY KEY,
+        user_id BIGINT,
+        amount INTEGER,
+        withdrawal_type TEXT DEFAULT 'admin',
+        status TEXT DEFAULT 'pending',
+        request_time BIGINT DEFAULT (EXTRACT(EPOCH FROM now())::BIGINT),
+        claimed_at BIGINT
+    )""",
+    """CREATE TABLE IF NOT EXISTS premium_requests (
+        id BIGSERIAL PRIMARY KEY,
+        user_id BIGINT,
+        status TEXT DEFAULT 'pending',
+        request_time BIGINT DEFAULT (EXTRACT(EPOCH FROM now())::BIGINT)
+    )""",
+    """CREATE TABLE IF NOT EXISTS user_actions (
+        id BIGSERIAL PRIMARY KEY,
+        user_id BIGINT,
+        action_type TEXT,
+        action_time BIGINT DEFAULT (EXTRACT(EPOCH FROM now())::BIGINT),
+        amount INTEGER
+    )""",
+    """CREATE TABLE IF NOT EXISTS tasks (
+        id SERIAL PRIMARY KEY,
+        task_name TEXT,
+        task_type TEXT,
+        task_data TEXT,
+        reward INTEGER,
+        active INTEGER DEFAULT 1,
+        created_by BIGINT,
+        created_at BIGINT DEFAULT (EXTRACT(EPOCH FROM now())::BIGINT)
+    )""",
+    """CREATE TABLE IF NOT EXISTS user_tasks (
+        id BIGSERIAL PRIMARY KEY,
+        user_id BIGINT,
+        task_id INTEGER,
+        completed_at BIGINT DEFAULT (EXTRACT(EPOCH FROM now())::BIGINT),
+        verified INTEGER DEFAULT 0
+    )""",
+    """CREATE TABLE IF NOT EXISTS redeem_codes (
+        id SERIAL PRIMARY KEY,
+        code TEXT UNIQUE,
+        amount INTEGER,
+        max_uses INTEGER DEFAULT 1,
+        used_count INTEGER DEFAULT 0,
+        expires_at BIGINT,
+        created_by BIGINT,
+        created_at BIGINT DEFAULT (EXTRACT(EPOCH FROM now())::BIGINT),
+        active INTEGER DEFAULT 1
+    )""",
+    """CREATE TABLE IF NOT EXISTS redeemed_codes (
+        id BIGSERIAL PRIMARY KEY,
+        code_id INTEGER,
+        user_id BIGINT,
+        redeemed_at BIGINT DEFAULT (EXTRACT(EPOCH FROM now())::BIGINT)
+    )""",
+    """CREATE TABLE IF NOT EXISTS admin_sessions (
+        admin_id BIGINT PRIMARY KEY,
+        session_data TEXT,
+        updated_at BIGINT DEFAULT (EXTRACT(EPOCH FROM now())::BIGINT)
+    )""",
+    """CREATE TABLE IF NOT EXISTS backup_log (
+        id SERIAL PRIMARY KEY,
+        backup_time BIGINT DEFAULT (EXTRACT(EPOCH FROM now())::BIGINT),
+        backup_type TEXT,
+        status TEXT,
+        details TEXT
+    )""",
+    """CREATE TABLE IF NOT EXISTS broadcasts (
+        id SERIAL PRIMARY KEY,
+        admin_id BIGINT,
+        message_text TEXT,
+        status TEXT DEFAULT 'running',
+        last_user_id BIGINT DEFAULT 0,
+        sent INTEGER DEFAULT 0,
+        failed INTEGER DEFAULT 0,
+        blocked INTEGER DEFAULT 0,
+        progress_chat_id BIGINT,
+        progress_message_id BIGINT,
+        created_at BIGINT DEFAULT (EXTRACT(EPOCH FROM now())::BIGINT),
+        finished_at BIGINT,
+        owner TEXT,
+        lease_until BIGINT
+    )""",
+    """CREATE TABLE IF NOT EXISTS job_runs (
+        name TEXT PRIMARY KEY,
+        last_run BIGINT
+    )""",
+    """CREATE TABLE IF NOT EXISTS user_locks (
+        user_id BIGINT PRIMARY KEY,
+        owner TEXT,
+        expires_at BIGINT
+    )""",
+    """CREATE TABLE IF NOT EXISTS notify_prefs (
+        admin_id BIGINT,
+        category TEXT,
+        mode TEXT,
+        PRIMARY KEY (admin_id, category)
+    )""",
+    """CREATE TABLE IF NOT EXISTS payments (
+        charge_id TEXT PRIMARY KEY,
+        user_id BIGINT,
+        payload TEXT,
+        amount INTEGER,
+        stars INTEGER,
+        status TEXT DEFAULT 'credited',
+        created_at BIGINT
+    )""",
+]
+
+# Columns added after the PostgreSQL backend shipped: (table, column, definition)
+POSTGRES_MIGRATIONS = [
+    ("broadcasts", "owner", "TEXT"),
+    ("broadcasts", "lease_until", "BIGINT"),
+]
+
+class PgCursor:
+    """psycopg2 cursor that accepts the ? placeholders the shared queries use."""
+
+    translated = {}
+
+    def __init__(self, cursor, on_query=None):
+        self.cursor = cursor
+        self.on_query = on_query
+
+    @classmethod
+    def translate(cls, sql):
+        pg_sql = cls.translated.get(sql)
+        if pg_sql is None:
+            pg_sql = cls.translated[sql] = sql.replace("%", "%%").replace("?", "%s")
+        return pg_sql
+
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            self.cursor.execute(self.translate(sql), tuple(parameters))
+        finally:
+            if self.on_query:
+                self.on_query(sql, parameters, time.perf_counter() - started)
+        return self
+
+    def executemany(self, sql, seq_of_parameters):
+        started = time.perf_counter()
+        try:
+            self.cursor.executemany(self.translate(sql), [tuple(p) for p in seq_of_parameters])
+        finally:
+            if self.on_query:
+                self.on_query(sql, None, time.perf_counter() - started)
+        return self
+
+    def fetchone(self):
+        return self.cursor.fetchone()
+
+    def fetchall(self):
+        return self.cursor.fetchall()
+
+    def fetchmany(self, size):
+        return self.cursor.fetchmany(size)
+
+    @property
+    def rowcount(self):
+        return self.cursor.rowcount
+
+    @property
+    def description(self):
+        return self.cursor.description
+
+class PostgresStorage(Storage):
+    """Pooled connections; single statements run in autocommit, transactions hold one connection."""
+
+    kind = "postgres"
+    LIKE = "ILIKE"
+    # Lets several instances drain the withdrawal queue without waiting on each other's claims
+    SKIP_LOCKED = " FOR UPDATE SKIP LOCKED"
+
+    def __init__(self, dsn, pool_size=POSTGRES_POOL_SIZE, on_query=None):
+        import psycopg2.pool
+        self.pool = psycopg2.pool.ThreadedConnectionPool(1, pool_size, dsn, options="-c timezone=UTC")
+        # getconn() raises instead of waiting when the pool is empty, so callers queue here
+        self.slots = threading.BoundedSemaphore(pool_size)
+        self.on_query = on_query
+
+    @contextmanager
+    def _connection(self, autocommit):
+        with self.slots:
+            conn = self.pool.getconn()
+            try:
+                conn.autocommit = autocommit
+                yield conn
+            finally:
+                self.pool.putconn(conn, close=bool(conn.closed))
+
+    @contextmanager
+    def transaction(self):
+        with self._connection(autocommit=False) as conn:
+            try:
+                yield PgCursor(conn.cursor(), self.on_query)
+            except BaseException:
+                if not conn.closed:
+                    conn.rollback()
+                raise
+            else:
+                conn.commit()
+
+    @contextmanager
+    def _cursor(self):
+        with self._connection(autocommit=True) as conn:
+            yield PgCursor(conn.cursor(), self.on_query)
+
+    def create_schema(self):
+        with self.transaction() as db:
+            # Instances starting together would otherwise race on CREATE TABLE IF NOT EXISTS
+            db.execute("SELECT pg_advisory_xact_lock(hashtext('pulse_profit_schema'))")
+            for sql in POSTGRES_SCHEMA:
+                db.execute(sql)
+            for table, column, definition in POSTGRES_MIGRATIONS:
+                db.execute(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {column} {definition}")
+            self.migrate_epochs(db)
+            for sql in INDEXES:
+                db.execute(sql)
+
+    def migrate_epochs(self, db):
+        """Convert TIMESTAMP columns of an existing database to BIGINT epochs; a no-op once done."""
+        for table, column, local in EPOCH_COLUMNS:
+            db.execute("""SELECT data_type, column_default FROM information_schema.columns
+                          WHERE table_schema=current_schema() AND table_name=? AND column_name=?""", (table, column))
+            row = db.fetchone()
+            if not row or not row[0].startswith("timestamp"):
+                continue
+            db.execute(f"""ALTER TABLE {table} ALTER COLUMN {column} DROP DEFAULT,
+                           ALTER COLUMN {column} TYPE BIGINT USING EXTRACT(EPOCH FROM {column})::BIGINT - {legacy_shift(local)}""")
+            if row[1]:
+                db.execute(f"ALTER TABLE {table} ALTER COLUMN {column} SET DEFAULT (EXTRACT(EPOCH FROM now())::BIGINT)")
+
+    def close(self):
+        self.pool.closeall()
+
+def open_storage(database_url, sqlite_path, cursor_factory=sqlite3.Cursor, on_query=None):
+    """PostgresStorage for a postgres:// DATABASE_URL, otherwise SQLiteStorage on sqlite_path."""
+    if database_url and database_url.startswith(("postgres://", "postgresql://")):
+        return PostgresStorage(database_url, on_query=on_query)
+    return SQLiteStorage.open(sqlite_path, cursor_factory)